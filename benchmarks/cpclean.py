@@ -0,0 +1,317 @@
+"""Benchmarks of the cpclean algorithms against their previous implementations.
+
+Run from the root of the repository with ``python -m benchmarks.cpclean``.
+"""
+import time
+from copy import deepcopy
+from functools import partial
+
+import numpy as np
+
+from dcbench.tasks.budgetclean.cpclean.algorithm.distance import compute_similarities
+from dcbench.tasks.budgetclean.cpclean.algorithm.min_max import (
+    min_max_batch,
+    min_max_val,
+)
+from dcbench.tasks.budgetclean.cpclean.algorithm.sort_count import (
+    prune,
+    sort,
+    sort_count_after_clean,
+    sort_count_dp,
+    sort_valid,
+)
+from dcbench.tasks.budgetclean.cpclean.clean import CPClean
+from dcbench.tasks.budgetclean.cpclean.utils import SimilaritySpace
+from tests.dcbench.tasks.cpclean_reference import (
+    assert_close,
+    brute_force_counts,
+    legacy_compute_similarity,
+    legacy_make_space,
+    legacy_sort,
+    legacy_sort_count_after_clean,
+    legacy_sort_count_dp,
+    random_repairs,
+    random_space,
+)
+
+
+def timeit(fn, *args, repeat=3, **kwargs):
+    """Return the best wall-clock time of ``repeat`` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - tic)
+    return best
+
+
+def benchmark_sort(sizes=(1000, 10000, 100000), n_candidates=5, repeat=3):
+    results = []
+    for n_rows in sizes:
+        S, y = random_space(n_rows, n_candidates)
+        assert [tuple(a) for a in sort(S, y).tolist()] == legacy_sort(S, y)
+        results.append(
+            {
+                "benchmark": "sort",
+                "n_rows": n_rows,
+                "legacy": timeit(legacy_sort, S, y, repeat=repeat),
+                "current": timeit(sort, S, y, repeat=repeat),
+            }
+        )
+    return results
+
+
+def benchmark_sorted_order(sizes=(10000, 100000), n_candidates=5, n_iter=10, K=3):
+    """Sort the pruned candidates of a validation point after n_iter rows were
+    cleaned, from scratch (legacy) and from the order cached before cleaning."""
+    results = []
+    for n_rows in sizes:
+        rng = np.random.RandomState(0)
+        lengths = np.full(n_rows, n_candidates)
+        space = SimilaritySpace(rng.rand(1, lengths.sum()), lengths)
+        y = rng.randint(0, 2, n_rows)
+        order = partial(space.sorted_candidates, 0)
+        S, y_valid, valid_indices = prune(space[0], y, K, space.MM[0])
+        sort_valid(S, y_valid, valid_indices, order)
+
+        for row in space.dirty_rows[:n_iter]:
+            space.collapse(row, 0)
+        S, y_valid, valid_indices = prune(space[0], y, K, space.MM[0])
+        assert np.array_equal(
+            sort_valid(S, y_valid, valid_indices, order), sort(S, y_valid)
+        )
+        results.append(
+            {
+                "benchmark": "sorted_order",
+                "n_rows": n_rows,
+                "legacy": timeit(sort, S, y_valid),
+                "current": timeit(sort_valid, S, y_valid, valid_indices, order),
+            }
+        )
+    return results
+
+
+def benchmark_similarity(sizes=(1000, 10000), n_val=1000, n_features=20, repeat=3):
+    rng = np.random.RandomState(0)
+    results = []
+    for n_rows in sizes:
+        X_train, X_val = rng.randn(n_rows, n_features), rng.randn(n_val, n_features)
+        assert np.allclose(
+            compute_similarities(X_train, X_val),
+            legacy_compute_similarity(X_train, X_val),
+        )
+        for dtype in [np.float64, np.float32]:
+            results.append(
+                {
+                    "benchmark": "similarity_" + np.dtype(dtype).name,
+                    "n_rows": n_rows,
+                    "legacy": timeit(
+                        legacy_compute_similarity, X_train, X_val, repeat=repeat
+                    ),
+                    "current": timeit(
+                        compute_similarities, X_train, X_val, dtype=dtype, repeat=repeat
+                    ),
+                }
+            )
+    return results
+
+
+def benchmark_make_space(sizes=(1000, 10000), n_val=200, n_repairs=5, repeat=1):
+    cleaner = CPClean()
+    results = []
+    for n_rows in sizes:
+        X_train_repairs, X_val, gt = random_repairs(n_rows, n_val, n_repairs)
+        space, S_val, gt_indices, MM = cleaner.make_space(X_train_repairs, X_val, gt)
+        _, legacy_S_val, legacy_gt_indices, legacy_MM = legacy_make_space(
+            X_train_repairs, X_val, gt
+        )
+        assert gt_indices == legacy_gt_indices
+        for S, legacy_S in zip(S_val, legacy_S_val):
+            assert [len(Si) for Si in S] == [len(Si) for Si in legacy_S]
+            assert np.allclose(np.concatenate(S), np.concatenate(legacy_S))
+        assert np.allclose(MM, legacy_MM)
+        results.append(
+            {
+                "benchmark": "make_space",
+                "n_rows": n_rows,
+                "legacy": timeit(
+                    legacy_make_space, X_train_repairs, X_val, gt, repeat=repeat
+                ),
+                "current": timeit(
+                    cleaner.make_space, X_train_repairs, X_val, gt, repeat=repeat
+                ),
+            }
+        )
+    return results
+
+
+def legacy_clean_updates(S_val, MM, selection, gt_indices):
+    """The bookkeeping of CPClean.clean on lists: copy, then prune a validation
+    point and clean a row at every iteration."""
+    S_val_pruned = deepcopy(S_val)
+    MM_pruned = MM
+    for sel in selection:
+        S_val_pruned = S_val_pruned[1:]
+        MM_pruned = MM_pruned[1:]
+        for i in range(len(S_val_pruned)):
+            S_val_pruned[i][sel] = [S_val_pruned[i][sel][gt_indices[sel]]]
+            MM_pruned[i][sel] = [S_val_pruned[i][sel][0], S_val_pruned[i][sel][0]]
+    return S_val_pruned, MM_pruned
+
+
+def clean_updates(space, selection, gt_indices):
+    space = space.copy()
+    for sel in selection:
+        space = space.take(np.arange(1, len(space)))
+        space.collapse(sel, gt_indices[sel])
+    return space
+
+
+def benchmark_clean_updates(sizes=(1000, 10000), n_val=200, n_iter=20, repeat=1):
+    cleaner = CPClean()
+    results = []
+    for n_rows in sizes:
+        X_train_repairs, X_val, gt = random_repairs(n_rows, n_val, p_dirty=0.5)
+        _, space, gt_indices, _ = cleaner.make_space(X_train_repairs, X_val, gt)
+        selection = space.dirty_rows[:n_iter]
+        S_val, MM = space.to_lists(), list(space.MM.copy())
+
+        legacy_S_val, legacy_MM = legacy_clean_updates(S_val, MM, selection, gt_indices)
+        current = clean_updates(space, selection, gt_indices)
+        for S, legacy_S in zip(current, legacy_S_val):
+            assert [len(Si) for Si in S] == [len(Si) for Si in legacy_S]
+            assert np.array_equal(np.concatenate(S), np.concatenate(legacy_S))
+        assert np.array_equal(current.MM, legacy_MM)
+        results.append(
+            {
+                "benchmark": "clean_updates",
+                "n_rows": n_rows,
+                "legacy": timeit(
+                    legacy_clean_updates,
+                    S_val,
+                    list(space.MM.copy()),
+                    selection,
+                    gt_indices,
+                    repeat=repeat,
+                ),
+                "current": timeit(
+                    clean_updates, space, selection, gt_indices, repeat=repeat
+                ),
+            }
+        )
+    return results
+
+
+def benchmark_min_max(sizes=(1000, 10000), n_val=1000, K=3, repeat=3):
+    results = []
+    for n_rows in sizes:
+        rng = np.random.RandomState(0)
+        MM = np.sort(rng.rand(n_val, n_rows, 2), axis=2)
+        y = rng.randint(0, 2, n_rows)
+        q1_results, _ = min_max_batch(MM, y, K)
+        assert np.array_equal(q1_results, min_max_val(MM, y, K)[0])
+        results.append(
+            {
+                "benchmark": "min_max",
+                "n_rows": n_rows,
+                "legacy": timeit(min_max_val, MM, y, K, repeat=repeat),
+                "current": timeit(min_max_batch, MM, y, K, repeat=repeat),
+            }
+        )
+    return results
+
+
+def benchmark_sort_count(
+    sizes=(100, 300, 1000), n_candidates=5, p_dirty=1.0, K=3, repeat=1
+):
+    results = []
+    for n_rows in sizes:
+        # dirty rows have a wide range of similarities, so few of them are pruned
+        S, y = random_space(n_rows, n_candidates, p_dirty=p_dirty)
+        for name, legacy, current in [
+            ("sort_count_dp", legacy_sort_count_dp, sort_count_dp),
+            (
+                "sort_count_after_clean",
+                legacy_sort_count_after_clean,
+                sort_count_after_clean,
+            ),
+        ]:
+            assert_close(current(S, y, K), legacy(S, y, K))
+            results.append(
+                {
+                    "benchmark": name,
+                    "n_rows": n_rows,
+                    "legacy": timeit(legacy, S, y, K, repeat=repeat),
+                    "current": timeit(current, S, y, K, repeat=repeat),
+                }
+            )
+    return results
+
+
+def separate_q2q3(S, y, K):
+    """Q2 counts and Q3 after entropies in two scans, as before they were
+    fused."""
+    return sort_count_dp(S, y, K), sort_count_after_clean(S, y, K)
+
+
+def benchmark_q2q3(sizes=(100, 300, 1000), n_candidates=5, p_dirty=1.0, K=3, repeat=1):
+    results = []
+    for n_rows in sizes:
+        S, y = random_space(n_rows, n_candidates, p_dirty=p_dirty)
+        fused = sort_count_after_clean(S, y, K, return_counts=True)
+        assert_close(fused, separate_q2q3(S, y, K))
+        results.append(
+            {
+                "benchmark": "q2q3",
+                "n_rows": n_rows,
+                "legacy": timeit(separate_q2q3, S, y, K, repeat=repeat),
+                "current": timeit(
+                    sort_count_after_clean, S, y, K, repeat=repeat, return_counts=True
+                ),
+            }
+        )
+    return results
+
+
+def benchmark_multi_class(
+    sizes=(8, 12, 16), n_candidates=3, p_dirty=0.5, n_classes=4, K=5, repeat=1
+):
+    """sort_count_dp against the enumeration of every possible world."""
+    results = []
+    for n_rows in sizes:
+        S, y = random_space(n_rows, n_candidates, p_dirty, n_classes, n_rows)
+        assert_close(sort_count_dp(S, y, K), brute_force_counts(S, y, K))
+        results.append(
+            {
+                "benchmark": "multi_class",
+                "n_rows": n_rows,
+                "legacy": timeit(brute_force_counts, S, y, K, repeat=repeat),
+                "current": timeit(sort_count_dp, S, y, K, repeat=repeat),
+            }
+        )
+    return results
+
+
+def main():
+    results = (
+        benchmark_sort()
+        + benchmark_sorted_order()
+        + benchmark_sort_count()
+        + benchmark_q2q3()
+        + benchmark_multi_class()
+        + benchmark_similarity()
+        + benchmark_make_space()
+        + benchmark_clean_updates()
+        + benchmark_min_max()
+    )
+    for result in results:
+        print(
+            "{benchmark:<24} n_rows={n_rows:<8} legacy={legacy:.4f}s "
+            "current={current:.4f}s speedup={speedup:.1f}x".format(
+                speedup=result["legacy"] / result["current"], **result
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
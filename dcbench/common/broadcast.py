@@ -0,0 +1,305 @@
+"""Zero-copy broadcast of in-memory data (e.g. loaded artifacts) to worker
+processes."""
+
+from __future__ import annotations
+
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+import warnings
+from dataclasses import dataclass
+from typing import Any, List, Tuple
+
+import meerkat as mk
+import numpy as np
+from meerkat.tools.lazy_loader import LazyLoader
+
+torch = LazyLoader("torch")
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+# segments that could not be closed yet because arrays backed by them are still
+# referenced, closing them is retried whenever a broadcast is closed
+_unclosed_segments = []
+
+
+@dataclass
+class _ArrayRef:
+    """Placeholder for an array that lives in a shared segment."""
+
+    segment: str
+    shape: Tuple[int, ...]
+    dtype: str
+    is_tensor: bool = False
+
+
+@dataclass
+class _DataPanelRef:
+    """Placeholder for a DataPanel whose array-like columns live in shared
+    segments."""
+
+    columns: List[Tuple[str, Any]]
+
+
+class Broadcast:
+    """Places the arrays in an object into memory that can be shared with worker
+    processes without copying.
+
+    The object may be a numpy array, a torch tensor, a :class:`meerkat.DataPanel`, or
+    any nesting of dicts, lists and tuples thereof. Every array (and every numpy or
+    tensor column of a DataPanel) with at least ``min_nbytes`` bytes is copied once
+    into a shared segment. Pickling a :class:`Broadcast` (e.g. when it is passed to a
+    process pool) only pickles the names of the segments, so workers attach to the
+    segments and read the data in place instead of each deserializing a private
+    copy.
+
+    .. code-block:: python
+
+        with Broadcast(embs) as shared:
+            pool.map(partial(fn, embs=shared), args)
+
+        def fn(arg, embs):
+            embs = embs.value  # same structure as the original object
+            ...
+
+    Args:
+        obj (Any): The object to broadcast.
+        backend (str, optional): Either ``"shm"``, which uses
+            :mod:`multiprocessing.shared_memory`, or ``"mmap"``, which writes the
+            arrays to files that workers memory-map. Defaults to ``"shm"`` when it
+            is available (python >= 3.8) and ``"mmap"`` otherwise.
+        min_nbytes (int, optional): Arrays smaller than this are pickled along with
+            the rest of the object instead of being shared. Defaults to 64 KiB.
+        dir (str, optional): Directory for the ``"mmap"`` backend. Defaults to None,
+            in which case a temporary directory is created.
+
+    .. warning::
+        The shared arrays must be treated as read-only, the ``"mmap"`` backend
+        maps them read-only. The segments are released when the owning
+        :class:`Broadcast` is closed, so it should outlive the workers that use
+        it. Segments that arrays still reference are unmapped once they are no
+        longer referenced, on a later call to :meth:`close`. The segments are
+        local to a host, so the workers must run on the same machine.
+    """
+
+    def __init__(
+        self,
+        obj: Any,
+        backend: str = None,
+        min_nbytes: int = 1 << 16,
+        dir: str = None,
+    ):
+        if backend is None:
+            backend = "mmap" if shared_memory is None else "shm"
+        if backend not in ("shm", "mmap"):
+            raise ValueError(f"Unknown broadcast backend '{backend}'.")
+        if backend == "shm" and shared_memory is None:
+            raise ValueError("The 'shm' backend requires python >= 3.8.")
+
+        self.backend = backend
+        self.min_nbytes = min_nbytes
+        self._owner = True
+        self._segments = {}
+        if backend == "mmap":
+            self._dir = tempfile.mkdtemp(prefix="dcbench-") if dir is None else dir
+            self._remove_dir = dir is None
+        else:
+            self._dir, self._remove_dir = None, False
+
+        self._skeleton = self._share(obj)
+        self._value = None
+
+    @property
+    def value(self) -> Any:
+        """The broadcast object, with its shared arrays backed by the shared
+        segments."""
+        if self._value is None:
+            self._value = self._resolve(self._skeleton)
+        return self._value
+
+    @property
+    def nbytes(self) -> int:
+        """The total number of bytes held in shared segments."""
+        return sum(
+            int(np.prod(ref.shape)) * np.dtype(ref.dtype).itemsize
+            for ref in self._iter_refs(self._skeleton)
+        )
+
+    def close(self):
+        """Detach from the shared segments and, in the owning process, release
+        them."""
+        self._value = None
+        for segment in self._segments.values():
+            if self.backend == "shm":
+                if self._owner:
+                    segment.unlink()
+                _unclosed_segments.append(segment)
+        self._segments = {}
+        _unclosed_segments[:] = [
+            segment for segment in _unclosed_segments if not _close_segment(segment)
+        ]
+        if self._owner and self._remove_dir and os.path.exists(self._dir):
+            shutil.rmtree(self._dir)
+
+    def __enter__(self) -> Broadcast:
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __getstate__(self):
+        return {
+            "backend": self.backend,
+            "min_nbytes": self.min_nbytes,
+            "_dir": self._dir,
+            "_skeleton": self._skeleton,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        self._remove_dir = False
+        self._segments = {}
+        self._value = None
+
+    def _share(self, obj: Any) -> Any:
+        if isinstance(obj, dict):
+            return {k: self._share(v) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self._share(v) for v in obj)
+        elif isinstance(obj, mk.DataPanel):
+            return _DataPanelRef(
+                columns=[(name, self._share_column(obj[name])) for name in obj.columns]
+            )
+        elif isinstance(obj, np.ndarray) or (
+            "torch" in sys.modules and isinstance(obj, torch.Tensor)
+        ):
+            return self._share_array(obj)
+        return obj
+
+    def _share_column(self, column: mk.AbstractColumn) -> Any:
+        if isinstance(column, (mk.NumpyArrayColumn, mk.TensorColumn)):
+            return self._share_array(column.data)
+        return column
+
+    def _share_array(self, array: Any) -> Any:
+        is_tensor = not isinstance(array, np.ndarray)
+        data = array.detach().cpu().numpy() if is_tensor else array
+        if data.nbytes < self.min_nbytes or data.dtype.hasobject:
+            return array
+
+        ref = _ArrayRef(
+            segment=f"dcbench-{uuid.uuid4().hex[:16]}",
+            shape=data.shape,
+            dtype=data.dtype.str,
+            is_tensor=is_tensor,
+        )
+        if self.backend == "shm":
+            segment = shared_memory.SharedMemory(
+                name=ref.segment, create=True, size=max(data.nbytes, 1)
+            )
+            self._segments[ref.segment] = segment
+            view = _segment_view(segment, data.shape, data.dtype)
+            view[...] = data
+            # the view holds an export of the segment, which prevents closing it
+            del view
+        else:
+            path = os.path.join(self._dir, ref.segment + ".npy")
+            view = np.lib.format.open_memmap(
+                path, mode="w+", dtype=data.dtype, shape=data.shape
+            )
+            view[...] = data
+            view.flush()
+        return ref
+
+    def _resolve(self, skeleton: Any) -> Any:
+        if isinstance(skeleton, dict):
+            return {k: self._resolve(v) for k, v in skeleton.items()}
+        elif isinstance(skeleton, (list, tuple)):
+            return type(skeleton)(self._resolve(v) for v in skeleton)
+        elif isinstance(skeleton, _DataPanelRef):
+            return mk.DataPanel(
+                {name: self._resolve(column) for name, column in skeleton.columns}
+            )
+        elif isinstance(skeleton, _ArrayRef):
+            return self._attach(skeleton)
+        return skeleton
+
+    def _attach(self, ref: _ArrayRef) -> Any:
+        if self.backend == "shm":
+            if ref.segment not in self._segments:
+                self._segments[ref.segment] = _attach_shared_memory(ref.segment)
+            array = _segment_view(self._segments[ref.segment], ref.shape, ref.dtype)
+        else:
+            array = np.load(
+                os.path.join(self._dir, ref.segment + ".npy"), mmap_mode="r"
+            )
+        if not ref.is_tensor:
+            return array
+        with warnings.catch_warnings():
+            # torch warns about read-only arrays, which broadcast arrays are
+            warnings.filterwarnings("ignore", message="The given NumPy array")
+            return torch.from_numpy(array)
+
+    def _iter_refs(self, skeleton: Any):
+        if isinstance(skeleton, dict):
+            skeleton = skeleton.values()
+        elif isinstance(skeleton, _DataPanelRef):
+            skeleton = [column for _, column in skeleton.columns]
+        elif isinstance(skeleton, _ArrayRef):
+            yield skeleton
+            return
+        elif not isinstance(skeleton, (list, tuple)):
+            return
+        for child in skeleton:
+            yield from self._iter_refs(child)
+
+
+def _attach_shared_memory(name: str) -> "shared_memory.SharedMemory":
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # only the owner should release the segment, but python < 3.13 registers every
+    # attached segment with the resource tracker, which unlinks it on exit.
+    # Unregistering it afterwards would also drop the registration of the owner
+    # when it shares the tracker, so the registration is skipped instead. The
+    # tracker knows segments by their POSIX name, with a leading "/"
+    register = resource_tracker.register
+
+    def register_others(tracked_name, rtype):
+        if rtype != "shared_memory" or tracked_name.lstrip("/") != name:
+            register(tracked_name, rtype)
+
+    resource_tracker.register = register_others
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _segment_view(
+    segment: "shared_memory.SharedMemory", shape: Tuple[int, ...], dtype: str
+) -> np.ndarray:
+    # the view holds an export of `segment.buf`, so the segment cannot be unmapped
+    # while views on it are alive (closing it raises a BufferError instead)
+    count = int(np.prod(shape))
+    return np.frombuffer(segment.buf, dtype=dtype, count=count).reshape(shape)
+
+
+def _close_segment(segment: "shared_memory.SharedMemory") -> bool:
+    """Unmap the segment, unless arrays backed by it are still referenced."""
+    try:
+        segment.close()
+    except BufferError:
+        return False
+    return True
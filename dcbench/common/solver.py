@@ -1,7 +1,33 @@
 def solver(id: str, summary: str):
+    """Decorator that registers a function as a solver.
+
+    A solver maps a single :class:`Problem` to a :class:`Solution`. A solver may
+    optionally be given a batched counterpart with the ``batch`` decorator attached to
+    it, which maps a sequence of problems to a sequence of solutions (one per
+    problem, in the same order). :meth:`Trial.evaluate` uses it when problems are
+    grouped with ``batch_by``, so that work shared across problems is only done once.
+
+    .. code-block:: python
+
+        @solver(id="my_solver", summary="...")
+        def my_solver(problem):
+            ...
+
+        @my_solver.batch
+        def my_solver_batch(problems):
+            ...
+    """
+
     def _solver(fn: callable):
         fn.id = id
         fn.attributes = {"summary": summary}
+        fn.solve_batch = None
+
+        def batch(batch_fn: callable):
+            fn.solve_batch = batch_fn
+            return batch_fn
+
+        fn.batch = batch
         return fn
 
     return _solver
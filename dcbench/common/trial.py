@@ -1,8 +1,27 @@
-from typing import TYPE_CHECKING, Callable, Dict, Optional, Sequence
+import multiprocessing as mp
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from tqdm import tqdm
 
-from .table import RowUnion, Table
+from .table import RowMixin, RowUnion, Table
 
 if TYPE_CHECKING:
     from .problem import Problem
@@ -17,6 +36,177 @@ else:
         pass
 
 
+# the output of a trial cell: one (solution, result, run info) triple per problem
+CellOutput = List[Tuple[Optional[Solution], "Result", Optional[Dict[str, Any]]]]
+
+
+def _solve_single(
+    solver: Callable[[Problem], Solution], problems: Sequence[Problem]
+) -> List[Solution]:
+    return [solver(problem) for problem in problems]
+
+
+def _solve_batch(
+    solver: Callable[[Problem], Solution], problems: Sequence[Problem]
+) -> List[Solution]:
+    solutions = list(solver.solve_batch(problems))
+    if len(solutions) != len(problems):
+        raise ValueError(
+            f"The batched solver for '{solver.id}' returned {len(solutions)} "
+            f"solutions for a batch of {len(problems)} problems."
+        )
+    return solutions
+
+
+def _solve_and_evaluate(
+    solve_fn: Callable[[Sequence[Problem]], List[Solution]],
+    problems: Sequence[Problem],
+) -> CellOutput:
+    solutions = solve_fn(problems)
+    return [
+        (solution, problem.evaluate(solution), None)
+        for problem, solution in zip(problems, solutions)
+    ]
+
+
+def _supervised_target(
+    conn,
+    solve_fn: Callable[[Sequence[Problem]], List[Solution]],
+    problems: Sequence[Problem],
+    max_memory: int,
+):
+    if max_memory is not None:
+        import resource
+
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+    try:
+        tic = time.time()
+        solutions = solve_fn(problems)
+        conn.send(("solved", time.time() - tic))
+
+        tic = time.time()
+        results = [
+            problem.evaluate(solution) for problem, solution in zip(problems, solutions)
+        ]
+        conn.send(("done", (solutions, results, time.time() - tic)))
+    except MemoryError:
+        conn.send(("memory", traceback.format_exc()))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class _ChildProcesses:
+    """The supervised child processes of a trial that are still running, so that
+    they can be killed when the trial is stopped early."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.stopped = False
+
+    def start(self, process) -> bool:
+        """Start the process, unless the trial was stopped."""
+        with self._lock:
+            if self.stopped:
+                return False
+            process.start()
+            self._processes.add(process)
+            return True
+
+    def discard(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def kill(self):
+        """Kill the running processes and prevent new ones from starting."""
+        with self._lock:
+            self.stopped = True
+            for process in self._processes:
+                if process.is_alive():
+                    process.kill()
+
+
+def _solve_and_evaluate_supervised(
+    solve_fn: Callable[[Sequence[Problem]], List[Solution]],
+    problems: Sequence[Problem],
+    timeout: Optional[float] = None,
+    max_memory: Optional[int] = None,
+    children: Optional[_ChildProcesses] = None,
+) -> CellOutput:
+    """Run the solver and the evaluation of a cell of problems in a child process,
+    killing it if it exceeds ``timeout`` seconds.
+
+    Failures never raise. Instead, placeholder :class:`Result` objects are returned
+    and the run info describes what went wrong along with the timings collected so
+    far. If ``children`` is given, the child process is registered there while it
+    runs, and is not started at all if the trial was stopped (status
+    ``"cancelled"``).
+    """
+    from .result import Result
+
+    ctx = mp.get_context()
+    recv_conn, send_conn = ctx.Pipe(duplex=False)
+    process = ctx.Process(
+        target=_supervised_target, args=(send_conn, solve_fn, problems, max_memory)
+    )
+    start = time.time()
+    if children is None:
+        process.start()
+        started = True
+    else:
+        started = children.start(process)
+    send_conn.close()
+
+    solutions, results = [None] * len(problems), None
+    info = {
+        "status": "timeout" if started else "cancelled",
+        "solve_time": None,
+        "evaluate_time": None,
+        "error": None,
+    }
+    while started:
+        remaining = None if timeout is None else timeout - (time.time() - start)
+        if remaining is not None and remaining <= 0:
+            break
+        if not recv_conn.poll(remaining):
+            break
+
+        try:
+            kind, payload = recv_conn.recv()
+        except EOFError:
+            # the child died without reporting back, e.g. it was killed by the OS
+            info["status"] = "killed"
+            break
+
+        if kind == "solved":
+            info["solve_time"] = payload
+        elif kind == "done":
+            solutions, results, info["evaluate_time"] = payload
+            info["status"] = "ok"
+            break
+        else:
+            info["status"], info["error"] = kind, payload
+            break
+
+    if started:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        if children is not None:
+            children.discard(process)
+    recv_conn.close()
+    info["elapsed_time"] = time.time() - start
+
+    if results is None:
+        results = [Result(id=uuid.uuid4().hex, attributes={}) for _ in problems]
+    return [
+        (solution, result, dict(info)) for solution, result in zip(solutions, results)
+    ]
+
+
 class Trial(Table):
     def __init__(
         self,
@@ -30,26 +220,222 @@ class Trial(Table):
         self.results: Dict[str, Result] = {}
         super().__init__([])
 
-    def evaluate(self, repeat: int = 1, quiet: bool = False) -> "Trial":
+    def evaluate(
+        self,
+        repeat: int = 1,
+        quiet: bool = False,
+        n_jobs: int = 1,
+        timeout: Optional[float] = None,
+        max_memory: Optional[int] = None,
+        batch_by: Union[str, Sequence[str], Callable[[Problem], Hashable]] = None,
+    ) -> "Trial":
+        for _ in self.iter_evaluate(
+            repeat=repeat,
+            quiet=quiet,
+            n_jobs=n_jobs,
+            timeout=timeout,
+            max_memory=max_memory,
+            batch_by=batch_by,
+        ):
+            pass
+        return self
+
+    def iter_evaluate(
+        self,
+        repeat: int = 1,
+        quiet: bool = False,
+        n_jobs: int = 1,
+        timeout: Optional[float] = None,
+        max_memory: Optional[int] = None,
+        batch_by: Union[str, Sequence[str], Callable[[Problem], Hashable]] = None,
+    ) -> Iterator[RowUnion]:
+        """Solve and evaluate every problem, yielding each row of the trial as soon
+        as it is ready.
+
+        Rows are added to the trial before they are yielded, so the trial can be
+        inspected (e.g. with :meth:`average`) while the run is still going. Stopping
+        the iteration early (e.g. with ``break``) stops the trial: with
+        ``n_jobs > 1``, the problems that have not started are not run, and the
+        supervised ones that are running are killed.
+
+        Args:
+            repeat (int, optional): Number of times each problem is solved.
+                Defaults to 1.
+            quiet (bool, optional): Disable progress bars. Defaults to False.
+            n_jobs (int, optional): Number of worker processes. When greater than 1,
+                the solver and the problems must be picklable and rows are yielded
+                in order of completion rather than in order of submission.
+                Defaults to 1.
+            timeout (float, optional): Wall-clock limit in seconds for solving and
+                evaluating a single problem (or a single batch, see ``batch_by``).
+                Defaults to None, in which case there is no limit.
+            max_memory (int, optional): Limit in bytes on the address space of the
+                process solving a single problem (or batch). Only supported on Unix.
+                Defaults to None, in which case there is no limit.
+            batch_by (Union[str, Sequence[str], Callable], optional): Key used to
+                group problems into batches that are passed together to the batched
+                version of the solver (see :func:`dcbench.common.solver.solver`).
+                Either the name of an attribute, a sequence of attribute names, or
+                a function mapping a problem to a hashable key. Defaults to None, in
+                which case each problem is solved on its own.
+
+        .. note::
+            When ``timeout`` or ``max_memory`` is set, every problem is solved in a
+            supervised child process. Problems that time out, run out of memory or
+            raise are recorded as failed rows rather than aborting the trial. These
+            rows carry a ``status`` attribute (``"timeout"``, ``"memory"``,
+            ``"killed"`` or ``"error"``) along with the timings collected before the
+            failure (``solve_time``, ``evaluate_time`` and ``elapsed_time``). For
+            batches, the timings cover the whole batch.
+        """
         assert repeat >= 1
+        assert n_jobs >= 1
         assert self.solver is not None
 
-        problems = self.problems if quiet else tqdm(self.problems, desc="Problems")
-        for problem in problems:
+        if batch_by is None:
+            solve_fn = partial(_solve_single, self.solver)
+            cells = [(problem,) for problem in self.problems]
+        else:
+            if getattr(self.solver, "solve_batch", None) is None:
+                raise ValueError(
+                    "Passed `batch_by` to `Trial.evaluate`, but the solver does not "
+                    "have a batched version."
+                )
+            solve_fn = partial(_solve_batch, self.solver)
+            cells = self._group_problems(batch_by)
+
+        children = None
+        if timeout is None and max_memory is None:
+            run_fn = _solve_and_evaluate
+        else:
+            if n_jobs > 1:
+                children = _ChildProcesses()
+            run_fn = partial(
+                _solve_and_evaluate_supervised,
+                timeout=timeout,
+                max_memory=max_memory,
+                children=children,
+            )
+
+        if n_jobs == 1:
+            yield from self._iter_evaluate_serial(
+                run_fn=partial(run_fn, solve_fn),
+                cells=cells,
+                repeat=repeat,
+                quiet=quiet,
+            )
+        else:
+            # supervised runs already happen in a child process, so threads are
+            # enough to supervise several of them at once
+            executor_class = (
+                ProcessPoolExecutor
+                if run_fn is _solve_and_evaluate
+                else ThreadPoolExecutor
+            )
+            yield from self._iter_evaluate_parallel(
+                run_fn=partial(run_fn, solve_fn),
+                executor=executor_class(max_workers=n_jobs),
+                cells=cells,
+                repeat=repeat,
+                quiet=quiet,
+                children=children,
+            )
+
+    def _group_problems(
+        self, batch_by: Union[str, Sequence[str], Callable[[Problem], Hashable]]
+    ) -> List[Tuple[Problem, ...]]:
+        if isinstance(batch_by, str):
+            batch_by = [batch_by]
+        if not callable(batch_by):
+            names = list(batch_by)
+
+            def batch_by(problem: Problem) -> Hashable:
+                return tuple(problem.attributes.get(name, None) for name in names)
+
+        groups: Dict[Hashable, List[Problem]] = {}
+        for problem in self.problems:
+            groups.setdefault(batch_by(problem), []).append(problem)
+        return [tuple(group) for group in groups.values()]
+
+    def _iter_evaluate_serial(
+        self,
+        run_fn: Callable[[Sequence[Problem]], CellOutput],
+        cells: List[Tuple[Problem, ...]],
+        repeat: int,
+        quiet: bool,
+    ) -> Iterator[RowUnion]:
+        desc = "Problems" if all(len(cell) == 1 for cell in cells) else "Batches"
+        cells = cells if quiet else tqdm(cells, desc=desc)
+        for cell in cells:
             repetitions = (
                 range(repeat)
                 if quiet or repeat == 1
                 else tqdm(range(repeat), desc="Repetitions")
             )
             for _ in repetitions:
-                solution = self.solver(problem)
-                result = problem.evaluate(solution)
-                self.solutions[solution.id] = solution
-                self.results[solution.id] = result
-                self._add_row(
-                    RowUnion(id=solution.id, elements=[problem, solution, result])
-                )
-        return self
+                for problem, output in zip(cell, run_fn(cell)):
+                    yield self._add_result(problem, *output)
+
+    def _iter_evaluate_parallel(
+        self,
+        run_fn: Callable[[Sequence[Problem]], CellOutput],
+        executor,
+        cells: List[Tuple[Problem, ...]],
+        repeat: int,
+        quiet: bool,
+        children: Optional[_ChildProcesses] = None,
+    ) -> Iterator[RowUnion]:
+        with executor:
+            futures = {
+                executor.submit(run_fn, cell): cell
+                for cell in cells
+                for _ in range(repeat)
+            }
+            try:
+                completed = as_completed(futures)
+                if not quiet:
+                    completed = tqdm(
+                        completed,
+                        total=len(futures),
+                        desc=(
+                            "Problems"
+                            if len(cells) == len(self.problems)
+                            else "Batches"
+                        ),
+                    )
+                for future in completed:
+                    for problem, output in zip(futures[future], future.result()):
+                        yield self._add_result(problem, *output)
+            finally:
+                # when the iteration is stopped early (e.g. ``break``), the problems
+                # that have not started are dropped and the supervised ones that are
+                # running are killed, so that closing the executor does not wait
+                # for them
+                for future in futures:
+                    if not future.done():
+                        future.cancel()
+                if children is not None:
+                    children.kill()
+
+    def _add_result(
+        self,
+        problem: Problem,
+        solution: Optional[Solution],
+        result: "Result",
+        info: Optional[Dict[str, Any]] = None,
+    ) -> RowUnion:
+        elements = [problem] if solution is None else [problem, solution]
+        elements.append(result)
+        if info is not None:
+            elements.append(RowMixin(id=result.id, attributes=info))
+
+        row_id = result.id if solution is None else solution.id
+        if solution is not None:
+            self.solutions[row_id] = solution
+        self.results[row_id] = result
+        row = RowUnion(id=row_id, elements=elements)
+        self._add_row(row)
+        return row
 
     def save(self) -> None:
         raise NotImplementedError()
@@ -0,0 +1,61 @@
+"""Distance kernel shared by the KNN classifiers and the space builder."""
+import numpy as np
+
+# upper bound on the size of the temporaries of a chunk of test points
+CHUNK_BYTES = 1 << 26
+
+
+def compute_distances(X_train, X_test, chunk_size=None, dtype=np.float64, out=None):
+    """Compute the euclidean distances between test and training points.
+
+    Uses ||a||^2 + ||b||^2 - 2ab, so that the bulk of the work is a single matrix
+    product for each chunk of test points.
+
+    Args:
+        X_train (np.array): training points, n_train x d
+        X_test (np.array): test points, n_test x d
+        chunk_size (int): number of test points processed at once. Defaults to
+            None, in which case chunks are sized to about CHUNK_BYTES.
+        dtype: np.float64, or np.float32 to halve the memory at the cost of
+            precision
+        out (np.array): n_test x n_train array (e.g. a memory map) to write the
+            distances to. Defaults to None, in which case one is allocated.
+
+    Return:
+        dists (np.array): n_test x n_train distances
+    """
+    X_train = np.asarray(X_train, dtype=dtype)
+    X_test = np.asarray(X_test, dtype=dtype)
+    if chunk_size is None:
+        row_bytes = max(X_train.shape[0] * X_train.dtype.itemsize, 1)
+        chunk_size = max(CHUNK_BYTES // row_bytes, 1)
+
+    train_norms = np.einsum("ij,ij->i", X_train, X_train)
+    if out is None:
+        out = np.empty((X_test.shape[0], X_train.shape[0]), dtype=dtype)
+    for start in range(0, X_test.shape[0], chunk_size):
+        chunk = X_test[start : start + chunk_size]
+        block = out[start : start + chunk_size]
+        np.dot(chunk, X_train.T, out=block)
+        block *= -2
+        block += train_norms
+        block += np.einsum("ij,ij->i", chunk, chunk)[:, None]
+        # rounding can make the squared distance of close points negative
+        np.maximum(block, 0, out=block)
+        np.sqrt(block, out=block)
+    return out
+
+
+def compute_similarities(X_train, X_test, chunk_size=None, dtype=np.float64, out=None):
+    """Compute the similarities 1 / (1 + distance) between test and training
+    points, see :func:`compute_distances`.
+
+    Return:
+        sims (np.array): n_test x n_train similarities
+    """
+    sims = compute_distances(
+        X_train, X_test, chunk_size=chunk_size, dtype=dtype, out=out
+    )
+    sims += 1
+    np.reciprocal(sims, out=sims)
+    return sims
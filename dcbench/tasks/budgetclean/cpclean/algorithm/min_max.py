@@ -1,6 +1,38 @@
 import numpy as np
 
-from .utils import majority_vote
+from ..utils import SimilaritySpace
+from .distance import CHUNK_BYTES
+from .sort_count import get_classes
+
+
+def vote(votes):
+    """Label with the most votes, ties go to the largest label as in
+    sort_count_dp."""
+    return len(votes) - 1 - int(np.argmax(votes[::-1]))
+
+
+def possible_labels(bounds):
+    """Labels that a world may predict given the fewest and most votes of each
+    label.
+
+    A label q wins against p in every world if it gets at least as many votes as
+    p can get, and more unless q is the larger label. The other labels are
+    possible. For two labels, the bounds are reached in the same world and the
+    possible labels are exactly the predictions of the worlds. For more, the
+    fewest votes of q and the most votes of p can be reached in different worlds,
+    so a label may be possible although no world predicts it.
+
+    Args:
+        bounds (np.array): ... x C x 2, the fewest and most votes of each label
+
+    Return:
+        possible (np.array): ... x C, whether a world may predict each label
+    """
+    lo, hi = bounds[..., :, None, 0], bounds[..., None, :, 1]
+    labels = np.arange(bounds.shape[-2])
+    # wins[..., q, p]: q wins against p in every world, never for q == p
+    wins = (lo > hi) | ((lo == hi) & (labels[:, None] > labels[None, :]))
+    return ~wins.any(axis=-2)
 
 
 def min_max(mm, y, K):
@@ -10,36 +42,43 @@ def min_max(mm, y, K):
     best scenario for each label.  mm (np.array): shape Nx2. the min and
     max similarity of each row.  y (list): labels  K (int): KNN
     hyperparameter
+
+    A label gets the most votes in its best scenario, in which its rows are at
+    their max similarity and the others at their min, and the fewest in the
+    reverse scenario. The point is CP'ed if a single label is possible given these
+    bounds, see :func:`possible_labels`.
     """
-    assert len(set(y)) == 2
-    pred_set = set()
+    classes = get_classes(y)
+    bounds = np.zeros((len(classes), 2), dtype=int)
     best_scenarios = {}
 
-    for c in [0, 1]:
-        best_scenario = np.zeros(len(y))
+    for c in classes:
         mask = y == c
+        for most in [1, 0]:
+            # set min max
+            scenario = np.where(mask, mm[:, most], mm[:, 1 - most])
 
-        # set min max
-        best_scenario[mask] = mm[:, 1][mask]
-        best_scenario[(mask == False)] = mm[:, 0][(mask == False)]  # noqa: E712
-
-        # run KNN
-        order = np.argsort(-best_scenario, kind="stable")
-        top_K = y[order][:K]
+            # run KNN
+            order = np.argsort(-scenario, kind="stable")
+            votes = np.bincount(y[order][:K], minlength=len(classes))
+            bounds[c, most] = votes[c]
 
-        pred = majority_vote(top_K)
-
-        if pred == c:
-            pred_set.add(c)
-
-        best_scenarios[c] = (best_scenario, pred)
+            if most:
+                best_scenarios[c] = (scenario, vote(votes))
 
+    pred_set = np.flatnonzero(possible_labels(bounds)).tolist()
     is_cc = len(pred_set) == 1
 
-    return is_cc, best_scenarios, list(pred_set)
+    return is_cc, best_scenarios, pred_set
 
 
 def min_max_val(MM, y, K):
+    """Run min_max for every validation point.
+
+    MM is the #val x #train x 2 min and max similarities, or a SimilaritySpace.
+    """
+    if isinstance(MM, SimilaritySpace):
+        MM = MM.MM
     q1_results = []
     scenarios = []
     cc_preds = []
@@ -51,3 +90,202 @@ def min_max_val(MM, y, K):
 
     q1_results = np.array(q1_results)
     return q1_results, scenarios, cc_preds
+
+
+def count_top_k(scenarios, y, K, n_classes=2):
+    """Count the rows of each label among the K most similar rows of each scenario.
+
+    Ties are broken towards the smaller index, as a stable argsort would. Only the
+    K-th largest similarity is searched for (np.partition), rows above it are in
+    the top K and rows equal to it fill the remaining places in index order.
+
+    Args:
+        scenarios (np.array): #val x #train similarities
+        y (np.array): labels, 0, ..., n_classes - 1
+        K (int): KNN hyperparameter, at most #train
+        n_classes (int): number of labels
+
+    Return:
+        counts (np.array): #val x n_classes, number of rows of each label in the
+            top K of each scenario
+        kth (np.array): K-th largest similarity of each scenario
+    """
+    N = scenarios.shape[1]
+    kth = np.partition(scenarios, N - K, axis=1)[:, N - K, None]
+    above = scenarios > kth
+    ties = scenarios == kth
+    top = above | ties
+
+    # scenarios with more ties than places left keep the ties of smaller index
+    n_places = K - above.sum(axis=1)
+    crowded = np.flatnonzero(ties.sum(axis=1) > n_places)
+    if len(crowded) > 0:
+        ties = ties[crowded]
+        dropped = ties & (np.cumsum(ties, axis=1) > n_places[crowded, None])
+        top[crowded] &= ~dropped
+
+    # the rows of label 0 take the places left by the others
+    counts = np.zeros((len(scenarios), n_classes), dtype=int)
+    for p in range(1, n_classes):
+        counts[:, p] = np.count_nonzero(top & (y == p), axis=1)
+    counts[:, 0] = K - counts[:, 1:].sum(axis=1)
+    return counts, kth[:, 0]
+
+
+def _vote_bounds(MM, y, K, n_classes):
+    """Fewest and most votes of each label over the worlds, see
+    :func:`min_max`.
+
+    Return:
+        bounds (np.array): #val x C x 2, the fewest and most votes of each label
+        kth (np.array): #val x C x 2, K-th largest similarity of the scenarios in
+            which they are reached
+    """
+    n_val, n_train = MM.shape[:2]
+    K = min(K, n_train)
+    bounds = np.zeros((n_val, n_classes, 2), dtype=int)
+    kth = np.zeros((n_val, n_classes, 2), dtype=MM.dtype)
+
+    chunk_size = max(CHUNK_BYTES // max(n_train * MM.itemsize, 1), 1)
+    for start in range(0, n_val, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        for c in range(n_classes):
+            for most in [1, 0]:
+                if n_classes == 2 and not most:
+                    # reached in the best scenario for the other label
+                    continue
+                # rows of label c at their max similarity and the others at
+                # their min, the reverse for the fewest votes
+                scenarios = np.where(y == c, MM[chunk, :, most], MM[chunk, :, 1 - most])
+                counts, kth[chunk, c, most] = count_top_k(scenarios, y, K, n_classes)
+                bounds[chunk, c, most] = counts[:, c]
+                if n_classes == 2:
+                    bounds[chunk, 1 - c, 0] = counts[:, 1 - c]
+                    kth[chunk, 1 - c, 0] = kth[chunk, c, 1]
+    return bounds, kth
+
+
+def min_max_batch(MM, y, K):
+    """MinMax algorithm for all validation points at once, see :func:`min_max`.
+
+    Args:
+        MM (np.array): #val x #train x 2 min and max similarity of each row, or a
+            SimilaritySpace
+        y (np.array): labels
+        K (int): KNN hyperparameter
+
+    Return:
+        q1_results (np.array): whether each validation point is CP'ed
+        pred_sets (np.array): #val x C, whether a world may predict each label,
+            see :func:`possible_labels`
+    """
+    if isinstance(MM, SimilaritySpace):
+        MM = MM.MM
+    y = np.asarray(y)
+    bounds, _ = _vote_bounds(np.asarray(MM), y, K, len(get_classes(y)))
+    pred_sets = possible_labels(bounds)
+    q1_results = pred_sets.sum(axis=1) == 1
+    return q1_results, pred_sets
+
+
+class IncrementalMinMax(object):
+    """MinMax of validation points, kept up to date as training rows are cleaned.
+
+    Cleaning a row moves its min up and its max down to the similarity of the
+    ground truth. In the scenarios giving the fewest and most votes of a label,
+    the top K can then only change if the old or the new similarity of the row
+    reaches the K-th largest similarity of the scenario. Only those validation
+    points are evaluated again.
+
+    .. code-block:: python
+
+        q1 = IncrementalMinMax(space.MM, y_train, K)
+        q1.collapse(sel, space.similarities(sel, gt_indices[sel]))
+        q1 = q1.take(np.flatnonzero(~q1.q1_results))
+
+    Args:
+        MM (np.array): #val x #train x 2 min and max similarity of each row, which
+            :meth:`collapse` writes to. It is shared with the results of
+            :meth:`take`.
+        y (np.array): labels
+        K (int): KNN hyperparameter
+        points (np.array): position in MM of each validation point. Defaults to
+            None, in which case they are all the rows of MM.
+    """
+
+    def __init__(self, MM, y, K, points=None, bounds=None, kth=None):
+        self.MM = MM
+        self.points = points
+        self.y = np.asarray(y)
+        self.K = K
+        self.n_classes = len(get_classes(self.y))
+        if bounds is None:
+            bounds, kth = _vote_bounds(MM[self._at()], self.y, K, self.n_classes)
+        self.bounds = bounds
+        self.kth = kth
+        self.n_evaluated = 0
+
+    def _at(self, i=slice(None)):
+        return i if self.points is None else self.points[i]
+
+    def __len__(self):
+        return len(self.bounds)
+
+    @property
+    def pred_sets(self):
+        """Whether a world may predict each label, see :func:`possible_labels`."""
+        return possible_labels(self.bounds)
+
+    @property
+    def q1_results(self):
+        """Whether each validation point is CP'ed."""
+        return self.pred_sets.sum(axis=1) == 1
+
+    def collapse(self, row, similarities):
+        """Set the min and max similarity of training row `row` to the similarity
+        of the candidate it is cleaned to, and update the bounds of the votes.
+
+        Args:
+            row (int): training row
+            similarities (np.array): similarity of the candidate to each
+                validation point, see SimilaritySpace.similarities
+
+        Return:
+            q1_results (np.array): whether each validation point is CP'ed
+        """
+        old = self.MM[self._at(), row].copy()
+        new = np.asarray(similarities, dtype=self.MM.dtype)
+        self.MM[self._at(), row] = new[:, None]
+
+        affected = np.zeros(len(self), dtype=bool)
+        for c in range(self.n_classes):
+            for most in [0, 1]:
+                old_c = old[:, most] if self.y[row] == c else old[:, 1 - most]
+                kth = self.kth[:, c, most]
+                affected |= (old_c >= kth) | (new >= kth)
+        affected = np.flatnonzero(affected)
+
+        if len(affected) > 0:
+            bounds, kth = _vote_bounds(
+                self.MM[self._at(affected)], self.y, self.K, self.n_classes
+            )
+            self.bounds[affected] = bounds
+            self.kth[affected] = kth
+        self.n_evaluated += len(affected)
+        return self.q1_results
+
+    def take(self, indices):
+        """The MinMax of the validation points at the given positions, which
+        shares MM with this one."""
+        indices = np.asarray(indices, dtype=np.int64)
+        points = np.arange(len(self)) if self.points is None else self.points
+        q1 = IncrementalMinMax(
+            self.MM,
+            self.y,
+            self.K,
+            points=points[indices],
+            bounds=self.bounds[indices],
+            kth=self.kth[indices],
+        )
+        q1.n_evaluated = self.n_evaluated
+        return q1
@@ -0,0 +1,239 @@
+"""Monte Carlo estimates of the counts of sort_count_dp and sort_count_after_clean.
+
+Exact counting costs O(N M K) per validation point and gives up on the elements
+whose worlds are too unlikely to be represented. Drawing worlds at random (every
+candidate of a row equally likely, as in the exact counts) and taking the KNN
+prediction in each estimates the fraction of worlds that support each label
+instead, at a cost that does not depend on how many worlds there are.
+
+Samples are drawn in rounds of doubling size until the confidence interval of
+every estimate is within the tolerance, so that validation points whose
+prediction is (nearly) certain stop after the first round.
+"""
+import numpy as np
+
+from .distance import CHUNK_BYTES
+from .sort_count import get_classes, prune, sort_valid
+
+
+def binary_entropy(p):
+    """Entropy (in nats, as scipy.stats.entropy) of the label distribution
+    {0: 1 - p, 1: p}, elementwise."""
+    p = np.asarray(p, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = -(p * np.log(p) + (1 - p) * np.log(1 - p))
+    return np.where((p <= 0) | (p >= 1), 0.0, h)
+
+
+def bernstein_radius(p, n, delta):
+    """Half-width of the empirical Bernstein confidence interval of the mean of n
+    Bernoulli samples with empirical mean p, which holds with probability at
+    least 1 - delta (Audibert et al., 2009)."""
+    log_term = np.log(3 / delta)
+    return np.sqrt(2 * p * (1 - p) * log_term / n) + 3 * log_term / n
+
+
+class MonteCarloCounter(object):
+    """Approximate counting of the worlds supporting each label by sampling.
+
+    Drop-in replacement of sort_count_dp and sort_count_after_clean for the
+    binary label case, e.g. Querier(..., counter=MonteCarloCounter()), which
+    raises a ValueError for other labels (see :meth:`check_labels`). Every
+    estimated probability is within tol of the exact one with probability at
+    least confidence (jointly for all the estimates of a validation point).
+
+    Args:
+        tol (float): error tolerance of the estimated probabilities
+        confidence (float): probability that all estimates are within tol
+        min_samples (int): number of worlds drawn in the first round
+        max_samples (int): stop after drawing this many worlds even if the
+            tolerance is not reached. Defaults to None.
+        random_state (int): seed, every validation point is sampled with the
+            same stream so that results do not depend on the workers
+    """
+
+    def __init__(
+        self,
+        tol=0.01,
+        confidence=0.95,
+        min_samples=64,
+        max_samples=None,
+        random_state=0,
+    ):
+        self.tol = tol
+        self.confidence = confidence
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.random_state = random_state
+
+    @staticmethod
+    def check_labels(y):
+        """Check that the labels are 0 and 1, only the fraction of worlds
+        predicting 1 is estimated.
+
+        Raises:
+            ValueError: if there are other labels
+        """
+        if get_classes(y) != [0, 1]:
+            raise ValueError(
+                "MonteCarloCounter only supports the labels 0 and 1, got {}.".format(
+                    sorted(set(np.asarray(y).tolist()))
+                )
+            )
+
+    def sort_count(self, S_full, y_full, K, mm=None, order=None):
+        """Estimate of :func:`sort_count_dp`.
+
+        Return:
+            counts (dict): {label: fraction of worlds predicting it}
+        """
+        self.check_labels(y_full)
+        S, y, valid_indices = prune(S_full, y_full, K, mm)
+        p, _, _ = self._estimate(S, y, K, [], sort_valid(S, y, valid_indices, order))
+        return {0: 1 - p, 1: p}
+
+    def sort_count_after_clean(
+        self, S_full, y_full, K, mm=None, rows=None, return_counts=False, order=None
+    ):
+        """Estimate of :func:`sort_count_after_clean`.
+
+        Cleaning row r to candidate j only changes the value of r, so every drawn
+        world gives the prediction after cleaning each row to each candidate and
+        all conditional estimates share the same samples.
+
+        Return:
+            counts (dict): as :meth:`sort_count`, only if return_counts
+            after_entropies (list): for each row, the entropy for each candidate,
+                or None if it is clean, pruned or not in rows
+        """
+        self.check_labels(y_full)
+        S, y, valid_indices = prune(S_full, y_full, K, mm)
+        rows = None if rows is None else set(rows)
+        dirty_rows = [
+            ri
+            for ri, Si in enumerate(S)
+            if len(Si) > 1 and (rows is None or valid_indices[ri] in rows)
+        ]
+        sorted_A = sort_valid(S, y, valid_indices, order)
+        p, p_after, _ = self._estimate(S, y, K, dirty_rows, sorted_A)
+
+        after_entropies = [None] * len(y_full)
+        entropies = binary_entropy(p_after).tolist()
+        start = 0
+        for ri in dirty_rows:
+            after_entropies[valid_indices[ri]] = entropies[start : start + len(S[ri])]
+            start += len(S[ri])
+        if return_counts:
+            return {0: 1 - p, 1: p}, after_entropies
+        return after_entropies
+
+    def _estimate(self, S, y, K, dirty_rows, sorted_A):
+        """Sample worlds until the fraction of them predicting 1, before and after
+        cleaning each dirty row to each of its candidates, are within the
+        tolerance.
+
+        Return:
+            p (float), p_after (np.array): fractions, p_after lists the candidates
+                of the dirty rows in order
+            n (int): number of worlds drawn
+        """
+        rng = np.random.RandomState(self.random_state)
+        N = len(S)
+        K_top = min(K, N)
+        y = np.asarray(y, dtype=np.int64)
+        lengths = np.array([len(Si) for Si in S], dtype=np.int64)
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+        # a world is ordered by the position of its elements in the scan of
+        # sort_count_dp (sorted_A), which are distinct across rows and break ties
+        # alike
+        n_elements = len(sorted_A)
+        keys = np.empty(n_elements, dtype=np.int64)
+        keys[starts[sorted_A["ri"]] + sorted_A["rj"]] = np.arange(n_elements)[::-1]
+        # label of the element of each key, the last one is for "no element"
+        key_labels = np.append(sorted_A["yi"][::-1], 0)
+
+        # only the K + 1 best clean rows and the dirty rows that can beat them
+        # take part in the top K + 1 of a world, the other rows are not sampled
+        clean = np.flatnonzero(lengths == 1)
+        clean = clean[np.argsort(keys[starts[clean]])[: K_top + 1]]
+        bound = keys[starts[clean[-1]]] if len(clean) > K_top else n_elements
+        best_keys = np.minimum.reduceat(keys, starts) if N > 0 else keys
+        live = np.flatnonzero((lengths > 1) & (best_keys < bound))
+        columns = np.concatenate([live, clean])
+        column_is_one = y[columns] == 1
+        fixed = keys[starts[clean]]
+
+        # the candidates of the dirty rows, cleaning a row that is not sampled
+        # never changes the prediction
+        cells = np.concatenate(
+            [np.arange(starts[ri], starts[ri] + lengths[ri]) for ri in dirty_rows]
+            + [np.empty(0, dtype=np.int64)]
+        ).astype(np.int64)
+        cell_rows = np.repeat(np.arange(N), lengths)[cells]
+        column_of_row = np.full(N, len(columns))
+        column_of_row[live] = np.arange(len(live))
+        live_cells = np.flatnonzero(column_of_row[cell_rows] < len(live))
+        cell_columns = column_of_row[cell_rows[live_cells]]
+        cell_keys = keys[cells[live_cells]]
+        cell_labels = y[cell_rows[live_cells]]
+
+        n_estimates = 1 + len(live_cells)
+        chunk_size = max(CHUNK_BYTES // (8 * max(len(columns), len(live_cells))), 1)
+
+        n, ones, cell_ones = 0, 0, np.zeros(len(live_cells), dtype=np.int64)
+        n_target, n_round = self.min_samples, 0
+        while True:
+            while n < n_target:
+                size = min(chunk_size, n_target - n)
+                world = np.empty((size, len(columns)), dtype=np.int64)
+                world[:, len(live) :] = fixed
+                if len(live) > 0:
+                    choice = rng.randint(0, lengths[live], size=(size, len(live)))
+                    world[:, : len(live)] = keys[starts[live] + choice]
+
+                # K-th smallest key and the next one, n_elements if there is none
+                if len(columns) > K_top:
+                    part = np.partition(world, [K_top - 1, K_top], axis=1)
+                    kth, after = part[:, K_top - 1], part[:, K_top]
+                else:
+                    kth, after = world.max(axis=1), np.full(size, n_elements)
+                in_top = world <= kth[:, None]
+                n_ones = np.count_nonzero(in_top & column_is_one, axis=1)
+                # majority vote, ties go to label 1 as in sort_count_dp
+                ones += np.count_nonzero(2 * n_ones >= K)
+
+                if len(live_cells) > 0:
+                    # a row in the top K is replaced by the next element if its
+                    # new value falls below it, a row outside of it replaces
+                    # the K-th element if its new value rises above it
+                    n_ones_after = n_ones[:, None] + np.where(
+                        in_top[:, cell_columns],
+                        np.where(
+                            cell_keys < after[:, None],
+                            0,
+                            key_labels[after][:, None] - cell_labels,
+                        ),
+                        np.where(
+                            cell_keys < kth[:, None],
+                            cell_labels - key_labels[kth][:, None],
+                            0,
+                        ),
+                    )
+                    cell_ones += np.count_nonzero(2 * n_ones_after >= K, axis=0)
+                n += size
+
+            # the failure probability is split among rounds and estimates
+            delta = (1 - self.confidence) / 2 ** (n_round + 1) / n_estimates
+            p = ones / n
+            radius = bernstein_radius(np.append(cell_ones / n, p), n, delta).max()
+            if radius <= self.tol or (
+                self.max_samples is not None and n >= self.max_samples
+            ):
+                p_after = np.full(len(cells), p)
+                p_after[live_cells] = cell_ones / n
+                return p, p_after, n
+
+            n_target, n_round = 2 * n_target, n_round + 1
+            if self.max_samples is not None:
+                n_target = min(n_target, self.max_samples)
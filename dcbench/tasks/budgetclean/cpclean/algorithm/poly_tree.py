@@ -0,0 +1,135 @@
+"""Segment tree of truncated polynomial products.
+
+Counting the worlds in which k rows of a class are among the K nearest neighbors
+amounts to multiplying the polynomials alpha_i + beta_i * x of the rows of the class
+and reading the coefficient of x^k. compute_B and compute_BR rebuild these products
+from scratch in O(N K), although only one row changes at every step of the scan.
+The tree keeps them up to date in O(K^2 log N) per change instead.
+"""
+import numpy as np
+
+
+def poly_mul(a, b, K):
+    """Multiply polynomials truncated at degree K.
+
+    Args:
+        a, b (np.array): coefficients along the last axis (length K + 1), the
+            other axes are broadcast
+
+    Return:
+        coefficients of a * b up to degree K
+    """
+    out = a[..., :1] * b
+    for j in range(1, K + 1):
+        out[..., j:] += a[..., j : j + 1] * b[..., : K + 1 - j]
+    return out
+
+
+class PolyTree:
+    """Segment tree over the rows of a class.
+
+    Leaf i holds the polynomial alpha_i + beta_i * x and every internal node holds
+    the product of the leaves below it, truncated at degree K. The root is thus the
+    first row of the dp table returned by compute_B.
+
+    Args:
+        alpha_beta (list): [alpha, beta] of each row
+        K (int): degree at which the products are truncated
+    """
+
+    def __init__(self, alpha_beta, K):
+        self.n = len(alpha_beta)
+        self.K = K
+
+        self.size = 1
+        while self.size < self.n:
+            self.size *= 2
+
+        # padding leaves hold the constant polynomial 1
+        self.nodes = np.zeros((2 * self.size, K + 1))
+        self.nodes[:, 0] = 1
+        if self.n > 0:
+            ab = np.asarray(alpha_beta, dtype=float)
+            self.nodes[self.size : self.size + self.n, 0] = ab[:, 0]
+            if K > 0:
+                self.nodes[self.size : self.size + self.n, 1] = ab[:, 1]
+
+        start = self.size // 2
+        while start >= 1:
+            self.nodes[start : 2 * start] = poly_mul(
+                self.nodes[2 * start : 4 * start : 2],
+                self.nodes[2 * start + 1 : 4 * start : 2],
+                K,
+            )
+            start //= 2
+
+    @property
+    def root(self):
+        """Product of all rows."""
+        return self.nodes[1]
+
+    def _mul(self, a, b):
+        return np.convolve(a, b)[: self.K + 1]
+
+    def update(self, i, ab):
+        """Set the [alpha, beta] of row i."""
+        p = self.size + i
+        self.nodes[p] = 0
+        self.nodes[p, 0] = ab[0]
+        if self.K > 0:
+            self.nodes[p, 1] = ab[1]
+
+        p //= 2
+        while p >= 1:
+            self.nodes[p] = self._mul(self.nodes[2 * p], self.nodes[2 * p + 1])
+            p //= 2
+
+    def product(self, lo, hi):
+        """Product of rows lo, ..., hi - 1."""
+        result = np.zeros(self.K + 1)
+        result[0] = 1
+
+        lo += self.size
+        hi += self.size
+        while lo < hi:
+            if lo & 1:
+                result = self._mul(result, self.nodes[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                result = self._mul(result, self.nodes[hi])
+            lo //= 2
+            hi //= 2
+        return result
+
+    def leave_one_out(self):
+        """Products of all rows but one.
+
+        Return:
+            L (np.array): n x (K + 1) array, L[i] is the product of all rows but i
+        """
+        # outside[p] is the product of all leaves that are not below node p
+        outside = np.empty_like(self.nodes)
+        outside[1] = 0
+        outside[1, 0] = 1
+
+        start = 1
+        while start < self.size:
+            left = self.nodes[2 * start : 4 * start : 2]
+            right = self.nodes[2 * start + 1 : 4 * start : 2]
+            parent = outside[start : 2 * start]
+            outside[2 * start : 4 * start : 2] = poly_mul(parent, right, self.K)
+            outside[2 * start + 1 : 4 * start : 2] = poly_mul(parent, left, self.K)
+            start *= 2
+        return outside[self.size : self.size + self.n]
+
+    def leave_out(self, indices):
+        """Products of all rows but i, for each i in indices.
+
+        Costs O(K^2 log N) per index, cheaper than :meth:`leave_one_out` when
+        only a few rows are needed.
+        """
+        result = np.empty((len(indices), self.K + 1))
+        for k, i in enumerate(indices):
+            result[k] = self._mul(self.product(0, i), self.product(i + 1, self.n))
+        return result
@@ -1,3 +1,5 @@
+import heapq
+
 import numpy as np
 
 
@@ -17,26 +19,42 @@ def compute_avg_dirty_entropies(after_entropies, dirty_rows):
     return np.array(avg_entropies)
 
 
-def min_entropy_expected(
-    after_entropy_val, dirty_rows, before_entropies_val, n_jobs=4
-):  # already checked
-    """
+def avg_entropy_matrix(after_entropy_val, dirty_rows, before_entropies_val):
+    """Average entropy after cleaning each dirty row, for each validation point.
+
     Args:
-        ac_counters_val (list): Counts after clean for each cell for each test example
-            (only for dirty rows)
-        dirty rows (list): indices of dirty rows
+        after_entropy_val (list): entropies after cleaning each row to each of its
+            candidates, for each validation point. A V x len(dirty_rows) matrix
+            of the averages is returned as it is.
+        dirty_rows (list): indices of dirty rows
+        before_entropies_val (np.array): entropy of each validation point, which
+            rows that were not evaluated (None) keep, as well as rows with a
+            candidate whose worlds were all skipped (entropy inf, see
+            entropy_by_counts), so that their gain is 0
+
+    Return:
+        avg_entropies_val (np.array): V x len(dirty_rows) average entropies
     """
-    avg_entropies_val = [
-        compute_avg_dirty_entropies(ae, dirty_rows) for ae in after_entropy_val
-    ]
+    if isinstance(after_entropy_val, np.ndarray):
+        return after_entropy_val
+    avg_entropies_val = np.array(
+        [compute_avg_dirty_entropies(ae, dirty_rows) for ae in after_entropy_val]
+    ).reshape(len(after_entropy_val), len(dirty_rows))
+    mask = ~np.isfinite(avg_entropies_val)
+    avg_entropies_val[mask] = np.broadcast_to(
+        np.reshape(before_entropies_val, (-1, 1)), mask.shape
+    )[mask]
+    return avg_entropies_val
 
-    for i in range(len(avg_entropies_val)):
-        mask = np.isnan(avg_entropies_val[i])
-        avg_entropies_val[i][mask] = before_entropies_val[i]
 
-    avg_entropies_val = np.array(avg_entropies_val)
-    info_gain = (before_entropies_val.reshape(-1, 1) - avg_entropies_val).mean(axis=0)
-    info_gain[info_gain == 0] = float("-inf")
+def min_entropy_expected(
+    after_entropy_val, dirty_rows, before_entropies_val, n_jobs=4
+):  # already checked
+    """Select the dirty row with the largest information gain, see
+    :func:`entropy_expected`."""
+    info_gain = entropy_expected(
+        after_entropy_val, dirty_rows, before_entropies_val, n_jobs=n_jobs
+    )
     max_idx = np.argmax(info_gain)
     sel = dirty_rows[max_idx]
     return sel
@@ -47,19 +65,132 @@ def entropy_expected(
 ):  # already checked
     """
     Args:
-        ac_counters_val (list): Counts after clean for each cell for each test example
-            (only for dirty rows)
+        after_entropy_val (list or np.array): entropies after clean for each
+            validation point, or their averages, see :func:`avg_entropy_matrix`
         dirty rows (list): indices of dirty rows
     """
-    avg_entropies_val = [
-        compute_avg_dirty_entropies(ae, dirty_rows) for ae in after_entropy_val
-    ]
-
-    for i in range(len(avg_entropies_val)):
-        mask = np.isnan(avg_entropies_val[i])
-        avg_entropies_val[i][mask] = before_entropies_val[i]
-
-    avg_entropies_val = np.array(avg_entropies_val)
-    info_gain = (before_entropies_val.reshape(-1, 1) - avg_entropies_val).mean(axis=0)
+    avg_entropies_val = avg_entropy_matrix(
+        after_entropy_val, dirty_rows, before_entropies_val
+    )
+    info_gain = (np.reshape(before_entropies_val, (-1, 1)) - avg_entropies_val).mean(
+        axis=0
+    )
     info_gain[info_gain == 0] = float("-inf")
     return info_gain
+
+
+def select_batch(
+    after_entropy_val, dirty_rows, before_entropies_val, batch_size, gain_ratio=0.0
+):
+    """Select up to batch_size rows with large and complementary information gains.
+
+    Rows are picked greedily. A validation point cannot lose more entropy than it
+    has left, so once a row is picked, the gains of the others on the same
+    validation points are capped by what remains. The first row is thus the one
+    selected by :func:`min_entropy_expected`, and rows that only help on the
+    validation points it already resolves fall behind.
+
+    Args:
+        after_entropy_val (list or np.array): entropies after cleaning each row,
+            for each validation point, see :func:`avg_entropy_matrix`
+        dirty_rows (list): indices of dirty rows
+        before_entropies_val (np.array): entropy of each validation point
+        batch_size (int): maximum number of rows
+        gain_ratio (float): stop once the capped gain of the next row drops below
+            this fraction of the gain of the first
+
+    Return:
+        sels (list): selected rows
+    """
+    avg_entropies_val = avg_entropy_matrix(
+        after_entropy_val, dirty_rows, before_entropies_val
+    )
+    gains = before_entropies_val.reshape(-1, 1) - avg_entropies_val
+    # validation points whose worlds were all skipped have an infinite entropy,
+    # which no row is known to reduce
+    gains[~np.isfinite(gains)] = 0
+
+    residual = np.where(np.isfinite(before_entropies_val), before_entropies_val, 0)
+    available = np.ones(len(dirty_rows), dtype=bool)
+    sels, threshold = [], 0.0
+    for _ in range(min(batch_size, len(dirty_rows))):
+        capped = np.minimum(gains, residual.reshape(-1, 1)).sum(axis=0)
+        capped[capped == 0] = float("-inf")
+        capped[~available] = float("-inf")
+        k = np.argmax(capped)
+        if len(sels) > 0 and not capped[k] > threshold:
+            break
+        if len(sels) == 0 and capped[k] > 0:
+            # the first row is selected even without a gain, as by
+            # min_entropy_expected, the others only with one
+            threshold = gain_ratio * capped[k]
+
+        sels.append(dirty_rows[k])
+        available[k] = False
+        residual = np.maximum(residual - np.maximum(gains[:, k], 0), 0)
+    return sels
+
+
+class LazyGreedy(object):
+    """Lazy greedy (CELF) selection of the rows to clean.
+
+    The information gain of a row is assumed to only decrease as other rows are
+    cleaned, so the gain computed at an earlier iteration bounds the current one.
+    The rows are kept in a max-heap of these bounds. At every iteration, the stale
+    bounds at the top of the heap are evaluated again, batch_size rows at a time,
+    until the row at the top is up to date.
+
+    Gains are summed rather than averaged over the validation points, because the
+    validation points are pruned between iterations. This does not change which
+    row is the best within an iteration.
+
+    Args:
+        batch_size (int): number of stale rows evaluated at once
+    """
+
+    def __init__(self, batch_size=8):
+        self.batch_size = batch_size
+        self.heap = None
+        self.iteration = 0
+        self.n_evaluated = 0
+        self.n_exact = 0
+
+    def select(self, evaluate, dirty_rows):
+        """Select the next row to clean.
+
+        Args:
+            evaluate (callable): evaluate(rows) returns the current information
+                gain of each of the rows
+            dirty_rows (list): rows that can be selected
+
+        Return:
+            sel (int): the selected row, None if there is none
+        """
+        self.iteration += 1
+        self.n_exact += len(dirty_rows)
+        if self.heap is None:
+            self.heap = []
+            self._push(dirty_rows, evaluate(dirty_rows))
+
+        dirty_rows = set(dirty_rows)
+        while True:
+            stale = []
+            while len(self.heap) > 0 and len(stale) < self.batch_size:
+                _, row, iteration = self.heap[0]
+                if row not in dirty_rows:
+                    heapq.heappop(self.heap)
+                elif iteration == self.iteration:
+                    break
+                else:
+                    stale.append(heapq.heappop(self.heap)[1])
+
+            if len(stale) == 0:
+                if len(self.heap) == 0:
+                    return None
+                return heapq.heappop(self.heap)[1]
+            self._push(stale, evaluate(stale))
+
+    def _push(self, rows, gains):
+        self.n_evaluated += len(rows)
+        for row, gain in zip(rows, gains):
+            heapq.heappush(self.heap, (-gain, row, self.iteration))
@@ -3,12 +3,38 @@
 sort_count_no_dp(S, y, K) sort_count_dp(S, y, K) sort_count_dpdc(S, y,
 K) sort_count_dpdc_after_clean(S, y, K) sort_count_after_clean(S, y, K)
 """
-from functools import partial
 
 import numpy as np
 
-from ..utils import Pool
-from .utils import compute_entropy_by_counts
+from ..utils import WorkerPool, timed
+from .poly_tree import PolyTree
+from .utils import entropy_by_counts
+from .vote import count_votes, get_beta_bounds, vote_weights
+
+# one element per candidate of every training row, as produced by `sort`
+ELEMENT_DTYPE = np.dtype(
+    [("sij", np.float64), ("ri", np.int64), ("rj", np.int64), ("yi", np.int64)]
+)
+
+
+def flatten(S, y):
+    """Squash similarity matrix in a structured array.
+
+    Args:
+        S (list of list): similarity matrix
+        y (np.array): labels
+
+    Return:
+        A (np.array): structured array with fields sij, ri, rj, yi (ELEMENT_DTYPE)
+    """
+    lengths = np.array([len(Si) for Si in S], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    A = np.empty(offsets[-1], dtype=ELEMENT_DTYPE)
+    A["sij"] = np.concatenate(S) if len(S) > 0 else []
+    A["ri"] = np.repeat(np.arange(len(S)), lengths)
+    A["rj"] = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+    A["yi"] = np.repeat(np.asarray(y, dtype=np.int64), lengths)
+    return A
 
 
 def sort(S, y):
@@ -19,20 +45,43 @@ def sort(S, y):
         y (np.array): labels
 
     Return:
-        A (list of tuple): [(sij, ri, rj, yi)]
+        A (np.array): structured array with fields sij, ri, rj, yi (ELEMENT_DTYPE)
     """
-    A = []
-    for ri, (Si, yi) in enumerate(zip(S, y)):
-        for rj, sij in enumerate(Si):
-            A.append((-sij, ri, rj, yi))
+    A = flatten(S, y)
 
     # break tie: small index has larger similarity
-    A = sorted(A)[::-1]
-    sorted_A = []
+    order = np.lexsort((-A["rj"], -A["ri"], A["sij"]))
+    return A[order]
+
+
+def sort_valid(S, y, valid_indices, order=None):
+    """`sort` the pruned similarities.
 
-    for sij, ri, rj, yi in A:
-        sorted_A.append((-sij, ri, rj, yi))
-    return sorted_A
+    Args:
+        S, y: similarities and labels of the rows in valid_indices
+        valid_indices (np.array): rows of S_full that S holds, in increasing order
+        order (callable): order(valid_indices) returns the row (of S_full), index
+            in the row and similarity of the candidates of these rows in sorted
+            order, e.g. SimilaritySpace.sorted_candidates. Defaults to None, in
+            which case they are sorted.
+
+    The time spent is reported as the "sort" phase, see utils.timed.
+    """
+    with timed("sort"):
+        if order is None:
+            return sort(S, y)
+        ri, rj, sij = order(valid_indices)
+        # row of S_full -> row of S
+        valid_indices = np.asarray(valid_indices, dtype=np.int64)
+        new_rid = np.zeros(valid_indices[-1] + 1 if len(valid_indices) > 0 else 0, int)
+        new_rid[valid_indices] = np.arange(len(valid_indices))
+
+        A = np.empty(len(ri), dtype=ELEMENT_DTYPE)
+        A["sij"] = sij
+        A["ri"] = new_rid[ri]
+        A["rj"] = rj
+        A["yi"] = np.asarray(y, dtype=np.int64)[A["ri"]]
+        return A
 
 
 def compute_B(alpha_beta, K, eps=1e-100):
@@ -74,9 +123,47 @@ def compute_BR(alpha_beta, K, eps=1e-100):
     return B, status
 
 
-def group_by_classes(S, y):
-    classes = [0, 1]
+def compute_status(tree, ri, w, K, eps=1e-100, reverse=False):
+    """Status that compute_B (compute_BR if reverse) returns for the rows of a
+    tree, without building the dp table.
+
+    s ends up at sum(B[0, :K + 1]) + (1 - w) * sum(B[ri + 1, :K + 1]), where ri is
+    the current row and w = alpha + beta of that row (the rows before ri for
+    compute_BR). s only decreases during the loop, so its final value decides.
+    compute_B obtains s by subtracting from 1 and also reports steps below its
+    rounding error (about n machine epsilons) as "small". The tree holds the
+    products themselves, whose relative error does not grow with their size, so
+    s is accurate down to the smallest floats and a step is only skipped when its
+    worlds weigh less than eps / n in total.
+
+    Args:
+        tree (PolyTree): rows of the class
+        ri (int): current row in the tree or None if it belongs to another class
+        w (float): alpha + beta of the current row
+        K (int): degree at which the dp table is truncated
+    """
+    n = tree.n
+    if n == 0:
+        return "big"
+    threshold = eps / n
+
+    s = tree.root[: K + 1].sum()
+    if s >= threshold:
+        return "big"
+
+    if ri is not None:
+        rest = tree.product(0, ri) if reverse else tree.product(ri + 1, n)
+        s += (1 - w) * rest[: K + 1].sum()
+    return "small" if s < threshold else "big"
+
+
+def get_classes(y_full):
+    """Labels of the training rows, 0, ..., C - 1 with C >= 2 so that the counts
+    of binary problems always hold both labels."""
+    return list(range(max(int(np.max(y_full)) + 1, 2))) if len(y_full) > 0 else [0, 1]
+
 
+def group_by_classes(S, y, classes):
     # map old row number to new row number in each group
     new_rid = {}
 
@@ -113,31 +200,15 @@ def change_alpha_beta(alpha_beta_c, n_must_alpha_c, n_must_beta_c, ri, yi, ab_af
     alpha_beta_c[yi][ri] = ab_after
 
 
-def get_cases(n_must_alpha_c, n_must_beta_c, N_c, classes, K):
-    cases_c = {}
-
-    for c in classes:
-        n_must_alpha = n_must_alpha_c[c]
-        n_must_beta = n_must_beta_c[c]
-        N = N_c[c]
-        cases_c[c] = set(range(n_must_beta, min(N - n_must_alpha + 1, K + 1)))
-
-    # Only work for binary cases
-    possible_cases = []
-    max_n_beta = {c: 0 for c in classes}
-    classes = list(classes)
-
-    for i in range(K + 1):
-        if i in cases_c[classes[0]] and (K - i) in cases_c[classes[1]]:
-            pred = classes[0] if i > K / 2 else classes[1]
-            possible_cases.append({classes[0]: i, classes[1]: K - i, "knn_pred": pred})
-            max_n_beta[classes[0]] = max(max_n_beta[classes[0]], i)
-            max_n_beta[classes[1]] = max(max_n_beta[classes[1]], K - i)
-
-    return possible_cases, max_n_beta
+def sort_count_dp(S_full, y_full, K, mm=None, order=None):
+    """Count the worlds supporting each label.
 
+    Args:
+        order (callable): sorted order of the candidates, see :func:`sort_valid`
 
-def sort_count_dp(S_full, y_full, K, mm=None):
+    Return:
+        world_counts (dict): {label: number of worlds}
+    """
     S, y, valid_indices = prune(S_full, y_full, K, mm)
 
     (
@@ -148,140 +219,150 @@ def sort_count_dp(S_full, y_full, K, mm=None):
         row_count,
         n_must_alpha_c,
         n_must_beta_c,
-    ) = group_by_classes(S, y)
-    world_counts = {c: 0 for c in classes}
+    ) = group_by_classes(S, y, get_classes(y_full))
+    world_counts = np.zeros(len(classes))
     # sort
-    sorted_A = sort(S, y)
+    sorted_A = sort_valid(S, y, valid_indices, order)
 
-    # scan and count
-    Bc = {}
+    # dp tables, kept up to date as alpha beta change
+    trees = {c: PolyTree(alpha_beta_c[c], K) for c in classes}
 
-    for sij, ri, rj, yi in sorted_A:
+    # scan and count
+    for sij, ri, rj, yi in sorted_A.tolist():
         new_ri = new_rid[ri]
+        w = 1 / row_count[yi][new_ri]
 
         # temporarily change alpha beta for current row
         temp_ab = alpha_beta_c[yi][new_ri]
         change_alpha_beta(
-            alpha_beta_c,
-            n_must_alpha_c,
-            n_must_beta_c,
-            new_ri,
-            yi,
-            [0, 1 / row_count[yi][new_ri]],
+            alpha_beta_c, n_must_alpha_c, n_must_beta_c, new_ri, yi, [0, w]
         )
+        trees[yi].update(new_ri, [0, w])
 
         # get possible cases
-        cases, max_n_beta = get_cases(n_must_alpha_c, n_must_beta_c, N_c, classes, K)
+        feasible, max_n_beta = get_beta_bounds(
+            n_must_alpha_c, n_must_beta_c, N_c, classes, K
+        )
 
-        if len(cases) > 0:
-            # compute Bc
+        if feasible:
+            status = "big"
             for c in classes:
-                Bc[c], status = compute_B(alpha_beta_c[c], max_n_beta[c])
+                status = compute_status(
+                    trees[c], new_ri if c == yi else None, w, max_n_beta[c]
+                )
                 if status == "small":
                     break
 
             if status == "big":
-                for case in cases:
-                    counts = np.prod([Bc[c][0, case[c]] for c in classes])
-                    world_counts[case["knn_pred"]] += counts
+                world_counts += count_votes([trees[c].root for c in classes], K)
 
         # reset alpha beta
-        new_ab = [
-            temp_ab[0] + 1 / row_count[yi][new_ri],
-            temp_ab[1] - 1 / row_count[yi][new_ri],
-        ]
+        new_ab = [temp_ab[0] + w, temp_ab[1] - w]
         new_ab = stablelize(new_ab)
         change_alpha_beta(
             alpha_beta_c, n_must_alpha_c, n_must_beta_c, new_ri, yi, new_ab
         )
-    return world_counts
-
-
-def init_counter(classes):
-    return {c: 0 for c in classes}
+        trees[yi].update(new_ri, new_ab)
+    return dict(zip(classes, world_counts.tolist()))
 
 
 def init_ac_counters(S, classes):
-    ac_counters = []
-    for Si in S:
-        counters = [init_counter(classes) for _ in range(len(Si))]
-        ac_counters.append(counters)
-    return ac_counters
+    """Counters of the possible worlds, rows x candidates x classes."""
+    return np.zeros((len(S), max(len(Si) for Si in S), len(classes)))
 
 
-def count_worlds_fix_ri(B, BR, n_beta, ri):
-    if n_beta < 0:
-        return 0
-    if ri == len(B) - 2:
-        # the bottom row, only use BR
-        n_world = BR[ri, n_beta]
-    elif ri == 0:
-        # the top row, only use B
-        n_world = B[1, n_beta]
-    else:
-        n_world = B[ri + 1, : n_beta + 1].dot(BR[ri, : n_beta + 1][::-1])
-    return n_world
+def rank_candidates(sorted_A, S):
+    """Position of each candidate in the scan, rows x candidates.
 
+    Padding candidates are placed after all other elements.
+    """
+    ranks = np.full((len(S), max(len(Si) for Si in S)), len(sorted_A))
+    ranks[sorted_A["ri"], sorted_A["rj"]] = np.arange(len(sorted_A))
+    return ranks
 
-def count_worlds_after_clean(B_c, BR_c, cases, classes, y, new_rid, dirty_rows):
-    count_worlds = []
 
-    for ri, yi in enumerate(y):
-        if ri not in dirty_rows:
-            # omit clean rows
-            count_worlds.append([None, None])
-            continue
+def count_worlds_by_tree(trees, classes, n_rows, dirty_rows_c, new_rid, all_rows=True):
+    """Count the worlds for each dirty row given that its candidate is smaller
+    (s_counts) or larger (l_counts) than the current element.
 
-        # initialize counter
-        l_count = {c: 0 for c in classes}
-        s_count = {c: 0 for c in classes}
+    The worlds of the other rows of a class are read from the leave-one-out
+    products of its tree, those of the other classes from :func:`vote_weights`.
 
-        new_ri = new_rid[ri]
-        other_c = [c for c in classes if c != yi][
-            0
-        ]  # classes other than the current one
+    Args:
+        dirty_rows_c (dict): {class: dirty rows of the class}
+        all_rows (bool): whether dirty_rows_c holds all dirty rows, otherwise the
+            products are computed for each of them instead of for all rows,
+            unless there are many of them
 
-        for case in cases:
-            # worlds for other classes
-            world_other = B_c[other_c][0, case[other_c]]
+    Return:
+        s_counts, l_counts (np.array): rows x classes counts, zero for clean rows
+    """
+    s_counts = np.zeros((n_rows, len(classes)))
+    l_counts = np.zeros((n_rows, len(classes)))
 
-            # world for the current class
-            n_beta_yi = case[yi]
-            world_yi_s = count_worlds_fix_ri(B_c[yi], BR_c[yi], n_beta_yi, new_ri)
-            world_yi_l = count_worlds_fix_ri(B_c[yi], BR_c[yi], n_beta_yi - 1, new_ri)
+    roots = [trees[c].root for c in classes]
+    for i, c in enumerate(classes):
+        rows = dirty_rows_c[c]
+        if len(rows) == 0:
+            continue
 
-            pred = case["knn_pred"]
-            s_count[pred] += world_yi_s * world_other
-            l_count[pred] += world_yi_l * world_other
+        # weights[n_beta, p]: worlds of the other classes over the cases with
+        # n_beta rows of class c that predict classes[p]
+        weights = vote_weights(roots, trees[c].K, i)
 
-        count_worlds.append([s_count, l_count])
-    return count_worlds
+        leaves = [new_rid[ri] for ri in rows]
+        # leave_one_out costs about as much as leave_out for 8 + n / 128 rows
+        if all_rows or len(leaves) > 8 + trees[c].n / 128:
+            worlds = trees[c].leave_one_out()[leaves]
+        else:
+            worlds = trees[c].leave_out(leaves)
+        s_counts[rows] = worlds.dot(weights)
+        l_counts[rows] = worlds[:, :-1].dot(weights[1:])
+    return s_counts, l_counts
 
 
-def update_ac_counters(ac_counters, sl_counts, ri, rj, S, y, dirty_rows):
-    # update current element using large counts
-    if ri in dirty_rows:
-        l_count = sl_counts[ri][1]
-        for c, value in l_count.items():
-            ac_counters[ri][rj][c] += value
+def update_ac_counters(
+    ac_counters, s_counts, l_counts, ri, rj, ranks, pos, rows=slice(None)
+):
+    """Add the small counts to the candidates scanned before the current element,
+    the large counts to the others and to the current element itself.
 
-    # update others
-    for i, Si in enumerate(S):
-        if i == ri:
-            continue
+    Args:
+        ac_counters (np.array): rows x candidates x classes counters
+        s_counts, l_counts (np.array): rows x classes counts, zero for clean rows
+        ri, rj (int): current element
+        ranks (np.array): rows x candidates position of each candidate in the scan
+        pos (int): position of the current element in the scan
+        rows (np.array): the only rows with non-zero counts, defaults to all
+    """
+    current = l_counts[ri].copy()
+
+    # the other candidates of the current row are left as they are
+    s_counts[ri] = 0
+    l_counts[ri] = 0
+    ac_counters[rows] += np.where(
+        (ranks[rows] < pos)[:, :, None],
+        s_counts[rows, None, :],
+        l_counts[rows, None, :],
+    )
+    ac_counters[ri, rj] += current
+    return ac_counters
 
-        if i not in dirty_rows:
-            continue
 
-        s_count, l_count = sl_counts[i]
-        for j, sij in enumerate(Si):
-            if sij < S[ri][rj] or (sij == S[ri][rj] and i > ri):
-                for c, value in s_count.items():
-                    ac_counters[i][j][c] += value
-            else:
-                for c, value in l_count.items():
-                    ac_counters[i][j][c] += value
-    return ac_counters
+def compute_after_entropy(valid_indices, y_full, ac_counters, dirty_rows, S):
+    """Entropy after cleaning each dirty row to each of its candidates, computed
+    from all counters at once.
+
+    Return:
+        after_entropies (list): for each row of y_full, the entropy for each
+            candidate, or None if it is not a dirty row
+    """
+    after_entropies = [None] * len(y_full)
+    dirty_rows = sorted(dirty_rows)
+    entropies = entropy_by_counts(ac_counters[dirty_rows]).tolist()
+    for ri, row_entropies in zip(dirty_rows, entropies):
+        after_entropies[valid_indices[ri]] = row_entropies[: len(S[ri])]
+    return after_entropies
 
 
 def prune(S_full, y_full, K, mm=None):
@@ -307,30 +388,34 @@ def get_valid_indices(mm, K):
     return valid_indices
 
 
-def compute_after_entropy(valid_indices, y_full, ac_counters, dirty_rows):
-    after_entropies = []
-    indices_map = {idx: i for i, idx in enumerate(valid_indices)}
-
-    for i in range(len(y_full)):
-        if i not in indices_map:
-            after_entropies.append(None)
-        elif indices_map[i] not in dirty_rows:
-            after_entropies.append(None)
-        else:
-            entropies = [
-                compute_entropy_by_counts(counts)
-                for counts in ac_counters[indices_map[i]]
-            ]
-            after_entropies.append(entropies)
-    return after_entropies
+def sort_count_after_clean(
+    S_full, y_full, K, mm=None, rows=None, return_counts=False, order=None
+):
+    """Compute the entropy of the predictions after cleaning each dirty row to
+    each of its candidates.
 
+    Args:
+        rows (list): the rows of S_full to compute the entropies of, defaults to
+            all dirty rows
+        return_counts (bool): also return the counts of sort_count_dp, which the
+            same scan obtains at little extra cost
+        order (callable): sorted order of the candidates, see :func:`sort_valid`
 
-def sort_count_after_clean(S_full, y_full, K, mm=None):
+    Return:
+        world_counts (dict): {label: number of worlds}, only if return_counts
+        after_entropies (list): for each row, the entropy for each candidate, or
+            None if it is clean, pruned or not in rows
+    """
     S, y, valid_indices = prune(S_full, y_full, K, mm)
 
     # print("prune", len(S), time.time() - tic)
     # omit clean rows in later computation
     dirty_rows = set([i for i, x in enumerate(S) if len(x) > 1])
+    counted_rows = slice(None)
+    if rows is not None:
+        rows = set(rows)
+        dirty_rows = set(i for i in dirty_rows if valid_indices[i] in rows)
+        counted_rows = np.array(sorted(dirty_rows), dtype=int)
 
     # initialize
     (
@@ -341,68 +426,85 @@ def sort_count_after_clean(S_full, y_full, K, mm=None):
         row_count,
         n_must_alpha_c,
         n_must_beta_c,
-    ) = group_by_classes(S, y)
+    ) = group_by_classes(S, y, get_classes(y_full))
     ac_counters = init_ac_counters(S, classes)
+    world_counts = np.zeros(len(classes))
 
     # sort
-    sorted_A = sort(S, y)
+    sorted_A = sort_valid(S, y, valid_indices, order)
+    ranks = rank_candidates(sorted_A, S)
+
+    # dp tables, kept up to date as alpha beta change
+    trees = {c: PolyTree(alpha_beta_c[c], K) for c in classes}
+    dirty_rows_c = {c: [ri for ri in sorted(dirty_rows) if y[ri] == c] for c in classes}
 
-    # dp tables
-    B_c = {}
-    BR_c = {}
     # scan
-    for sij, ri, rj, yi in sorted_A:
+    for pos, (sij, ri, rj, yi) in enumerate(sorted_A.tolist()):
         new_ri = new_rid[ri]
+        w = 1 / row_count[yi][new_ri]
 
         # temporarily change alpha beta to [0, 1] for current row
         temp_ab = alpha_beta_c[yi][new_ri]
         change_alpha_beta(
-            alpha_beta_c,
-            n_must_alpha_c,
-            n_must_beta_c,
-            new_ri,
-            yi,
-            [0, 1 / row_count[yi][new_ri]],
+            alpha_beta_c, n_must_alpha_c, n_must_beta_c, new_ri, yi, [0, w]
         )
+        trees[yi].update(new_ri, [0, w])
 
         # get possible cases
-        cases, max_n_beta = get_cases(n_must_alpha_c, n_must_beta_c, N_c, classes, K)
+        feasible, max_n_beta = get_beta_bounds(
+            n_must_alpha_c, n_must_beta_c, N_c, classes, K
+        )
 
         # skip if no possible cases
-        if len(cases) > 0:
-            # compute dp tables B_c, BR_c only for the class of the current element
-            for c in classes:
-                B_c[c], status = compute_B(alpha_beta_c[c], max_n_beta[c])
-                if status == "small":
-                    break
-                BR_c[c], status = compute_BR(alpha_beta_c[c], max_n_beta[c])
+        if feasible:
+            status = "big"
+            for reverse in [False, True]:
+                for c in classes:
+                    status = compute_status(
+                        trees[c],
+                        new_ri if c == yi else None,
+                        w,
+                        max_n_beta[c],
+                        reverse=reverse,
+                    )
+                    if status == "small":
+                        break
                 if status == "small":
                     break
 
+                # sort_count_dp only needs the forward status
+                if return_counts and not reverse:
+                    world_counts += count_votes([trees[c].root for c in classes], K)
+
             if status == "big":
                 # count worlds for each cell
-                sl_counts = count_worlds_after_clean(
-                    B_c, BR_c, cases, classes, y, new_rid, dirty_rows
+                s_counts, l_counts = count_worlds_by_tree(
+                    trees,
+                    classes,
+                    len(S),
+                    dirty_rows_c,
+                    new_rid,
+                    all_rows=rows is None,
                 )
 
                 # update counts
                 ac_counters = update_ac_counters(
-                    ac_counters, sl_counts, ri, rj, S, y, dirty_rows
+                    ac_counters, s_counts, l_counts, ri, rj, ranks, pos, counted_rows
                 )
 
         # restore and update alpha beta
-        new_ab = [
-            temp_ab[0] + 1 / row_count[yi][new_ri],
-            temp_ab[1] - 1 / row_count[yi][new_ri],
-        ]
+        new_ab = [temp_ab[0] + w, temp_ab[1] - w]
         new_ab = stablelize(new_ab)
         change_alpha_beta(
             alpha_beta_c, n_must_alpha_c, n_must_beta_c, new_ri, yi, new_ab
         )
+        trees[yi].update(new_ri, new_ab)
 
     after_entropies = compute_after_entropy(
-        valid_indices, y_full, ac_counters, dirty_rows
+        valid_indices, y_full, ac_counters, dirty_rows, S
     )
+    if return_counts:
+        return dict(zip(classes, world_counts.tolist())), after_entropies
     return after_entropies
 
 
@@ -414,45 +516,20 @@ def stablelize(new_ab):
     return new_ab
 
 
-def sort_count_dp_wrapper(i, S_val, y_train, K, MM):
-    return sort_count_dp(S_val[i], y_train, K, mm=MM[i])
-
+def map_val(fn, S_val, y_train, K, MM=None, n_jobs=4):
+    """Apply fn(S, y_train, K, mm=mm, order=order) to every validation point in
+    parallel, see WorkerPool.map.
 
-def sort_count_dp_multi(S_val, y_train, K, MM=None, n_jobs=4):
-    indices = range(len(S_val))
-    if MM is None:
-        MM = [None] * len(S_val)
-
-    if n_jobs == 1:
-        counters = [sort_count_dp(S_val[i], y_train, K, MM[i]) for i in indices]
-    else:
-        pool = Pool(n_jobs)
-        counters = pool.map(
-            partial(sort_count_dp_wrapper, S_val=S_val, y_train=y_train, K=K, MM=MM),
-            indices,
-        )
-    return counters
+    S_val is a SimilaritySpace or a list of list of np.array, in which case MM are
+    the min and max similarities of each validation point.
+    """
+    with WorkerPool(S_val, y_train, MM=MM, n_jobs=n_jobs) as pool:
+        return pool.map(fn, K)
 
 
-def sort_count_after_clean_wrapper(i, S_val, y_train, K, MM):
-    return sort_count_after_clean(S_val[i], y_train, K, mm=MM[i])
+def sort_count_dp_multi(S_val, y_train, K, MM=None, n_jobs=4):
+    return map_val(sort_count_dp, S_val, y_train, K, MM=MM, n_jobs=n_jobs)
 
 
 def sort_count_after_clean_multi(S_val, y_train, K, n_jobs=4, MM=None):
-    indices = range(len(S_val))
-    if MM is None:
-        MM = [None] * len(S_val)
-
-    if n_jobs == 1:
-        after_entropies = [
-            sort_count_after_clean(S_val[i], y_train, K, MM[i]) for i in indices
-        ]
-    else:
-        pool = Pool(n_jobs)
-        after_entropies = pool.map(
-            partial(
-                sort_count_after_clean_wrapper, S_val=S_val, y_train=y_train, K=K, MM=MM
-            ),
-            indices,
-        )
-    return after_entropies
+    return map_val(sort_count_after_clean, S_val, y_train, K, MM=MM, n_jobs=n_jobs)
@@ -10,11 +10,42 @@ def compute_entropy_by_counts(counts):
     Args:
         counts (dict): {label: count}
     """
-    s = sum(counts.values())
-    if s == 0:
-        return float("inf")
-    p = [c / s for c in counts.values()]
-    return entropy(p)
+    return float(entropy_by_counts(list(counts.values())))
+
+
+def entropy_by_counts(counts):
+    """Compute the entropies given the counts of each label along the last axis,
+    e.g. of all the after-clean counters of a validation point at once.
+
+    Args:
+        counts (np.array): ... x labels counts
+
+    Return:
+        entropies (np.array): ... entropies (in nats, as scipy.stats.entropy),
+            inf where all counts are 0 as in compute_entropy_by_counts, which
+            avg_entropy_matrix treats as no gain
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    s = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = counts / s
+        h = -np.where(p > 0, p * np.log(p), 0).sum(axis=-1)
+    return np.where(s[..., 0] == 0, np.inf, h)
+
+
+def entropy_by_count_dicts(results):
+    """Compute the entropy of each of a list of counts, see
+    :func:`compute_entropy_by_counts`.
+
+    Return:
+        entropies (np.array): entropy of each dict of counts
+    """
+    labels = sorted(set().union(*results))
+    return entropy_by_counts(
+        np.array([[counts.get(c, 0) for c in labels] for counts in results]).reshape(
+            len(results), len(labels)
+        )
+    )
 
 
 def compute_entropy_by_labels(A):
@@ -40,7 +71,7 @@ def product(a):
     count = Counter(a)
     result = 1
     for k, v in count.items():
-        result *= k ** v
+        result *= k**v
     return result
 
 
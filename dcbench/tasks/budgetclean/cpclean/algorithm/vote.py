@@ -0,0 +1,133 @@
+"""Vote of the K nearest neighbors over the worlds counted by class.
+
+For every class, the dp tables give the worlds in which k of its rows are among the
+K nearest neighbors, k = 0, ..., K. Enumerating the ways to split the K neighbors
+among C classes, as the legacy scans did for two, takes C(K + C - 1, C - 1) cases.
+The vote is summed class by class instead: a label p wins with t votes iff every
+other class gets fewer votes (at most t for the classes it wins ties against),
+which is a product of truncated polynomials. This costs O(C^2) products of
+polynomials of degree K.
+
+Ties go to the largest label, as in sort_count_dp for two labels.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from .poly_tree import poly_mul
+
+
+def get_beta_bounds(n_must_alpha_c, n_must_beta_c, N_c, classes, K):
+    """Range of the number of rows of each class among the K nearest neighbors.
+
+    Return:
+        feasible (bool): whether the ranges add up to K, otherwise there is no
+            possible case
+        max_n_beta (dict): {class: largest number of rows of the class among the
+            K nearest neighbors}
+    """
+    lo = {c: n_must_beta_c[c] for c in classes}
+    hi = {c: min(N_c[c] - n_must_alpha_c[c], K) for c in classes}
+    feasible = all(lo[c] <= hi[c] for c in classes) and (
+        sum(lo.values()) <= K <= sum(hi.values())
+    )
+    total_lo = sum(lo.values())
+    max_n_beta = {c: min(hi[c], K - total_lo + lo[c]) for c in classes}
+    return feasible, max_n_beta
+
+
+@lru_cache(maxsize=None)
+def _layout(K, n_classes, c):
+    """Masks and indices of :func:`vote_weights`, which only depend on the shape.
+
+    Return:
+        masks (dict): {strict: (K + 1) x (K + 1) mask of the degrees up to t
+            (below t if strict) in row t}
+        degree (np.array): (K + 1) x (K + 1), K - m - t clipped at 0
+        keep (dict): {p: (K + 1) x (K + 1) mask of the m, t such that p wins
+            against c with t votes to m and degree is not clipped}
+    """
+    m = np.arange(K + 1)
+    masks = {False: np.tri(K + 1), True: np.tri(K + 1, k=-1)}
+    degree = K - m[:, None] - m[None, :]
+    keep = {
+        p: (degree >= 0)
+        & ((m[:, None] < m[None, :]) | ((m[:, None] == m[None, :]) & (p > c)))
+        for p in range(n_classes)
+        if p != c
+    }
+    return masks, np.maximum(degree, 0), keep
+
+
+def _product(polys, K):
+    """Product of batches of polynomials, the constant 1 if there are none."""
+    if len(polys) == 0:
+        result = np.zeros((K + 1, K + 1))
+        result[:, 0] = 1
+        return result
+    result = polys[0]
+    for poly in polys[1:]:
+        result = poly_mul(result, poly, K)
+    return result
+
+
+def vote_weights(roots, K, c):
+    """Worlds of the other classes by the votes of class c and the prediction.
+
+    Args:
+        roots (list): for each class, in increasing order of label, the worlds
+            with k of its rows among the K nearest neighbors (the root of its
+            PolyTree)
+        K (int): KNN hyperparameter
+        c (int): position of the class in roots
+
+    Return:
+        weights (np.array): (K + 1) x C, weights[m, p] sums the worlds of the
+            classes other than c over the cases in which c has m rows among the
+            K nearest neighbors and the class at position p is predicted. The
+            worlds of all classes predicting p are roots[c] @ weights[:, p].
+    """
+    n_classes = len(roots)
+    m = np.arange(K + 1)
+    if n_classes == 2:
+        # the other class gets the other K - m votes, and wins the ties if its
+        # label is larger
+        weights = np.empty((K + 1, 2))
+        rest = roots[1 - c][K - m]
+        wins = (m > K - m) | ((m == K - m) & (c == 1))
+        weights[:, c] = np.where(wins, rest, 0)
+        weights[:, 1 - c] = np.where(wins, 0, rest)
+        return weights
+
+    masks, degree, keep = _layout(K, n_classes, c)
+    # row t of bounded[strict][o] is roots[o] truncated after degree t (before
+    # degree t if strict)
+    bounded = {
+        strict: [mask * root[: K + 1] for root in roots]
+        for strict, mask in masks.items()
+    }
+    weights = np.zeros((K + 1, n_classes))
+
+    # c wins with m votes iff the classes of smaller label have at most m votes
+    # and the others fewer than m
+    others = [bounded[o > c][o] for o in range(n_classes) if o != c]
+    weights[:, c] = _product(others, K)[m, K - m]
+
+    # p wins against c with t votes iff c has fewer votes, or as many if p has
+    # the larger label
+    for p in range(n_classes):
+        if p == c:
+            continue
+        others = [bounded[o > p][o] for o in range(n_classes) if o not in (c, p)]
+        rest = _product(others, K)[m[None, :], degree] * keep[p]
+        weights[:, p] = rest.dot(roots[p][: K + 1])
+    return weights
+
+
+def count_votes(roots, K):
+    """Worlds predicting each class, see :func:`vote_weights`.
+
+    Return:
+        counts (np.array): worlds predicting the class at each position
+    """
+    return roots[0][: K + 1].dot(vote_weights(roots, K, 0))
@@ -1,20 +1,28 @@
 """Solution to three queriers for general classifier."""
+
+import logging
 import os
+import tempfile
 import time
 from collections import Counter
 from copy import deepcopy
 
 import numpy as np
-import pandas as pd
 
+from .algorithm.distance import CHUNK_BYTES, compute_similarities
+from .algorithm.min_max import IncrementalMinMax
+from .algorithm.select import LazyGreedy
+from .events import EventLog, IterationEvent
 from .query import Querier
+from .utils import (
+    PHASE_TIMES,
+    SimilaritySpace,
+    WorkerPool,
+    as_space,
+    min_max_similarities,
+)
 
-
-def compute_distances(X_train, X_test):
-    dists = np.array(
-        [np.sqrt(np.sum((X_train - x_test) ** 2, axis=1)) for x_test in X_test]
-    )
-    return dists
+_log = logging.getLogger(__name__)
 
 
 def majority_vote(A):
@@ -35,8 +43,7 @@ class KNN(object):
         self.y_train = y_train
 
     def predict(self, X_test):
-        dists = compute_distances(self.X_train, X_test)
-        self.sim = 1 / (1 + dists)
+        self.sim = compute_similarities(self.X_train, X_test)
         order = np.argsort(-self.sim, kind="stable", axis=1)
         top_K_idx = order[:, : self.K]
         top_K = self.y_train[top_K_idx]
@@ -52,57 +59,117 @@ class KNN(object):
 class CPClean(object):
     """docstring for CPClean."""
 
-    def __init__(self, K=3, n_jobs=4, random_state=1):
+    def __init__(
+        self,
+        K=3,
+        n_jobs=4,
+        random_state=1,
+        dtype=np.float64,
+        max_memory=CHUNK_BYTES,
+        mmap_dir=None,
+        counter=None,
+    ):
         """Constructor.
 
         Args:
             K (int): KNN n_neighbors.
             random_state (int): random seed.
             n_jobs (int): number of cpu workers.
+            dtype: dtype of the similarities, np.float32 halves their memory.
+            max_memory (int): bytes of temporaries make_space may use at once, it
+                processes as many validation points at a time as fit in them.
+            mmap_dir (str): directory in which make_space creates memory-mapped
+                files for the similarities, which then need not fit in memory.
+                Defaults to None, in which case they are kept in memory.
+            counter (MonteCarloCounter): estimates the counts of worlds by
+                sampling, for repair spaces too large to count exactly, binary
+                labels only. Defaults to None, in which case they are counted
+                exactly.
         """
         self.K = K
         self.random_state = random_state
         self.n_jobs = n_jobs
+        self.dtype = dtype
+        self.max_memory = max_memory
+        self.mmap_dir = mmap_dir
+        self.counter = counter
 
     def make_space(self, X_train_repairs, X_val, gt=None):
-        sim = np.array(
-            [self.compute_similarity(X_train, X_val) for X_train in X_train_repairs]
-        )  # shape (#repair, #val, #train)
-        space_sim = np.transpose(sim, (2, 0, 1))  # shape (#train, #repair, #val)
+        """Build the candidates of each training row and their similarities to the
+        validation points.
+
+        Similarities are computed once for each distinct candidate, so only once
+        for the rows on which all repairs agree. Validation points are processed
+        in chunks that fit in max_memory, and written to buffers that are
+        memory-mapped if mmap_dir is set.
+
+        Return:
+            space (list of np.array): distinct candidates of each row
+            S_val (SimilaritySpace): similarities of the candidates of each row
+                to each validation point
+            gt_indices (list): index of the ground truth among the candidates
+            MM (np.array): #val x #train x 2 min and max similarity of each row,
+                the same array as S_val.MM
+        """
         space_X = np.transpose(
             X_train_repairs, (1, 0, 2)
         )  # shape (#row, #repair, #column)
-        MM = np.array([sim.min(axis=0), sim.max(axis=0)]).transpose(1, 2, 0)
-
-        space_X = np.around(space_X, decimals=12)
+        space_X_rounded = np.around(space_X, decimals=12)
         gt = np.around(gt, decimals=12)
 
+        # rows on which all repairs agree have a single candidate
+        is_dirty = (space_X_rounded != space_X_rounded[:, :1]).any(axis=(1, 2))
+
         space = []
         gt_indices = []
-        S_val_t = []
-        for X, X_gt, S in zip(space_X, gt, space_sim):
-            X_unique, X_indices = np.unique(X, axis=0, return_index=True)
-            S_unique = S[X_indices]
+        candidates = []
+        lengths = []
+        for X, X_rounded, X_gt, dirty in zip(space_X, space_X_rounded, gt, is_dirty):
+            if dirty:
+                X_unique, X_indices = np.unique(X_rounded, axis=0, return_index=True)
+            else:
+                X_unique, X_indices = X_rounded[:1], np.zeros(1, dtype=int)
             gt_id = np.argwhere((X_unique == X_gt).all(axis=1))[0, 0]
             space.append(X_unique)
-            S_val_t.append(S_unique)
+            candidates.append(X[X_indices])
+            lengths.append(len(X_indices))
             gt_indices.append(gt_id)
 
-        S_val = []
-        for i in range(len(X_val)):
-            s_val = [S[:, i] for S in S_val_t]
-            S_val.append(s_val)
-
+        candidates = np.concatenate(candidates)
+        lengths = np.array(lengths)
+        starts = np.cumsum(lengths) - lengths
+
+        # shape (#val, #candidate), the candidates of each row are contiguous
+        mmap_dir = None
+        if self.mmap_dir is not None:
+            os.makedirs(self.mmap_dir, exist_ok=True)
+            mmap_dir = tempfile.mkdtemp(prefix="space-", dir=self.mmap_dir)
+        sim = self._buffer(mmap_dir, "S_val", (len(X_val), len(candidates)))
+        MM = self._buffer(mmap_dir, "MM", (len(X_val), len(lengths), 2))
+
+        # the similarities of a chunk, and about 4 temporaries per row for its MM
+        val_bytes = np.dtype(self.dtype).itemsize * (len(candidates) + 4 * len(lengths))
+        chunk_size = max(self.max_memory // val_bytes, 1)
+        for start in range(0, len(X_val), chunk_size):
+            end = start + chunk_size
+            self.compute_similarity(candidates, X_val[start:end], out=sim[start:end])
+            min_max_similarities(sim[start:end], starts, lengths, out=MM[start:end])
+
+        S_val = SimilaritySpace(sim, lengths, MM=MM)
         return space, S_val, gt_indices, MM
 
-    def compute_similarity(self, X_train, X_val):
-        S_val = np.array(
-            [
-                1 / (1 + np.sqrt(np.sum((X_train - x_val) ** 2, axis=1)))
-                for x_val in X_val
-            ]
+    def _buffer(self, mmap_dir, name, shape):
+        if mmap_dir is None:
+            return np.empty(shape, dtype=self.dtype)
+        return np.lib.format.open_memmap(
+            os.path.join(mmap_dir, name + ".npy"),
+            mode="w+",
+            dtype=self.dtype,
+            shape=shape,
         )
-        return S_val
+
+    def compute_similarity(self, X_train, X_val, out=None):
+        return compute_similarities(X_train, X_val, dtype=self.dtype, out=out)
 
     def fit(
         self,
@@ -127,9 +194,15 @@ class CPClean(object):
             gt (np.array): the ground truth index in each row.
         """
         space, S_val, gt_indices, MM = self.make_space(X_train_repairs, X_val, gt=gt)
-        if method == "cpclean":
+        if method in ["cpclean", "lazy_cpclean"]:
             selection = self.clean(
-                S_val, y_train, gt_indices, MM, debugger=debugger, restore=restore
+                S_val,
+                y_train,
+                gt_indices,
+                MM,
+                debugger=debugger,
+                restore=restore,
+                lazy=method == "lazy_cpclean",
             )
         elif method == "sample_cpclean":
             selection = self.sample_cpclean(
@@ -163,121 +236,280 @@ class CPClean(object):
     def score(self, X_test, y_test):
         return self.classifier.score(X_test, y_test)
 
-    def restore_results(self, S_val_pruned, MM, debugger, gt_indices):
-        saved_results = pd.read_csv(
-            os.path.join(debugger.debug_dir, "details_restore.csv")
-        )
-        selection = saved_results["selection"].values[1:-2].astype(int).tolist()
+    def restore_results(self, S_val_pruned, debugger, gt_indices, path=None):
+        """Clean the rows selected by an interrupted run again, replaying its log
+        one record at a time.
 
-        for i in range(len(S_val_pruned)):
-            for sel in selection:
-                S_val_pruned[i][sel] = [S_val_pruned[i][sel][gt_indices[sel]]]
-                MM[i][sel] = [S_val_pruned[i][sel][0], S_val_pruned[i][sel][0]]
+        Args:
+            path (str): the log of the run, an event log of :meth:`clean` or the
+                details.csv of a Debugger. Defaults to details_restore.csv in the
+                directory of the debugger.
 
-        percent_cc = saved_results["percent_cc"].values[0]
-        debugger.init_log(percent_cc)
-        sel_times = saved_results["time"].values[1:-2].tolist()
-        percent_ccs = saved_results["percent_cc"].values[1:-2].tolist()
+        Return:
+            selection (list), n_iter (int): the selected rows and the next
+                iteration
+        """
+        if path is None:
+            path = os.path.join(debugger.debug_dir, "details_restore.csv")
 
+        selection = []
         n_iter = 1
-        for sel, sel_time, percent_cc in zip(selection, sel_times, percent_ccs):
-            debugger.log(n_iter, sel, sel_time, percent_cc)
+        for record in EventLog.read(path):
+            event = IterationEvent.from_record(record)
+            if event.selection is None:
+                # the state before cleaning
+                if debugger is not None:
+                    debugger.init_log(event.percent_cc)
+                continue
+
+            S_val_pruned.collapse(event.selection, gt_indices[event.selection])
+            if debugger is not None:
+                debugger.log(n_iter, event.selection, event.time, event.percent_cc)
+            selection.append(event.selection)
             n_iter += 1
         return selection, n_iter
 
-    def clean(self, S_val, y_train, gt_indices, MM=None, debugger=None, restore=False):
-        S_val_pruned = deepcopy(S_val)
+    def clean(
+        self,
+        S_val,
+        y_train,
+        gt_indices,
+        MM=None,
+        debugger=None,
+        restore=False,
+        lazy=False,
+        batch_size=1,
+        gain_ratio=0.0,
+        budget=None,
+        event_log=None,
+    ):
+        """Greedily clean the row with the largest information gain until every
+        validation point is CP'ed.
+
+        With lazy=True, rows are selected with LazyGreedy, which only evaluates
+        the rows whose gain at a previous iteration could beat the best one.
+        With batch_size > 1, up to batch_size complementary rows are cleaned per
+        counting pass (see select_batch), which trades a little selection quality
+        for fewer passes.
+
+        Args:
+            budget (int): stop after cleaning this many rows. Defaults to None.
+            event_log (str): path of the log of the iterations (IterationEvent,
+                see EventLog), which restore continues. It also counts the rows
+                evaluated by the lazy selection. Defaults to None, in which case
+                the iterations are logged with the logging module.
+        """
+        # cleaning collapses rows of the copy, the values themselves are shared
+        S_val_pruned = as_space(S_val, MM).copy()
+        n_val = len(S_val_pruned)
         selection = []
         n_iter = 1
 
         if restore:
             selection, n_iter = self.restore_results(
-                S_val_pruned, MM, debugger, gt_indices
+                S_val_pruned, debugger, gt_indices, path=event_log
             )
-
-        init_querier = Querier(
-            self.K,
-            S_val_pruned,
-            y_train,
-            n_jobs=self.n_jobs,
-            random_state=self.random_state,
-        )
-        q1_results_pruned, _, before_entropy_pruned = init_querier.run_q1q2(MM=MM)
-        MM_pruned = MM
-
-        percent_cc = q1_results_pruned.mean()
-
-        if not restore and debugger is not None:
-            debugger.init_log(percent_cc)
-
-        while True:
-            tic = time.time()
-
-            # prune
-            non_cp_idx = np.argwhere(q1_results_pruned == False).ravel()  # noqa: E712
-            S_val_pruned = [S_val_pruned[i] for i in non_cp_idx]
-            before_entropy_pruned = before_entropy_pruned[non_cp_idx]
-            MM_pruned = [MM_pruned[i] for i in non_cp_idx]
-
-            if len(S_val_pruned) == 0:
-                break
-
-            # select
-            querier = Querier(
+        n_cleaned = len(set(selection))
+        events = None if event_log is None else EventLog(event_log, append=restore)
+
+        # the workers receive the similarities once and then only the cleaned rows
+        pool = WorkerPool(S_val_pruned, y_train, n_jobs=self.n_jobs)
+        val_indices = np.arange(n_val)
+        selector = LazyGreedy() if lazy else None
+        # rows whose gain was evaluated, and that an exact greedy would evaluate
+        n_evaluated = n_exact = 0
+        try:
+            init_querier = Querier(
                 self.K,
                 S_val_pruned,
                 y_train,
                 n_jobs=self.n_jobs,
                 random_state=self.random_state,
+                counter=self.counter,
+                pool=pool,
             )
-            sel, after_entropy_pruned = querier.run_q3_select(
-                before_entropy_val=before_entropy_pruned, MM=MM_pruned
-            )
-
-            if sel is None:
-                break
+            # the first selection reuses the after entropies of the initial scan,
+            # except for lazy selection which only evaluates some of the rows
+            after_entropy_pruned = None
+            if lazy:
+                q1_results_pruned, _, before_entropy_pruned = init_querier.run_q1q2()
+            else:
+                (
+                    q1_results_pruned,
+                    _,
+                    before_entropy_pruned,
+                    after_entropy_pruned,
+                ) = init_querier.run_q1q2(return_after_entropy=True)
+            # after a row is cleaned, q1 is only evaluated again where it can change
+            q1 = IncrementalMinMax(S_val_pruned.MM, y_train, self.K)
+
+            percent_cc = q1_results_pruned.mean()
+
+            if not restore and debugger is not None:
+                debugger.init_log(percent_cc)
+            if not restore and events is not None:
+                events.write(
+                    IterationEvent(
+                        0,
+                        percent_cc=percent_cc,
+                        n_val=n_val,
+                        n_workers=pool.n_workers,
+                    )
+                )
 
-            # update selection
-            for i in range(len(S_val_pruned)):
-                S_val_pruned[i][sel] = [S_val_pruned[i][sel][gt_indices[sel]]]
-                selection.append(sel)
+            while True:
+                tic = time.time()
+                # seconds spent in each phase during the iteration
+                busy_time, phase_times = pool.busy_time, pool.phase_times.copy()
+                main_times = PHASE_TIMES.copy()
+                q1_time = 0.0
+
+                # prune
+                q1_tic = time.perf_counter()
+                non_cp_idx = np.flatnonzero(~q1_results_pruned)
+                q1 = q1.take(non_cp_idx)
+                S_val_pruned = S_val_pruned.take(non_cp_idx)
+                before_entropy_pruned = before_entropy_pruned[non_cp_idx]
+                val_indices = val_indices[non_cp_idx]
+                if after_entropy_pruned is not None:
+                    after_entropy_pruned = [after_entropy_pruned[i] for i in non_cp_idx]
+                q1_time += time.perf_counter() - q1_tic
+
+                if len(S_val_pruned) == 0 or (
+                    budget is not None and n_cleaned >= budget
+                ):
+                    break
+
+                # select
+                querier = Querier(
+                    self.K,
+                    S_val_pruned,
+                    y_train,
+                    n_jobs=self.n_jobs,
+                    random_state=self.random_state,
+                    counter=self.counter,
+                    pool=pool,
+                    val_indices=val_indices,
+                )
+                n_dirty = len(S_val_pruned.dirty_rows)
+                if batch_size > 1:
+                    sels, after_entropy_sels = querier.run_q3_select(
+                        method="batch",
+                        before_entropy_val=before_entropy_pruned,
+                        batch_size=batch_size,
+                        gain_ratio=gain_ratio,
+                        after_entropy_val=after_entropy_pruned,
+                    )
+                else:
+                    sel, after_entropy_sel = querier.run_q3_select(
+                        method="lazy" if lazy else "cpclean",
+                        before_entropy_val=before_entropy_pruned,
+                        selector=selector,
+                        after_entropy_val=after_entropy_pruned,
+                    )
+                    sels = [] if sel is None else [sel]
+                    after_entropy_sels = [after_entropy_sel]
+                after_entropy_pruned = None
+                if selector is None:
+                    n_evaluated += n_dirty
+                    n_exact += n_dirty
+                else:
+                    n_evaluated, n_exact = selector.n_evaluated, selector.n_exact
+
+                if budget is not None:
+                    sels = sels[: budget - n_cleaned]
+                if len(sels) == 0:
+                    break
+
+                # update selection, MM and q1
+                for sel in sels:
+                    q1_tic = time.perf_counter()
+                    q1_results_pruned = q1.collapse(
+                        sel, S_val_pruned.similarities(sel, gt_indices[sel])
+                    )
+                    S_val_pruned.collapse(sel, gt_indices[sel])
+                    q1_time += time.perf_counter() - q1_tic
+                    pool.clean(sel, gt_indices[sel])
+                    selection.extend([sel] * len(S_val_pruned))
+                n_cleaned += len(sels)
 
                 # update q2 result
-                if after_entropy_pruned[i] is not None:
-                    before_entropy_pruned[i] = after_entropy_pruned[i][gt_indices[sel]]
-
-                # update MM
-                MM_pruned[i][sel] = [S_val_pruned[i][sel][0], S_val_pruned[i][sel][0]]
-
-            # update q1
-            q1_results_pruned = querier.run_q1(MM=MM_pruned)
-
-            sel_time = time.time() - tic
-            # logging
-            percent_cc = (
-                len(S_val) - len(S_val_pruned) + sum(q1_results_pruned)
-            ) / len(S_val)
-            print(
-                "Iteration {}, time {}, selection {}, percent_cc {}".format(
-                    n_iter, sel_time, sel, percent_cc
-                )
-            )
+                if len(sels) == 1:
+                    for i, after_entropies in enumerate(after_entropy_sels[0]):
+                        if after_entropies is not None:
+                            before_entropy_pruned[i] = after_entropies[gt_indices[sel]]
+                else:
+                    # the entropies after cleaning several rows at once are unknown
+                    _, before_entropy_pruned = querier.run_q2(return_entropy=True)
+
+                sel_time = (time.time() - tic) / len(sels)
+                # logging
+                percent_cc = (
+                    n_val - len(S_val_pruned) + sum(q1_results_pruned)
+                ) / n_val
+                sort_time = pool.phase_times["sort"] - phase_times["sort"]
+                count_time = pool.busy_time - busy_time - sort_time
+                select_time = PHASE_TIMES["select"] - main_times["select"]
+                utilization = pool.utilization()
+                for sel in sels:
+                    if events is None:
+                        _log.info(
+                            "Iteration %d, time %s, selection %s, percent_cc %s, "
+                            "utilization %.2f",
+                            n_iter,
+                            sel_time,
+                            sel,
+                            percent_cc,
+                            utilization,
+                        )
+                    else:
+                        events.write(
+                            IterationEvent(
+                                n_iter,
+                                selection=int(sel),
+                                time=sel_time,
+                                percent_cc=percent_cc,
+                                n_val=len(S_val_pruned),
+                                n_workers=pool.n_workers,
+                                utilization=utilization,
+                                q1_time=q1_time / len(sels),
+                                sort_time=sort_time / len(sels),
+                                count_time=count_time / len(sels),
+                                select_time=select_time / len(sels),
+                                n_evaluated=n_evaluated,
+                                n_exact=n_exact,
+                            )
+                        )
+                    if debugger is not None:
+                        debugger.log(n_iter, sel, sel_time, percent_cc)
+
+                    n_iter += 1
+        finally:
+            # the log and the workers are closed even if an iteration raises, so
+            # that the run can be restored from the iterations logged so far
+            pool.close()
+            if events is not None:
+                events.close()
             if debugger is not None:
-                debugger.log(n_iter, sel, sel_time, percent_cc)
-
-            n_iter += 1
+                debugger.save_log()
 
+        if selector is not None and events is None:
+            _log.info(
+                "Lazy greedy evaluated %d rows, exact greedy %d",
+                selector.n_evaluated,
+                selector.n_exact,
+            )
         return selection
 
     def sample_cpclean(
         self, S_val, y_train, gt_indices, MM=None, debugger=None, sample_size=32
     ):
-        S_val = deepcopy(S_val)
+        S_val = as_space(S_val, MM).copy()
         init_querier = Querier(self.K, S_val, y_train, n_jobs=self.n_jobs)
         final_selection = []
 
         while True:
-            q1_results = init_querier.run_q1(MM=MM)
+            q1_results = init_querier.run_q1()
             non_cp_idx = np.argwhere(q1_results == False).ravel()  # noqa: E712
 
             if len(non_cp_idx) <= sample_size:
@@ -291,18 +523,35 @@ class CPClean(object):
             if len(sampled_idx) == 0:
                 break
 
-            S_val_sampled = [S_val[i] for i in sampled_idx]
-            MM_sampled = [MM[i] for i in sampled_idx]
             selection = self.clean(
-                S_val_sampled, y_train, gt_indices, MM=MM_sampled, debugger=debugger
+                S_val.take(sampled_idx), y_train, gt_indices, debugger=debugger
             )
 
             final_selection.extend(selection)
 
-            for sel in selection:
-                for i in range(len(S_val)):
-                    S_val[i][sel] = [S_val[i][sel][gt_indices[sel]]]
-                    MM[i][sel] = [S_val[i][sel][0], S_val[i][sel][0]]
+            # the selection repeats each row once per validation point
+            for sel in sorted(set(selection)):
+                S_val.collapse(sel, gt_indices[sel])
+
+    def _log_iteration(self, events, n_iter, sel, sel_time, percent_cc, n_val):
+        if events is None:
+            _log.info(
+                "Iteration %d, time %s, selection %s, percent_cc %s",
+                n_iter,
+                sel_time,
+                sel,
+                percent_cc,
+            )
+        else:
+            events.write(
+                IterationEvent(
+                    n_iter,
+                    selection=int(sel),
+                    time=sel_time,
+                    percent_cc=percent_cc,
+                    n_val=n_val,
+                )
+            )
 
     def sgd_cpclean(
         self,
@@ -313,136 +562,176 @@ class CPClean(object):
         debugger=None,
         restore=False,
         sample_size=32,
+        event_log=None,
     ):
-        S_val_pruned = deepcopy(S_val)
+        """Clean the row with the largest information gain over a sample of the
+        validation points that are not CP'ed, until every one of them is.
+
+        Args:
+            event_log (str): path of the log of the iterations (IterationEvent,
+                see EventLog). Defaults to None, in which case the iterations are
+                logged with the logging module.
+        """
+        S_val_pruned = as_space(S_val, MM).copy()
+        n_val = len(S_val_pruned)
         selection = []
         n_iter = 1
+        events = None if event_log is None else EventLog(event_log, append=False)
 
-        init_querier = Querier(
-            self.K,
-            S_val_pruned,
-            y_train,
-            n_jobs=self.n_jobs,
-            random_state=self.random_state,
-        )
-        q1_results_pruned = init_querier.run_q1(MM=MM)
-        MM_pruned = MM
-
-        percent_cc = q1_results_pruned.mean()
-        debugger.init_log(percent_cc)
-
-        while True:
-            tic = time.time()
-
-            # prune
-            non_cp_idx = np.argwhere(q1_results_pruned == False).ravel()  # noqa: E712
-            S_val_pruned = [S_val_pruned[i] for i in non_cp_idx]
-            MM_pruned = [MM_pruned[i] for i in non_cp_idx]
-            n_non_cp_val = len(S_val_pruned)
-
-            if n_non_cp_val == 0:
-                break
-
-            # sample
-            if n_non_cp_val < sample_size:
-                sampled_idx = np.arange(n_non_cp_val)
-            else:
-                np.random.seed(n_iter)
-                sampled_idx = np.random.choice(
-                    n_non_cp_val, size=sample_size, replace=False
-                )
-
-            S_val_sampled = [S_val_pruned[i] for i in sampled_idx]
-            MM_sampled = [MM_pruned[i] for i in sampled_idx]
-
-            # select
-            querier = Querier(
+        pool = WorkerPool(S_val_pruned, y_train, n_jobs=self.n_jobs)
+        val_indices = np.arange(n_val)
+        try:
+            init_querier = Querier(
                 self.K,
-                S_val_sampled,
+                S_val_pruned,
                 y_train,
                 n_jobs=self.n_jobs,
                 random_state=self.random_state,
+                counter=self.counter,
             )
-            sel, _ = querier.run_q3_select(MM=MM_sampled)
-
-            # update selection
-            for i in range(len(S_val_pruned)):
-                S_val_pruned[i][sel] = [S_val_pruned[i][sel][gt_indices[sel]]]
-                selection.append(sel)
-                # update MM
-                MM_pruned[i][sel] = [S_val_pruned[i][sel][0], S_val_pruned[i][sel][0]]
-
-            # update q1
-            q1_results_pruned = querier.run_q1(MM=MM_pruned)
-
-            sel_time = time.time() - tic
-
-            # logging
-            percent_cc = (
-                len(S_val) - len(S_val_pruned) + sum(q1_results_pruned)
-            ) / len(S_val)
-            print(
-                "Iteration {}, time {}, selection {}, percent_cc {}".format(
-                    n_iter, sel_time, sel, percent_cc
-                )
-            )
-            debugger.log(n_iter, sel, sel_time, percent_cc)
+            q1_results_pruned = init_querier.run_q1()
 
-            n_iter += 1
-
-        return selection
+            percent_cc = q1_results_pruned.mean()
+            if debugger is not None:
+                debugger.init_log(percent_cc)
+            if events is not None:
+                events.write(IterationEvent(0, percent_cc=percent_cc, n_val=n_val))
+
+            while True:
+                tic = time.time()
+
+                # prune
+                non_cp_idx = np.argwhere(
+                    q1_results_pruned == False  # noqa: E712
+                ).ravel()
+                S_val_pruned = S_val_pruned.take(non_cp_idx)
+                val_indices = val_indices[non_cp_idx]
+                n_non_cp_val = len(S_val_pruned)
+
+                if n_non_cp_val == 0:
+                    break
+
+                # sample
+                if n_non_cp_val < sample_size:
+                    sampled_idx = np.arange(n_non_cp_val)
+                else:
+                    np.random.seed(n_iter)
+                    sampled_idx = np.random.choice(
+                        n_non_cp_val, size=sample_size, replace=False
+                    )
+
+                # select
+                querier = Querier(
+                    self.K,
+                    S_val_pruned.take(sampled_idx),
+                    y_train,
+                    n_jobs=self.n_jobs,
+                    random_state=self.random_state,
+                    counter=self.counter,
+                    pool=pool,
+                    val_indices=val_indices[sampled_idx],
+                )
+                sel, _ = querier.run_q3_select()
 
-    def random_clean(self, S_val, y_train, gt_indices, MM=None, debugger=None):
-        S_val_pruned = deepcopy(S_val)
+                # update selection and MM
+                S_val_pruned.collapse(sel, gt_indices[sel])
+                pool.clean(sel, gt_indices[sel])
+                selection.extend([sel] * n_non_cp_val)
 
-        init_querier = Querier(
-            self.K, S_val, y_train, n_jobs=self.n_jobs, random_state=self.random_state
-        )
-        q1_results_pruned = init_querier.run_q1(MM=MM)
-        MM_pruned = MM
+                # update q1
+                q1_results_pruned = querier.run_q1(MM=S_val_pruned.MM)
 
-        percent_cc = q1_results_pruned.mean()
-        debugger.init_log(percent_cc)
+                sel_time = time.time() - tic
 
-        np.random.seed(self.random_state)
-        select = [i for i, x in enumerate(S_val[0]) if len(x) > 1]
-        np.random.shuffle(select)
+                # logging
+                percent_cc = (n_val - n_non_cp_val + sum(q1_results_pruned)) / n_val
+                self._log_iteration(
+                    events, n_iter, sel, sel_time, percent_cc, n_non_cp_val
+                )
+                if debugger is not None:
+                    debugger.log(n_iter, sel, sel_time, percent_cc)
+
+                n_iter += 1
+        finally:
+            pool.close()
+            if events is not None:
+                events.close()
+            if debugger is not None:
+                debugger.save_log()
+        return selection
 
-        selection = []
-        n_iter = 1
+    def random_clean(
+        self, S_val, y_train, gt_indices, MM=None, debugger=None, event_log=None
+    ):
+        """Clean the dirty rows in a random order until every validation point is
+        CP'ed.
 
-        for sel in select:
-            tic = time.time()
-            # prune
-            non_cp_idx = np.argwhere(q1_results_pruned == False).ravel()  # noqa: E712
-            S_val_pruned = [S_val_pruned[i] for i in non_cp_idx]
-            MM_pruned = [MM_pruned[i] for i in non_cp_idx]
+        Args:
+            event_log (str): path of the log of the iterations (IterationEvent,
+                see EventLog). Defaults to None, in which case the iterations are
+                logged with the logging module.
+        """
+        S_val_pruned = as_space(S_val, MM).copy()
+        n_val = len(S_val_pruned)
+        events = None if event_log is None else EventLog(event_log, append=False)
 
-            if len(S_val_pruned) == 0:
-                break
+        try:
+            init_querier = Querier(
+                self.K,
+                S_val_pruned,
+                y_train,
+                n_jobs=self.n_jobs,
+                random_state=self.random_state,
+                counter=self.counter,
+            )
+            q1_results_pruned = init_querier.run_q1()
 
-            # update selection
-            for i in range(len(S_val_pruned)):
-                S_val_pruned[i][sel] = [S_val_pruned[i][sel][gt_indices[sel]]]
-                selection.append(sel)
-
-                # update MM
-                MM_pruned[i][sel] = [S_val_pruned[i][sel][0], S_val_pruned[i][sel][0]]
-
-            # update q1
-            q1_results_pruned = init_querier.run_q1(MM=MM_pruned)
-
-            sel_time = time.time() - tic
-            # logging
-            percent_cc = (
-                len(S_val) - len(S_val_pruned) + sum(q1_results_pruned)
-            ) / len(S_val)
-            print(
-                "Iteration {}, time {}, selection {}, percent_cc {}".format(
-                    n_iter, sel_time, sel, percent_cc
+            percent_cc = q1_results_pruned.mean()
+            if debugger is not None:
+                debugger.init_log(percent_cc)
+            if events is not None:
+                events.write(IterationEvent(0, percent_cc=percent_cc, n_val=n_val))
+
+            np.random.seed(self.random_state)
+            select = S_val_pruned.dirty_rows
+            np.random.shuffle(select)
+
+            selection = []
+            n_iter = 1
+
+            for sel in select:
+                tic = time.time()
+                # prune
+                non_cp_idx = np.argwhere(
+                    q1_results_pruned == False  # noqa: E712
+                ).ravel()
+                S_val_pruned = S_val_pruned.take(non_cp_idx)
+
+                if len(S_val_pruned) == 0:
+                    break
+
+                # update selection and MM
+                S_val_pruned.collapse(sel, gt_indices[sel])
+                selection.extend([sel] * len(S_val_pruned))
+
+                # update q1
+                q1_results_pruned = init_querier.run_q1(MM=S_val_pruned.MM)
+
+                sel_time = time.time() - tic
+                # logging
+                percent_cc = (
+                    n_val - len(S_val_pruned) + sum(q1_results_pruned)
+                ) / n_val
+                self._log_iteration(
+                    events, n_iter, sel, sel_time, percent_cc, len(S_val_pruned)
                 )
-            )
-            debugger.log(n_iter, sel, sel_time, percent_cc)
+                if debugger is not None:
+                    debugger.log(n_iter, sel, sel_time, percent_cc)
 
-            n_iter += 1
+                n_iter += 1
+        finally:
+            if events is not None:
+                events.close()
+            if debugger is not None:
+                debugger.save_log()
         return selection
@@ -1,19 +1,39 @@
 from copy import deepcopy
 
-import pandas as pd
-import utils
-
+from .events import EventLog
 from .knn_evaluator import KNNEvaluator
+from .utils import makedir
 
 
 class Debugger(object):
-    """docstring for Debugger."""
+    """Accuracy of the KNN on the partially cleaned training set, logged to
+    details.csv in debug_dir after every selection.
+
+    Rows are appended to the log in batches of buffer_size, :meth:`save_log`
+    writes the pending ones.
+    """
 
-    def __init__(self, data, model, debug_dir):
+    columns = [
+        "n_iter",
+        "n_val",
+        "selection",
+        "time",
+        "percent_cc",
+        "percent_clean",
+        "clean_val_acc",
+        "gt_val_acc",
+        "mean_val_acc",
+        "clean_test_acc",
+        "gt_test_acc",
+        "mean_test_acc",
+    ]
+
+    def __init__(self, data, model, debug_dir, buffer_size=16):
         self.data = deepcopy(data)
         self.K = model["params"]["n_neighbors"]
         self.debug_dir = debug_dir
-        self.logging = []
+        self.buffer_size = buffer_size
+        self.event_log = None
         self.n_dirty = self.data["X_train_mv"].isnull().values.any(axis=1).sum()
         self.n_val = len(self.data["X_val"])
 
@@ -25,6 +45,7 @@ class Debugger(object):
             self.data["y_val"],
             self.data["X_test"],
             self.data["y_test"],
+            K=self.K,
         ).score()
         self.gt_val_acc, self.gt_test_acc = KNNEvaluator(
             self.data["X_train_gt"],
@@ -33,21 +54,29 @@ class Debugger(object):
             self.data["y_val"],
             self.data["X_test"],
             self.data["y_test"],
+            K=self.K,
         ).score()
         self.X_train_mean = deepcopy(self.data["X_train_repairs"]["mean"])
         self.selection = []
 
-        self.logging = []
-        mean_val_acc, mean_test_acc = KNNEvaluator(
+        self.event_log = EventLog(
+            makedir([self.debug_dir], "details.csv"),
+            buffer_size=self.buffer_size,
+            append=False,
+        )
+        # kept up to date as rows are cleaned, see KNNEvaluator.update
+        self.mean_evaluator = KNNEvaluator(
             self.X_train_mean,
             self.data["y_train"],
             self.data["X_val"],
             self.data["y_val"],
             self.data["X_test"],
             self.data["y_test"],
-        ).score()
+            K=self.K,
+        )
+        mean_val_acc, mean_test_acc = self.mean_evaluator.score()
 
-        self.logging.append(
+        self.write(
             [
                 0,
                 self.n_val,
@@ -65,23 +94,13 @@ class Debugger(object):
         )
         self.save_log()
 
+    def write(self, row):
+        self.event_log.write(dict(zip(self.columns, row)))
+
     def save_log(self):
-        columns = [
-            "n_iter",
-            "n_val",
-            "selection",
-            "time",
-            "percent_cc",
-            "percent_clean",
-            "clean_val_acc",
-            "gt_val_acc",
-            "mean_val_acc",
-            "clean_test_acc",
-            "gt_test_acc",
-            "mean_test_acc",
-        ]
-        logging_save = pd.DataFrame(self.logging, columns=columns)
-        logging_save.to_csv(utils.makedir([self.debug_dir], "details.csv"), index=False)
+        """Write the pending rows to details.csv."""
+        if self.event_log is not None:
+            self.event_log.flush()
 
     def log(self, n_iter, sel, sel_time, percent_cc):
         self.selection.append(sel)
@@ -89,16 +108,10 @@ class Debugger(object):
         percent_clean = len(self.selection) / self.n_dirty
         self.X_train_mean[sel] = self.data["X_train_gt"][sel]
 
-        mean_val_acc, mean_test_acc = KNNEvaluator(
-            self.X_train_mean,
-            self.data["y_train"],
-            self.data["X_val"],
-            self.data["y_val"],
-            self.data["X_test"],
-            self.data["y_test"],
-        ).score()
+        self.mean_evaluator.update(sel, self.X_train_mean[sel])
+        mean_val_acc, mean_test_acc = self.mean_evaluator.score()
 
-        self.logging.append(
+        self.write(
             [
                 n_iter,
                 self.n_val,
@@ -116,4 +129,3 @@ class Debugger(object):
         )
 
         self.percent_clean = percent_clean
-        self.save_log()
@@ -0,0 +1,138 @@
+"""Append-only log of the iterations of a cleaning run.
+
+Records are buffered and appended to a JSON lines (.jsonl) or CSV (.csv) file, so
+that logging an iteration never rewrites the log. They are read back one at a
+time, e.g. to restore an interrupted run (CPClean.restore_results).
+"""
+import csv
+import json
+import os
+from dataclasses import asdict, dataclass, fields, is_dataclass
+from typing import Optional
+
+import numpy as np
+
+_INT_FIELDS = ("n_iter", "selection", "n_val", "n_workers", "n_evaluated", "n_exact")
+
+
+@dataclass
+class IterationEvent:
+    """An iteration of CPClean.clean, one per selected row.
+
+    The first event of a run (n_iter 0) has no selection and holds the state
+    before cleaning. Times are in seconds per selected row: q1 and select are
+    spent in the main process, sort and count by the workers, summed over them.
+    n_evaluated counts the rows whose information gain was evaluated since the
+    start of the run, and n_exact those an exact greedy selection evaluates,
+    which only differ with lazy selection.
+    """
+
+    n_iter: int
+    selection: Optional[int] = None
+    time: float = 0.0
+    percent_cc: float = 0.0
+    n_val: int = 0
+    n_workers: int = 1
+    utilization: float = 1.0
+    q1_time: float = 0.0
+    sort_time: float = 0.0
+    count_time: float = 0.0
+    select_time: float = 0.0
+    n_evaluated: int = 0
+    n_exact: int = 0
+
+    @classmethod
+    def from_record(cls, record):
+        """Event of a record read by :meth:`EventLog.read`. Values of CSV records
+        are strings, missing or empty ones take the defaults."""
+        values = {}
+        for field in fields(cls):
+            value = record.get(field.name)
+            if value is None or value == "":
+                continue
+            kind = int if field.name in _INT_FIELDS else float
+            values[field.name] = kind(float(value))
+        return cls(**values)
+
+
+def _to_python(value):
+    # numpy scalars, e.g. a selected row or percent_cc
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+class EventLog(object):
+    """Buffered append-only sink of records.
+
+    .. code-block:: python
+
+        with EventLog("events.jsonl") as log:
+            log.write(IterationEvent(n_iter=1, selection=sel, time=sel_time))
+        events = [IterationEvent.from_record(r) for r in EventLog.read(path)]
+
+    Args:
+        path (str): a .csv file, whose columns are the fields of the first record
+            written to it, or a JSON lines file otherwise
+        buffer_size (int): number of records kept in memory before they are
+            appended to the file
+        append (bool): keep the records already in the file, otherwise it is
+            emptied
+    """
+
+    def __init__(self, path, buffer_size=64, append=True):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.is_csv = path.endswith(".csv")
+        self._buffer = []
+        self._columns = None
+
+        if not append or not os.path.exists(path):
+            open(path, "w").close()
+        elif self.is_csv:
+            with open(path, newline="") as f:
+                self._columns = next(csv.reader(f), None)
+
+    def write(self, record):
+        """Append a record, a dict or an IterationEvent."""
+        if is_dataclass(record):
+            record = asdict(record)
+        self._buffer.append(record)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        if len(self._buffer) == 0:
+            return
+        with open(self.path, "a", newline="") as f:
+            if self.is_csv:
+                if self._columns is None:
+                    self._columns = list(self._buffer[0])
+                    csv.writer(f).writerow(self._columns)
+                writer = csv.DictWriter(f, self._columns, extrasaction="ignore")
+                writer.writerows(self._buffer)
+            else:
+                for record in self._buffer:
+                    f.write(json.dumps(record, default=_to_python) + "\n")
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def read(path):
+        """Iterate over the records of a log (dicts), one at a time."""
+        with open(path, newline="") as f:
+            if path.endswith(".csv"):
+                yield from csv.DictReader(f)
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
@@ -1,11 +1,6 @@
 import numpy as np
 
-
-def compute_distances(X_train, X_test):
-    dists = np.array(
-        [np.sqrt(np.sum((X_train - x_test) ** 2, axis=1)) for x_test in X_test]
-    )
-    return dists
+from .algorithm.distance import compute_similarities
 
 
 def majority_vote(A):
@@ -14,31 +9,79 @@ def majority_vote(A):
 
 
 class KNNEvaluator(object):
-    """docstring for KNNEvaluator."""
+    """Accuracy of a KNN classifier on the validation and test sets.
+
+    The similarities and the top K of every validation and test point are kept, so
+    that changing a training row (:meth:`update`) costs O(V + T) instead of
+    computing the similarities again. Only the points whose top K the row leaves
+    are sorted again.
+    """
 
     def __init__(self, X_train, y_train, X_val, y_val, X_test, y_test, K=3):
         super(KNNEvaluator).__init__()
-        dists_val = compute_distances(X_train, X_val)
-        dists_test = compute_distances(X_train, X_test)
-        self.sim_val = 1 / (1 + dists_val)
-        self.sim_test = 1 / (1 + dists_test)
+        self.sim_val = compute_similarities(X_train, X_val)
+        self.sim_test = compute_similarities(X_train, X_test)
         self.K = K
-        self.y_train = y_train
+        self.y_train = np.asarray(y_train)
         self.y_val = y_val
         self.y_test = y_test
+        self.X_val = X_val
+        self.X_test = X_test
 
-    def predict(self, sim):
+        # top K of each point, most similar first, and the predictions
+        self.top_val = self.top_k(self.sim_val)
+        self.top_test = self.top_k(self.sim_test)
+        self.pred_val = self.vote(self.top_val)
+        self.pred_test = self.vote(self.top_test)
+
+    def top_k(self, sim):
+        """Indices of the K most similar training rows, ties go to the smaller
+        index."""
         order = np.argsort(-sim, kind="stable", axis=1)
-        top_K_idx = order[:, : self.K]
+        return order[:, : self.K]
+
+    def vote(self, top_K_idx):
         top_K = self.y_train[top_K_idx]
-        pred = np.array([majority_vote(top) for top in top_K])
-        return pred
+        return np.array([majority_vote(top) for top in top_K], dtype=int)
 
-    def score(self):
-        pred_val = self.predict(self.sim_val)
-        pred_test = self.predict(self.sim_test)
+    def predict(self, sim):
+        return self.vote(self.top_k(sim))
+
+    def update(self, row, x):
+        """Replace training row `row` by x and update the predictions."""
+        for X, sim, top, pred in [
+            (self.X_val, self.sim_val, self.top_val, self.pred_val),
+            (self.X_test, self.sim_test, self.top_test, self.pred_test),
+        ]:
+            new = compute_similarities(np.asarray(x)[None], X)[:, 0]
+            sim[:, row] = new
+
+            # the points the row is in the top K of are sorted again, the others
+            # only let it in if it beats their K-th row
+            was_top = np.flatnonzero((top == row).any(axis=1))
+            kth = top[:, -1]
+            kth_sim = sim[np.arange(len(sim)), kth]
+            enters = (new > kth_sim) | ((new == kth_sim) & (row < kth))
+            enters[was_top] = False
+            enters = np.flatnonzero(enters)
 
-        val_acc = (pred_val == self.y_val).mean()
-        test_acc = (pred_test == self.y_test).mean()
+            if len(enters) > 0:
+                candidates = np.concatenate(
+                    [top[enters, :-1], np.full((len(enters), 1), row)], axis=1
+                )
+                order = np.lexsort(
+                    (candidates, -np.take_along_axis(sim[enters], candidates, 1))
+                )
+                top[enters] = np.take_along_axis(candidates, order, 1)
+
+            changed = np.concatenate([was_top, enters])
+            if len(was_top) > 0:
+                top[was_top] = self.top_k(sim[was_top])
+            if len(changed) > 0:
+                pred[changed] = self.vote(top[changed])
+
+    def score(self):
+        val_acc = (self.pred_val == self.y_val).mean()
+        test_acc = (self.pred_test == self.y_test).mean()
 
         return val_acc, test_acc
@@ -1,10 +1,25 @@
 """Solution to three queriers for KNN classifier."""
+
+from functools import partial
+
 import numpy as np
 
-from .algorithm.min_max import min_max_val
-from .algorithm.select import min_entropy_expected, random_select
-from .algorithm.sort_count import sort_count_after_clean_multi, sort_count_dp_multi
-from .algorithm.utils import compute_entropy_by_counts
+from .algorithm.min_max import min_max_batch
+from .algorithm.select import (
+    avg_entropy_matrix,
+    entropy_expected,
+    min_entropy_expected,
+    random_select,
+    select_batch,
+)
+from .algorithm.sort_count import (
+    get_valid_indices,
+    map_val,
+    sort_count_after_clean,
+    sort_count_dp,
+)
+from .algorithm.utils import entropy_by_count_dicts
+from .utils import as_space, timed
 
 # from .algorithm.sort_count import
 
@@ -12,64 +27,188 @@ from .algorithm.utils import compute_entropy_by_counts
 class Querier(object):
     """docstring for Querier."""
 
-    def __init__(self, K, S_val, y_train, n_jobs=4, random_state=1):
+    def __init__(
+        self,
+        K,
+        S_val,
+        y_train,
+        n_jobs=4,
+        random_state=1,
+        pool=None,
+        val_indices=None,
+        counter=None,
+    ):
         """Constructor.
 
         Args:
             K (int): KNN hyper-parameter
-            space (list of list of np.array): each row contains a list of candidates
-            (repairs) for one example
+            S_val (SimilaritySpace): similarities of the candidates of each
+                training row to each validation point, or a list of list of
+                np.array
             y_train (np.array): labels of training set
             X_val (np.array): features of test set
             y_val (np.array): list of test set
             gt_indices (np.array): the ground truth index in each row
+            pool (WorkerPool): workers of the cleaning session, which hold the
+                similarities of the validation points. Defaults to None, in which
+                case workers are started for every query.
+            val_indices (list): the index in the pool of each validation point in
+                S_val. Defaults to None, in which case they are the same.
+            counter (MonteCarloCounter): estimates the worlds supporting each
+                label by sampling, binary labels only. Defaults to None, in which
+                case they are counted exactly.
         """
         self.K = K
-        self.S_val = S_val
+        self.S_val = as_space(S_val)
         self.y_train = y_train
         self.classes = list(set(y_train))
         self.n_jobs = n_jobs
         self.random_state = random_state
+        self.pool = pool
+        self.val_indices = (
+            list(range(len(S_val))) if val_indices is None else list(val_indices)
+        )
+        if counter is None:
+            self.sort_count = sort_count_dp
+            self.sort_count_after_clean = sort_count_after_clean
+        else:
+            # fail before any work is sent to the workers
+            counter.check_labels(y_train)
+            self.sort_count = counter.sort_count
+            self.sort_count_after_clean = counter.sort_count_after_clean
+
+    def map_val(self, fn, indices=None):
+        """Apply fn(S, y_train, K, mm=mm) to the validation points at the given
+        positions in S_val (all of them by default), with the workers of the pool
+        if there is one."""
+        indices = range(len(self.S_val)) if indices is None else indices
+        if self.pool is not None:
+            return self.pool.map(fn, self.K, [self.val_indices[i] for i in indices])
+
+        S_val = self.S_val.take(list(indices))
+        return map_val(fn, S_val, self.y_train, self.K, n_jobs=self.n_jobs)
+
+    def map_after_clean(self, fn, indices=None, rows=None):
+        """Apply an after-clean function fn(S, y_train, K, mm=mm, rows=rows), e.g.
+        sort_count_after_clean, like map_val.
+
+        With few validation points for the workers of the pool, which is common
+        late in the cleaning, the dirty rows of the points with the most work are
+        split across workers as well (see WorkerPool.map_parts). Each part scans
+        the point again but only
+        counts its own rows, which is where most of the time goes. Points are
+        split so that the parts get about the same share of the work, estimated
+        as the number of candidates times the number of dirty rows to count.
+
+        Args:
+            rows (list): the rows to count, defaults to all dirty rows
+        """
+        indices = list(range(len(self.S_val))) if indices is None else list(indices)
+        n_workers = 1 if self.pool is None else self.pool.n_workers
+        # with enough points, spreading them over the workers keeps them busy
+        if n_workers == 1 or len(indices) >= 4 * n_workers:
+            return self.map_val(fn if rows is None else partial(fn, rows=rows), indices)
+
+        lengths = self.S_val.lengths
+        parts, works = [], []
+        for i in indices:
+            valid_indices = get_valid_indices(self.S_val.mm(i), self.K)
+            dirty_rows = valid_indices[lengths[valid_indices] > 1]
+            if rows is not None:
+                dirty_rows = np.intersect1d(dirty_rows, rows)
+            parts.append(dirty_rows)
+            works.append(lengths[valid_indices].sum() * max(len(dirty_rows), 1))
+
+        fair_share = sum(works) / n_workers
+        n_parts = [
+            min(max(int(round(work / fair_share)), 1), max(len(dirty_rows), 1))
+            for work, dirty_rows in zip(works, parts)
+        ]
+        if max(n_parts) == 1 and len(indices) >= n_workers:
+            return self.map_val(fn if rows is None else partial(fn, rows=rows), indices)
+
+        tasks, costs, owners = [], [], []
+        for i, dirty_rows, n, work in zip(indices, parts, n_parts, works):
+            chunks = [rows] if n == 1 else np.array_split(dirty_rows, n)
+            for chunk in chunks:
+                tasks.append((self.val_indices[i], chunk))
+                costs.append(work / n)
+                owners.append(i)
+
+        results = {}
+        for i, result in zip(owners, self.pool.map_parts(fn, self.K, tasks, costs)):
+            if i not in results:
+                results[i] = result
+                continue
+            # the parts only differ in the rows they counted
+            after_entropies = result[1] if isinstance(result, tuple) else result
+            merged = results[i][1] if isinstance(result, tuple) else results[i]
+            for row, entropies in enumerate(after_entropies):
+                if entropies is not None:
+                    merged[row] = entropies
+        return [results[i] for i in indices]
 
     def run_q1(self, return_preds=False, MM=None):
         """Solution for q1.
 
         Return:
-            q1_results (list of boolean): for each example in test set, whether it can
-                be CP'ed.
+            q1_results (np.array of boolean): for each example in test set, whether it
+                can be CP'ed.
+            pred_sets (np.array): #val x C, whether a world may predict each label,
+                only if return_preds
         """
         if MM is None:
-            MM = []
-            for S in self.S_val:
-                mm = np.array([[min(s), max(s)] for s in S])
-                MM.append(mm)
+            MM = self.S_val.MM
 
-        q1_results, _, pred_sets = min_max_val(MM, self.y_train, self.K)
+        q1_results, pred_sets = min_max_batch(MM, self.y_train, self.K)
 
         if return_preds:
             return q1_results, pred_sets
         else:
             return q1_results
 
-    def run_q2(self, return_entropy=False, MM=None):
+    def run_q2(self, return_entropy=False):
         """Solution for q2.
 
         Return:
             results (list of dict): the number of worlds supporting each label for each
                 example in test set.
         """
-        q2_results = sort_count_dp_multi(
-            self.S_val, self.y_train, self.K, n_jobs=self.n_jobs, MM=MM
-        )
+        q2_results = self.map_val(self.sort_count)
         if return_entropy:
-            entropies_val = np.array(
-                [compute_entropy_by_counts(counts) for counts in q2_results]
-            )
+            entropies_val = entropy_by_count_dicts(q2_results)
             return q2_results, entropies_val
         else:
             return q2_results
 
-    def run_q1q2(self, MM=None, return_entropy=True):
+    def run_q2q3(self, indices=None):
+        """Solution for q2 and the after entropies of q3 in a single scan of each
+        validation point.
+
+        Args:
+            indices (list): positions in S_val of the validation points, defaults
+                to all of them
+
+        Return:
+            q2_results (list of dict): see run_q2
+            entropies_val (np.array): entropy of each validation point
+            after_entropy_val (list): see run_q3_select
+        """
+        results = self.map_after_clean(
+            partial(self.sort_count_after_clean, return_counts=True), indices
+        )
+        q2_results = [counts for counts, _ in results]
+        entropies_val = entropy_by_count_dicts(q2_results)
+        return q2_results, entropies_val, [ae for _, ae in results]
+
+    def run_q1q2(self, MM=None, return_entropy=True, return_after_entropy=False):
+        """Solution for q1 and q2, q2 is only counted for the validation points
+        that are not CP'ed.
+
+        Args:
+            return_after_entropy (bool): also return the after entropies of q3,
+                obtained in the same scan (None for CP'ed validation points)
+        """
         q1_results, cp_preds = self.run_q1(return_preds=True, MM=MM)
 
         cp_idx = [i for i, cp in enumerate(q1_results) if cp]
@@ -77,46 +216,115 @@ class Querier(object):
 
         q2_cp = []
         for i in cp_idx:
-            assert len(cp_preds[i]) == 1
-            pred = cp_preds[i][0]
+            assert cp_preds[i].sum() == 1
+            pred = int(np.argmax(cp_preds[i]))
             res = {c: 0 for c in self.classes}
             res[pred] = 1
             q2_cp.append(res)
 
-        S_val_no_cp = [self.S_val[i] for i in not_cp_idx]
-        q2_no_cp = sort_count_dp_multi(
-            S_val_no_cp, self.y_train, self.K, n_jobs=self.n_jobs
-        )
+        if return_after_entropy:
+            q2_no_cp, _, after_no_cp = self.run_q2q3(not_cp_idx)
+            after_entropy_val = [None] * len(q1_results)
+            for i, after_entropies in zip(not_cp_idx, after_no_cp):
+                after_entropy_val[i] = after_entropies
+        else:
+            q2_no_cp = self.map_val(self.sort_count, not_cp_idx)
         q2_results = self.merge_result([q2_cp, q2_no_cp], [cp_idx, not_cp_idx])
 
-        if return_entropy:
-            entropies_val = np.array(
-                [compute_entropy_by_counts(counts) for counts in q2_results]
-            )
-            return q1_results, q2_results, entropies_val
+        if not return_entropy and not return_after_entropy:
+            return q1_results, q2_results
 
-        return q1_results, q2_results
+        entropies_val = entropy_by_count_dicts(q2_results)
+        if return_after_entropy:
+            return q1_results, q2_results, entropies_val, after_entropy_val
+        return q1_results, q2_results, entropies_val
 
-    def run_q3_select(self, method="cpclean", before_entropy_val=None, MM=None):
-        dirty_rows = [i for i, x in enumerate(self.S_val[0]) if len(x) > 1]
+    def run_q3_select(
+        self,
+        method="cpclean",
+        before_entropy_val=None,
+        selector=None,
+        batch_size=1,
+        gain_ratio=0.0,
+        after_entropy_val=None,
+    ):
+        """Select the next row to clean.
 
-        if method == "cpclean":
-            assert len(self.S_val) == len(MM)
-            after_entropy_val = sort_count_after_clean_multi(
-                self.S_val, self.y_train, self.K, self.n_jobs, MM=MM
-            )
+        Args:
+            method (str): "cpclean" evaluates every dirty row, "lazy" only the
+                rows that selector (LazyGreedy) needs, "batch" selects up to
+                batch_size rows with select_batch, "random" picks one
+            before_entropy_val (np.array): entropy of each validation point
+            selector (LazyGreedy): state of the lazy selection across iterations
+            batch_size (int), gain_ratio (float): see select_batch
+            after_entropy_val (list): after entropies of every validation point
+                for "cpclean" and "batch", e.g. from run_q1q2. Defaults to None,
+                in which case they are computed, together with
+                before_entropy_val if it is None as well.
 
-            # extract counters for dirty rows
-            if before_entropy_val is None:
-                _, before_entropy_val = self.run_q2(MM=MM, return_entropy=True)
+        Return:
+            sel (int), after_entropy_val_sel (list): entropy of each validation
+                point after cleaning sel to each of its candidates. With "batch",
+                lists of them for each selected row.
+        """
+        dirty_rows = self.S_val.dirty_rows
+
+        if method in ["cpclean", "batch"]:
+            if after_entropy_val is None and before_entropy_val is None:
+                _, before_entropy_val, after_entropy_val = self.run_q2q3()
+            elif after_entropy_val is None:
+                after_entropy_val = self.map_after_clean(self.sort_count_after_clean)
+            elif before_entropy_val is None:
+                _, before_entropy_val = self.run_q2(return_entropy=True)
+            with timed("select"):
+                avg_entropies_val = avg_entropy_matrix(
+                    after_entropy_val, dirty_rows, before_entropy_val
+                )
 
-            sel = min_entropy_expected(
-                after_entropy_val, dirty_rows, before_entropy_val, n_jobs=self.n_jobs
-            )
+        if method == "cpclean":
+            with timed("select"):
+                sel = min_entropy_expected(
+                    avg_entropies_val,
+                    dirty_rows,
+                    before_entropy_val,
+                    n_jobs=self.n_jobs,
+                )
 
             after_entropy_val_sel = [ae[sel] for ae in after_entropy_val]
 
             return sel, after_entropy_val_sel
+        elif method == "batch":
+            with timed("select"):
+                sels = select_batch(
+                    avg_entropies_val,
+                    dirty_rows,
+                    before_entropy_val,
+                    batch_size,
+                    gain_ratio=gain_ratio,
+                )
+            return sels, [[ae[sel] for ae in after_entropy_val] for sel in sels]
+        elif method == "lazy":
+            if before_entropy_val is None:
+                _, before_entropy_val = self.run_q2(return_entropy=True)
+
+            evaluated = {}
+
+            def evaluate(rows):
+                after_entropy_val = self.map_after_clean(
+                    self.sort_count_after_clean, rows=rows
+                )
+                for row in rows:
+                    evaluated[row] = [ae[row] for ae in after_entropy_val]
+                with timed("select"):
+                    info_gain = entropy_expected(
+                        after_entropy_val, rows, before_entropy_val, n_jobs=self.n_jobs
+                    )
+                return info_gain * len(self.S_val)
+
+            sel = selector.select(evaluate, dirty_rows)
+            if sel is None:
+                return None, None
+            return sel, evaluated[sel]
         elif method == "random":
             sel = random_select(dirty_rows)
             return sel, None
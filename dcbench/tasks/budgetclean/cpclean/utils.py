@@ -1,11 +1,31 @@
 import json
+import multiprocessing as mp
 import os
-from multiprocessing import Process, Queue
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
 
 import numpy as np
 import pandas as pd
 from scipy.stats import entropy
 
+from dcbench.common.broadcast import Broadcast
+
+# seconds spent in each phase of the computations by the current process
+PHASE_TIMES = Counter()
+
+
+@contextmanager
+def timed(phase):
+    """Add the time spent in the block to PHASE_TIMES[phase]."""
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_TIMES[phase] += time.perf_counter() - tic
+
 
 def makedir(dir_list, file=None):
     save_dir = os.path.join(*dir_list)
@@ -53,46 +73,562 @@ def compute_entropy(counts):
     return entropy(p)
 
 
-class Pool(object):
-    """docstring for Pool."""
+def min_max_similarities(values, starts, lengths, out=None):
+    """Compute the min and max similarity of the candidates of each row.
 
-    def __init__(self, n_jobs):
-        super(Pool, self).__init__()
-        self.n_jobs = n_jobs
+    Args:
+        values (np.array): #val x #candidate similarities
+        starts, lengths (np.array): position of the first candidate and number of
+            candidates of each row
+        out (np.array): #val x #row x 2 array to write to. Defaults to None, in
+            which case one is allocated.
 
-    def fn_batch(self, fn, arg_batch, q):
-        res = [(i, fn(arg)) for i, arg in arg_batch]
-        q.put(res)
+    Return:
+        MM (np.array): #val x #row x 2 min and max similarity of each row
+    """
+    if out is None:
+        out = np.empty((values.shape[0], len(starts), 2), dtype=values.dtype)
+    out[:, :, 0] = out[:, :, 1] = values[:, starts]
+    for j in range(1, lengths.max(initial=1)):
+        rows = np.flatnonzero(lengths > j)
+        column = values[:, starts[rows] + j]
+        out[:, rows, 0] = np.minimum(out[:, rows, 0], column)
+        out[:, rows, 1] = np.maximum(out[:, rows, 1], column)
+    return out
 
-    def array_split(self, arr, n):
-        if len(arr) > n:
-            res = []
-            idx = np.array_split(np.arange(len(arr)), n)
-            for i in idx:
-                res.append([(j, arr[j]) for j in i])
-        else:
-            res = [[(i, a)] for i, a in enumerate(arr)]
-        return res
 
-    def map(self, fn, args):
-        arg_batches = self.array_split(args, self.n_jobs)
+class SimilaritySpace(object):
+    """Similarities of the candidates of every training row to every validation
+    point, in a CSR-like layout.
+
+    The candidates of a training row are the same for all validation points, so
+    their positions are stored once: the similarities of the candidates of row r to
+    validation point i are ``values[i, starts[r] : starts[r] + lengths[r]]``.
+    Cleaning a row only moves its start and sets its length to 1, the similarities
+    themselves are never written to.
+
+    The order in which sort_count scans the candidates of a validation point is
+    sorted once and kept across cleaning (see :meth:`sorted_candidates`),
+    cleaning only drops the removed candidates from it.
+
+    A space can hold some of the rows of values and MM only (see :meth:`take`), so
+    that pruning validation points never copies the similarities.
+
+    Args:
+        values (np.array): #val x #candidate similarities, the candidates of each
+            row are contiguous
+        lengths (np.array): number of candidates of each row
+        MM (np.array): #val x #train x 2 min and max similarity of each row.
+            Defaults to None, in which case it is computed from the values.
+        starts (np.array): position of the first candidate of each row. Defaults
+            to None, in which case the rows follow each other.
+        points (np.array): position in values of each validation point of the
+            space. Defaults to None, in which case they are all the rows of values.
+        mm_points (np.array): position in MM of each validation point, likewise.
+    """
 
-        q = Queue()
-        procs = [
-            Process(target=self.fn_batch, args=(fn, arg_batch, q))
-            for arg_batch in arg_batches
+    def __init__(
+        self, values, lengths, MM=None, starts=None, points=None, mm_points=None
+    ):
+        self.values = values
+        self.points = None if points is None else np.asarray(points, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        if starts is None:
+            starts = np.cumsum(self.lengths) - self.lengths
+        self.starts = np.array(starts, dtype=np.int64)
+        if MM is None:
+            values = self.values[self._at(self.points)]
+            MM = min_max_similarities(values, self.starts, self.lengths)
+            mm_points = None
+        self._MM = MM
+        self.mm_points = (
+            None if mm_points is None else np.asarray(mm_points, dtype=np.int64)
+        )
+
+        # row of each candidate, -1 for the candidates removed by collapse
+        self.candidate_rows = np.full(self.values.shape[1], -1, dtype=np.int64)
+        self.candidate_rows[self._positions(np.arange(self.n_rows))] = np.repeat(
+            np.arange(self.n_rows), self.lengths
+        )
+        # validation point -> (sorted positions, rows they were sorted for)
+        self._orders = {}
+
+    @classmethod
+    def from_lists(cls, S_val, MM=None):
+        """Pack the similarities of each validation point, given as a list of
+        arrays with one array per training row.
+
+        Raises:
+            ValueError: if the rows do not have the same number of candidates for
+                all validation points
+        """
+        lengths = [len(s) for s in S_val[0]] if len(S_val) > 0 else []
+        for S in S_val:
+            if [len(s) for s in S] != lengths:
+                raise ValueError(
+                    "The rows must have the same candidates for all validation points."
+                )
+        values = np.array([np.concatenate(S) for S in S_val])
+        values = values.reshape(len(S_val), sum(lengths))
+        return cls(values, lengths, MM=None if MM is None else np.array(MM))
+
+    def __len__(self):
+        return self.values.shape[0] if self.points is None else len(self.points)
+
+    def __getitem__(self, i):
+        """Similarities of validation point i, as a list of arrays (views)."""
+        v = self.values[self._at(self.points, i)]
+        return [
+            v[start : start + length]
+            for start, length in zip(self.starts.tolist(), self.lengths.tolist())
         ]
 
-        for p in procs:
-            p.start()
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @staticmethod
+    def _at(points, i=slice(None)):
+        """Position of validation point(s) i in an array indexed by points."""
+        return i if points is None else points[i]
+
+    @property
+    def MM(self):
+        """#val x #train x 2 min and max similarity of each row, a copy if the
+        space was taken from another one (use :meth:`mm` for a single point)."""
+        return self._MM if self.mm_points is None else self._MM[self.mm_points]
+
+    def mm(self, i):
+        """Min and max similarity of each row to validation point i (a view)."""
+        return self._MM[self._at(self.mm_points, i)]
+
+    def similarities(self, row, index):
+        """Similarity of the candidate `index` of training row `row` to each
+        validation point."""
+        return self.values[self._at(self.points), self.starts[row] + index]
+
+    @property
+    def n_rows(self):
+        return len(self.lengths)
+
+    @property
+    def dirty_rows(self):
+        """Rows with more than one candidate."""
+        return np.flatnonzero(self.lengths > 1).tolist()
+
+    def _positions(self, rows):
+        """Positions of the candidates of the given rows, row after row."""
+        lengths = self.lengths[rows]
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return (
+            np.repeat(self.starts[rows], lengths) + np.arange(lengths.sum()) - offsets
+        )
+
+    def collapse(self, row, index):
+        """Keep only the candidate `index` of training row `row`."""
+        if not 0 <= index < self.lengths[row]:
+            raise IndexError("Row {} has {} candidates.".format(row, self.lengths[row]))
+        start = self.starts[row]
+        self.candidate_rows[start : start + self.lengths[row]] = -1
+        self.candidate_rows[start + index] = row
+        self.starts[row] += index
+        self.lengths[row] = 1
+        self._MM[self._at(self.mm_points), row] = self.similarities(row, 0)[:, None]
+
+    def sorted_candidates(self, i, rows):
+        """Candidates of the given rows for validation point i, in the order of
+        sort_count's `sort`: by similarity, ties go to the larger row and then to
+        the larger candidate.
+
+        The order is cached and reused as long as rows is a subset of the rows of
+        the previous call, which holds across cleaning since pruning only ever
+        removes rows. Reusing it only filters out the candidates removed since,
+        instead of sorting again.
+
+        Args:
+            i (int): validation point
+            rows (np.array): rows, in increasing order
+
+        Return:
+            ri, rj (np.array): row and index in the row of each candidate
+            sij (np.array): similarity of each candidate
+        """
+        values = self.values[self._at(self.points, i)]
+        needed = np.zeros(self.n_rows, dtype=bool)
+        needed[rows] = True
+        cached = self._orders.get(i)
+
+        if cached is not None and np.count_nonzero(needed[cached[1]]) == len(rows):
+            positions = cached[0]
+            ri = self.candidate_rows[positions]
+            positions = positions[(ri >= 0) & needed[ri]]
+        else:
+            positions = self._positions(rows)
+            ri = self.candidate_rows[positions]
+            rj = positions - self.starts[ri]
+            positions = positions[np.lexsort((-rj, -ri, values[positions]))]
+
+        self._orders[i] = (positions, np.asarray(rows))
+        ri = self.candidate_rows[positions]
+        return ri, positions - self.starts[ri], values[positions]
+
+    def take(self, indices):
+        """The space of the validation points at the given positions.
+
+        The values and MM are shared rather than copied, so collapsing the
+        result also collapses these points in the MM of this space, which should
+        then no longer be used (see :meth:`copy`). Neither take nor copy keep the
+        cached orders.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        points = np.arange(len(self)) if self.points is None else self.points
+        mm_points = np.arange(len(self)) if self.mm_points is None else self.mm_points
+        return SimilaritySpace(
+            self.values,
+            self.lengths,
+            self._MM,
+            self.starts,
+            points=points[indices],
+            mm_points=mm_points[indices],
+        )
+
+    def copy(self):
+        """A copy that can be collapsed independently, the values are shared and
+        only MM is copied."""
+        MM = self._MM.copy() if self.mm_points is None else self.MM
+        return SimilaritySpace(
+            self.values, self.lengths, MM, self.starts, points=self.points
+        )
+
+    def to_lists(self):
+        return [self[i] for i in range(len(self))]
+
+
+def as_space(S_val, MM=None):
+    """Return S_val as a SimilaritySpace, packing it if it is a list. MM is only used
+    in the latter case, a SimilaritySpace holds its own."""
+    if isinstance(S_val, SimilaritySpace):
+        return S_val
+    return SimilaritySpace.from_lists(S_val, MM)
+
+
+def share_similarities(space, y_train):
+    """Place the arrays of a SimilaritySpace in shared memory, so that worker
+    processes can read them without each deserializing a private copy.
+
+    Return:
+        shared (Broadcast): use :func:`unshare_similarities` to read it back
+    """
+    values = space.values if space.points is None else space.values[space.points]
+    return Broadcast(
+        {
+            "values": values,
+            "lengths": space.lengths,
+            "starts": space.starts,
+            "MM": space.MM,
+            "y_train": np.asarray(y_train),
+        }
+    )
+
+
+def unshare_similarities(shared):
+    """Read a SimilaritySpace back from a Broadcast created with
+    :func:`share_similarities`.
+
+    Return:
+        space (SimilaritySpace), y_train (np.array)
+    """
+    data = shared.value
+    space = SimilaritySpace(
+        data["values"], data["lengths"], data["MM"], starts=data["starts"]
+    )
+    return space, data["y_train"]
+
+
+def _inherits_memory():
+    """Whether workers are forked, in which case they inherit the memory of the
+    parent process and their arguments are never pickled."""
+    return mp.get_start_method() == "fork"
 
+
+class _WorkerState(object):
+    """Similarities of the validation points assigned to one worker.
+
+    The worker can read the values of the other points too. When it is given a
+    part of the work of one of them (see WorkerPool.map_parts), the point is kept
+    as a guest, with its own MM and sorted order, and collapsed along with the
+    others.
+    """
+
+    def __init__(self, space, y_train, indices):
+        self.y_train = y_train
+        # the values are only read and shared, a worker collapses its own MM
+        if list(indices) == list(range(len(space))):
+            self.space = space.copy()
+        else:
+            self.space = space.take(indices).copy()
+        self.position = {i: k for k, i in enumerate(indices)}
+        # position in the values of every validation point
+        self.points = space.points
+        self.guests = {}
+
+    def _point(self, i):
+        """Space holding validation point i and its position in the space."""
+        if i in self.position:
+            return self.space, self.position[i]
+        if i not in self.guests:
+            self.guests[i] = SimilaritySpace(
+                self.space.values,
+                self.space.lengths,
+                starts=self.space.starts,
+                points=[SimilaritySpace._at(self.points, i)],
+            )
+        return self.guests[i], 0
+
+    def map(self, fn, K, indices, use_mm):
         results = []
-        for p in procs:
-            results.extend(q.get())
+        for i in indices:
+            k = self.position[i]
+            mm = self.space.mm(k) if use_mm else None
+            # the sorted order of each point persists in the space of the worker
+            order = partial(self.space.sorted_candidates, k)
+            results.append((i, fn(self.space[k], self.y_train, K, mm=mm, order=order)))
+        return results
+
+    def map_parts(self, fn, K, parts):
+        results = []
+        for key, i, rows in parts:
+            space, k = self._point(i)
+            order = partial(space.sorted_candidates, k)
+            result = fn(
+                space[k], self.y_train, K, mm=space.mm(k), order=order, rows=rows
+            )
+            results.append((key, result))
+        return results
+
+    def clean(self, row, index):
+        self.space.collapse(row, index)
+        for guest in self.guests.values():
+            guest.collapse(row, index)
+
+
+def _worker_loop(inbox, outbox, space, y_train, indices):
+    if isinstance(space, Broadcast):
+        space, y_train = unshare_similarities(space)
+    state = _WorkerState(space, y_train, indices)
+
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        method, args = message
+        tic = time.perf_counter()
+        phases = PHASE_TIMES.copy()
+        try:
+            result = getattr(state, method)(*args)
+        except Exception:
+            outbox.put(("error", traceback.format_exc(), 0, {}))
+        else:
+            elapsed = time.perf_counter() - tic
+            outbox.put(("ok", result, elapsed, dict(PHASE_TIMES - phases)))
+
+
+class WorkerPool(object):
+    """Long-lived worker processes holding the similarities of a cleaning session.
+
+    The validation points are spread over the workers once, when the pool is
+    created. Afterwards, :meth:`map` only sends the function to apply and the
+    indices of the validation points to apply it to, and :meth:`clean` only sends
+    the row that was cleaned, which every worker applies to its own copy of the
+    similarities. :meth:`map_parts` spreads the work of single validation points
+    over several workers.
+
+    .. code-block:: python
+
+        with WorkerPool(S_val, y_train, MM, n_jobs=4) as pool:
+            results = pool.map(sort_count_dp, K)
+            pool.clean(sel, gt_indices[sel])
+
+    Args:
+        S_val (SimilaritySpace): similarities of the candidates of each training
+            row to each validation point, or a list of list of np.array
+        y_train (np.array): labels of training set
+        MM (list of np.array): min and max similarity of each training row to each
+            validation point, when S_val is a list
+        n_jobs (int): number of worker processes. With 1, everything runs in the
+            current process.
+    """
+
+    def __init__(self, S_val, y_train, MM=None, n_jobs=4):
+        space = as_space(S_val, MM)
+        self.n_val = len(space)
+        self.n_workers = max(min(n_jobs, self.n_val), 1)
+        self._state = None
+        self._workers = []
+        self._shared = None
+        # seconds the workers were busy and seconds spent waiting for them
+        self.busy_time = 0.0
+        self.wall_time = 0.0
+        # seconds the workers spent in each phase, see timed
+        self.phase_times = Counter()
 
-        for p in procs:
-            p.join()
+        if self.n_workers == 1:
+            self._state = _WorkerState(space, y_train, range(self.n_val))
+            return
 
-        sorted_results = sorted(results)
-        results = [res for i, res in sorted_results]
+        if _inherits_memory():
+            args = (space, y_train)
+        else:
+            # workers would otherwise each deserialize a copy of all similarities
+            self._shared = share_similarities(space, y_train)
+            args = (self._shared, None)
+
+        ctx = mp.get_context()
+        for w in range(self.n_workers):
+            inbox, outbox = ctx.Queue(), ctx.Queue()
+            process = ctx.Process(
+                target=_worker_loop,
+                args=(inbox, outbox) + args + (self._owned(w, range(self.n_val)),),
+                daemon=True,
+            )
+            process.start()
+            self._workers.append((process, inbox, outbox))
+
+    def _owned(self, w, indices):
+        # round robin, so that pruning the validation points keeps them balanced
+        return [i for i in indices if i % self.n_workers == w]
+
+    def _call(self, method, args_per_worker):
+        if self._state is not None:
+            tic = time.perf_counter()
+            phases = PHASE_TIMES.copy()
+            result = getattr(self._state, method)(*args_per_worker[0])
+            self.busy_time += time.perf_counter() - tic
+            self.wall_time += time.perf_counter() - tic
+            self.phase_times.update(PHASE_TIMES - phases)
+            return [result]
+
+        tic = time.perf_counter()
+        for (_, inbox, _), args in zip(self._workers, args_per_worker):
+            if args is not None:
+                inbox.put((method, args))
+
+        results = []
+        for (_, _, outbox), args in zip(self._workers, args_per_worker):
+            if args is not None:
+                status, result, elapsed, phases = outbox.get()
+                if status == "error":
+                    raise RuntimeError("Worker failed:\n" + result)
+                results.append(result)
+                self.busy_time += elapsed
+                self.phase_times.update(phases)
+        self.wall_time += time.perf_counter() - tic
         return results
+
+    def map(self, fn, K, indices=None, use_mm=True):
+        """Apply fn(S, y_train, K, mm=mm, order=order) to validation points, where
+        order(rows) returns the candidates of the rows in sorted order (see
+        SimilaritySpace.sorted_candidates).
+
+        Args:
+            fn (callable): picklable function of a single validation point
+            K (int): KNN hyper-parameter
+            indices (list): indices of the validation points, as passed to the
+                constructor. Defaults to all of them.
+            use_mm (bool): pass the min and max similarities, otherwise mm=None
+
+        Return:
+            results (list): the result for each validation point in indices
+        """
+        indices = list(range(self.n_val)) if indices is None else list(indices)
+        if self._state is not None:
+            return [res for _, res in self._call("map", [(fn, K, indices, use_mm)])[0]]
+
+        args_per_worker = []
+        for w in range(self.n_workers):
+            owned = self._owned(w, indices)
+            args_per_worker.append((fn, K, owned, use_mm) if len(owned) > 0 else None)
+
+        results = dict(
+            item for result in self._call("map", args_per_worker) for item in result
+        )
+        return [results[i] for i in indices]
+
+    def map_parts(self, fn, K, parts, costs=None):
+        """Apply fn(S, y_train, K, mm=mm, order=order, rows=rows) to parts of
+        validation points, on any worker, e.g. sort_count_after_clean on a subset
+        of the dirty rows.
+
+        Like :meth:`map`, only the indices of the validation points and the rows
+        are sent. The workers keep the points they are given parts of, so that
+        their sorted order persists as well. Parts are assigned longest first to
+        the least loaded worker.
+
+        Args:
+            fn (callable): picklable function of a single validation point
+            K (int): KNN hyper-parameter
+            parts (list): (index of the validation point, rows) of each part
+            costs (list): estimated cost of each part. Defaults to None, in which
+                case all parts cost the same.
+
+        Return:
+            results (list): the result of each part
+        """
+        parts = [(key, i, rows) for key, (i, rows) in enumerate(parts)]
+        if self._state is not None:
+            return [res for _, res in self._call("map_parts", [(fn, K, parts)])[0]]
+
+        costs = [1] * len(parts) if costs is None else costs
+        loads = [0] * self.n_workers
+        assigned = [[] for _ in range(self.n_workers)]
+        for key in sorted(range(len(parts)), key=lambda key: -costs[key]):
+            w = loads.index(min(loads))
+            assigned[w].append(parts[key])
+            loads[w] += costs[key]
+
+        args_per_worker = [(fn, K, a) if len(a) > 0 else None for a in assigned]
+        results = dict(
+            item
+            for result in self._call("map_parts", args_per_worker)
+            for item in result
+        )
+        return [results[key] for key in range(len(parts))]
+
+    def utilization(self, reset=True):
+        """Fraction of the capacity of the workers that was used by the calls
+        since the last reset, or 1 if there were none."""
+        if self.wall_time == 0:
+            return 1.0
+        utilization = self.busy_time / (self.wall_time * self.n_workers)
+        if reset:
+            self.busy_time = self.wall_time = 0.0
+        return utilization
+
+    def clean(self, row, index):
+        """Keep only the candidate `index` of training row `row`."""
+        self._call("clean", [(row, index)] * self.n_workers)
+
+    def close(self):
+        """Stop the workers."""
+        for process, inbox, _ in self._workers:
+            if process.is_alive():
+                inbox.put(None)
+        for process, _, _ in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._workers = []
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
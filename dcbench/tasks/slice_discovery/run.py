@@ -21,18 +21,22 @@ import os
 
 from domino.utils import unpack_args
 from dcbench import Artifact
+from dcbench.common.broadcast import Broadcast
 from dcbench import SliceDiscoveryProblem, SliceDiscoverySolution
 import dcbench
 from .metrics import compute_solution_metrics
 
 task = dcbench.tasks["slice_discovery"]
 
-def _run_sdms(problems: List[SliceDiscoveryProblem], **kwargs):
+def _run_sdms(problems: List[SliceDiscoveryProblem], embs, **kwargs):
+    if isinstance(embs, Broadcast):
+        # attach to the embeddings in shared memory instead of copying them
+        embs = embs.value
     result = []
     for problem in problems:
         #f = io.StringIO()
         #with redirect_stdout(f):
-        result.append(run_sdm(problem, **kwargs))
+        result.append(run_sdm(problem, embs=embs, **kwargs))
     return result
 
 def run_sdms(
@@ -75,7 +79,14 @@ def run_sdms(
 
         ray.init()
         run_fn = ray.remote(_run_sdms).remote
-        embs = ray.put(embs) 
+        if len([node for node in ray.nodes() if node["Alive"]]) > 1:
+            # shared memory is local to a host, so the workers of a multi-node
+            # cluster get the embeddings from the object store instead
+            embs = ray.put(embs)
+        else:
+            # the workers all read the embeddings from the same shared memory, so
+            # memory use stays flat as workers are added
+            embs = Broadcast(embs)
     else:
         run_fn = _run_sdms
 
@@ -83,36 +94,42 @@ def run_sdms(
     results = []
     t = tqdm(total=total_batches)
 
-    for start_idx in range(0, len(problems), batch_size):
-        batch = problems[start_idx : start_idx + batch_size]
-
-        result = run_fn(
-            problems=batch,
-            embs=embs,
-            slicer_class=slicer_class,
-            slicer_config=slicer_config,
-        )
+    try:
+        for start_idx in range(0, len(problems), batch_size):
+            batch = problems[start_idx : start_idx + batch_size]
 
-        if num_workers == 0:
-            t.update(n=len(result))
-            results.extend(result)
-        else:
-            # in the parallel case, this is a single object reference
-            # moreover, the remote returns immediately so we don't update tqdm
-            results.append(result)
+            result = run_fn(
+                problems=batch,
+                embs=embs,
+                slicer_class=slicer_class,
+                slicer_config=slicer_config,
+            )
 
-    if num_workers > 0:
-        # if we're working in parallel, we need to wait for the results to come back
-        # and update the tqdm accordingly
-        result_refs = results
-        results = []
-        while result_refs:
-            done, result_refs = ray.wait(result_refs)
-            for result in done:
-                result = ray.get(result)
-                results.extend(result)
+            if num_workers == 0:
                 t.update(n=len(result))
-        ray.shutdown()
+                results.extend(result)
+            else:
+                # in the parallel case, this is a single object reference
+                # moreover, the remote returns immediately so we don't update tqdm
+                results.append(result)
+
+        if num_workers > 0:
+            # if we're working in parallel, we need to wait for the results to come
+            # back and update the tqdm accordingly
+            result_refs = results
+            results = []
+            while result_refs:
+                done, result_refs = ray.wait(result_refs)
+                for result in done:
+                    result = ray.get(result)
+                    results.extend(result)
+                    t.update(n=len(result))
+    finally:
+        if num_workers > 0:
+            # release the shared embeddings even if a worker fails
+            ray.shutdown()
+            if isinstance(embs, Broadcast):
+                embs.close()
     solutions, metrics = zip(*results)
     # flatten the list of lists 
     metrics = [row for slices in metrics for row in slices]
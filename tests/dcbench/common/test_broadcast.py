@@ -0,0 +1,102 @@
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import meerkat as mk
+import numpy as np
+import pytest
+import torch
+
+from dcbench.common import broadcast
+from dcbench.common.broadcast import Broadcast
+
+
+def _sum_emb(key: str, shared: Broadcast) -> float:
+    return float(shared.value[key]["emb"].sum())
+
+
+@pytest.fixture(params=["shm", "mmap"])
+def backend(request):
+    return request.param
+
+
+def test_broadcast_nested(backend):
+    obj = {
+        "array": np.arange(100_000, dtype=np.float32),
+        "small": np.arange(3),
+        "list": [torch.ones(200, 100), "name"],
+    }
+    with Broadcast(obj, backend=backend) as shared:
+        assert shared.nbytes == 100_000 * 4 + 200 * 100 * 4
+        value = pickle.loads(pickle.dumps(shared)).value
+        assert np.array_equal(value["array"], obj["array"])
+        assert np.array_equal(value["small"], obj["small"])
+        assert isinstance(value["list"][0], torch.Tensor)
+        assert torch.equal(value["list"][0], obj["list"][0])
+        assert value["list"][1] == "name"
+
+
+def test_broadcast_datapanel(backend):
+    embs = {
+        "a": mk.DataPanel({"id": np.arange(1000), "emb": np.ones((1000, 64))}),
+        "b": mk.DataPanel({"id": np.arange(1000), "emb": torch.ones(1000, 64) * 2}),
+    }
+    with Broadcast(embs, backend=backend, min_nbytes=0) as shared:
+        # pickling the broadcast only pickles the names of the segments
+        assert len(pickle.dumps(shared)) < 2048
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            sums = list(executor.map(partial(_sum_emb, shared=shared), ["a", "b"]))
+        assert sums == [1000 * 64, 1000 * 64 * 2]
+
+        value = shared.value["a"]
+        assert isinstance(value, mk.DataPanel)
+        assert np.array_equal(value["id"], np.arange(1000))
+
+
+def test_broadcast_close_with_views(backend):
+    obj = {"array": np.arange(100_000, dtype=np.float32)}
+    shared = Broadcast(obj, backend=backend)
+    value = pickle.loads(pickle.dumps(shared)).value
+    if backend == "mmap":
+        with pytest.raises(ValueError):
+            value["array"][0] = 1
+
+    # closing never fails, even while arrays backed by the segments are alive
+    array = shared.value["array"]
+    shared.close()
+    assert np.array_equal(array, obj["array"])
+    assert np.array_equal(value["array"], obj["array"])
+    del array, value
+    Broadcast(np.arange(3), backend=backend).close()
+
+
+@pytest.mark.skipif(
+    os.name != "posix" or sys.version_info >= (3, 13),
+    reason="only python < 3.13 tracks attached segments, on POSIX",
+)
+def test_broadcast_attach_untracked(monkeypatch):
+    tracked = set()
+    tracker = broadcast.resource_tracker
+    register, unregister = tracker.register, tracker.unregister
+
+    def track(name, rtype):
+        tracked.add(name)
+        register(name, rtype)
+
+    def untrack(name, rtype):
+        tracked.remove(name)
+        unregister(name, rtype)
+
+    monkeypatch.setattr(tracker, "register", track)
+    monkeypatch.setattr(tracker, "unregister", untrack)
+    with Broadcast(np.arange(100_000), backend="shm") as shared:
+        # the segment is tracked once by its owner, which unlinks it on close
+        assert len(tracked) == 1
+        value = pickle.loads(pickle.dumps(shared)).value
+        assert len(tracked) == 1
+        assert np.array_equal(value, np.arange(100_000))
+        del value
+    assert len(tracked) == 0
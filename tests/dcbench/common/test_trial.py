@@ -0,0 +1,131 @@
+import time
+import uuid
+from typing import List
+
+import pandas as pd
+import pytest
+
+from dcbench.common.result import Result
+from dcbench.common.solver import solver
+from dcbench.common.table import RowMixin, RowUnion
+from dcbench.common.trial import Trial
+
+
+class SimpleProblem(RowMixin):
+    def __init__(self, id: str, value: int):
+        super().__init__(id=id, attributes={"value": value})
+
+    def evaluate(self, solution: RowMixin) -> Result:
+        return Result(
+            id=solution.id,
+            attributes={"score": solution.attributes["guess"] * 2},
+        )
+
+
+def double_solver(problem: SimpleProblem) -> RowMixin:
+    return RowMixin(
+        id=uuid.uuid4().hex, attributes={"guess": problem.attributes["value"]}
+    )
+
+
+@solver(id="batched_solver", summary="Solves problems in batches.")
+def batched_solver(problem: SimpleProblem) -> RowMixin:
+    return double_solver(problem)
+
+
+@batched_solver.batch
+def batched_solver_batch(problems: List[SimpleProblem]) -> List[RowMixin]:
+    return [
+        RowMixin(
+            id=uuid.uuid4().hex,
+            attributes={"guess": problem.attributes["value"], "batch": len(problems)},
+        )
+        for problem in problems
+    ]
+
+
+def slow_solver(problem: SimpleProblem) -> RowMixin:
+    if problem.attributes["value"] == 0:
+        time.sleep(10)
+    return double_solver(problem)
+
+
+def mostly_slow_solver(problem: SimpleProblem) -> RowMixin:
+    if problem.attributes["value"] != 0:
+        time.sleep(10)
+    return double_solver(problem)
+
+
+@pytest.fixture
+def problems():
+    return [SimpleProblem(id=f"p{idx}", value=idx) for idx in range(4)]
+
+
+def test_evaluate(problems):
+    trial = Trial(problems=problems, solver=double_solver).evaluate(quiet=True)
+    assert len(trial) == 4
+    assert sorted(trial.df["score"]) == [0, 2, 4, 6]
+
+
+def test_iter_evaluate_yields_rows_as_they_complete(problems):
+    trial = Trial(problems=problems, solver=double_solver)
+    for idx, row in enumerate(trial.iter_evaluate(repeat=2, quiet=True)):
+        assert isinstance(row, RowUnion)
+        # each row is already recorded in the trial when it is yielded
+        assert len(trial) == idx + 1
+        assert row.attributes["score"] == 2 * row.attributes["value"]
+    assert len(trial) == 8
+
+
+def test_iter_evaluate_parallel(problems):
+    trial = Trial(problems=problems, solver=double_solver)
+    rows = list(trial.iter_evaluate(repeat=2, quiet=True, n_jobs=2))
+    assert len(rows) == 8
+    assert len(trial) == 8
+    assert sorted(trial.df["score"]) == [0, 0, 2, 2, 4, 4, 6, 6]
+
+
+def test_iter_evaluate_parallel_break():
+    problems = [SimpleProblem(id=f"p{idx}", value=idx) for idx in range(8)]
+    trial = Trial(problems=problems, solver=mostly_slow_solver)
+    start = time.time()
+    for row in trial.iter_evaluate(quiet=True, n_jobs=2, timeout=60):
+        break
+    assert row.attributes["status"] == "ok"
+    assert row.attributes["value"] == 0
+    # the running problems are killed and the pending ones are never run
+    assert time.time() - start < 5
+    assert len(trial) == 1
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_evaluate_timeout(problems, n_jobs):
+    trial = Trial(problems=problems, solver=slow_solver).evaluate(
+        quiet=True, n_jobs=n_jobs, timeout=2
+    )
+    assert len(trial) == 4
+    df = trial.df.set_index("value").sort_index()
+    assert df.loc[0, "status"] == "timeout"
+    assert pd.isnull(df.loc[0, "solve_time"])
+    assert df.loc[0, "elapsed_time"] >= 2
+    assert (df.loc[1:, "status"] == "ok").all()
+    assert list(df.loc[1:, "score"]) == [2, 4, 6]
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_evaluate_batched(problems, n_jobs):
+    trial = Trial(problems=problems, solver=batched_solver).evaluate(
+        quiet=True,
+        n_jobs=n_jobs,
+        batch_by=lambda problem: problem.attributes["value"] % 2,
+    )
+    assert len(trial) == 4
+    assert list(trial.df["batch"]) == [2, 2, 2, 2]
+    assert sorted(trial.df["score"]) == [0, 2, 4, 6]
+
+
+def test_evaluate_batched_without_batch_solver(problems):
+    with pytest.raises(ValueError):
+        Trial(problems=problems, solver=double_solver).evaluate(
+            quiet=True, batch_by="value"
+        )
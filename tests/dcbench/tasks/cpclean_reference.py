@@ -0,0 +1,414 @@
+"""Previous implementations of the cpclean algorithms and random fixtures, which
+the tests and the benchmarks compare the current implementations against."""
+import itertools
+
+import numpy as np
+
+from dcbench.tasks.budgetclean.cpclean.algorithm.sort_count import (
+    change_alpha_beta,
+    compute_B,
+    compute_BR,
+    get_classes,
+    group_by_classes,
+    prune,
+    sort,
+    stablelize,
+)
+from dcbench.tasks.budgetclean.cpclean.algorithm.utils import compute_entropy_by_counts
+
+
+def get_cases(n_must_alpha_c, n_must_beta_c, N_c, classes, K):
+    """Ways to split the K nearest neighbors between two labels, which the
+    legacy scans enumerate (see vote.py for any number of labels)."""
+    cases_c = {}
+
+    for c in classes:
+        n_must_alpha = n_must_alpha_c[c]
+        n_must_beta = n_must_beta_c[c]
+        N = N_c[c]
+        cases_c[c] = set(range(n_must_beta, min(N - n_must_alpha + 1, K + 1)))
+
+    # Only work for binary cases
+    possible_cases = []
+    max_n_beta = {c: 0 for c in classes}
+    classes = list(classes)
+
+    for i in range(K + 1):
+        if i in cases_c[classes[0]] and (K - i) in cases_c[classes[1]]:
+            pred = classes[0] if i > K / 2 else classes[1]
+            possible_cases.append({classes[0]: i, classes[1]: K - i, "knn_pred": pred})
+            max_n_beta[classes[0]] = max(max_n_beta[classes[0]], i)
+            max_n_beta[classes[1]] = max(max_n_beta[classes[1]], K - i)
+
+    return possible_cases, max_n_beta
+
+
+def legacy_sort(S, y):
+    """Tuple-based implementation of :func:`sort` that it replaced."""
+    A = []
+    for ri, (Si, yi) in enumerate(zip(S, y)):
+        for rj, sij in enumerate(Si):
+            A.append((-sij, ri, rj, yi))
+
+    # break tie: small index has larger similarity
+    A = sorted(A)[::-1]
+    sorted_A = []
+
+    for sij, ri, rj, yi in A:
+        sorted_A.append((-sij, ri, rj, yi))
+    return sorted_A
+
+
+def legacy_sort_count_dp(S_full, y_full, K, mm=None):
+    """Implementation of :func:`sort_count_dp` that rebuilds the dp tables at every
+    step of the scan."""
+    S, y, valid_indices = prune(S_full, y_full, K, mm)
+
+    (
+        alpha_beta_c,
+        new_rid,
+        classes,
+        N_c,
+        row_count,
+        n_must_alpha_c,
+        n_must_beta_c,
+    ) = group_by_classes(S, y, get_classes(y))
+    world_counts = {c: 0 for c in classes}
+    # sort
+    sorted_A = sort(S, y).tolist()
+
+    # scan and count
+    Bc = {}
+
+    for sij, ri, rj, yi in sorted_A:
+        new_ri = new_rid[ri]
+
+        # temporarily change alpha beta for current row
+        temp_ab = alpha_beta_c[yi][new_ri]
+        change_alpha_beta(
+            alpha_beta_c,
+            n_must_alpha_c,
+            n_must_beta_c,
+            new_ri,
+            yi,
+            [0, 1 / row_count[yi][new_ri]],
+        )
+
+        # get possible cases
+        cases, max_n_beta = get_cases(n_must_alpha_c, n_must_beta_c, N_c, classes, K)
+
+        if len(cases) > 0:
+            # compute Bc
+            for c in classes:
+                Bc[c], status = compute_B(alpha_beta_c[c], max_n_beta[c])
+                if status == "small":
+                    break
+
+            if status == "big":
+                for case in cases:
+                    counts = np.prod([Bc[c][0, case[c]] for c in classes])
+                    world_counts[case["knn_pred"]] += counts
+
+        # reset alpha beta
+        new_ab = [
+            temp_ab[0] + 1 / row_count[yi][new_ri],
+            temp_ab[1] - 1 / row_count[yi][new_ri],
+        ]
+        new_ab = stablelize(new_ab)
+        change_alpha_beta(
+            alpha_beta_c, n_must_alpha_c, n_must_beta_c, new_ri, yi, new_ab
+        )
+    return world_counts
+
+
+def legacy_init_counter(classes):
+    return {c: 0 for c in classes}
+
+
+def legacy_init_ac_counters(S, classes):
+    ac_counters = []
+    for Si in S:
+        counters = [legacy_init_counter(classes) for _ in range(len(Si))]
+        ac_counters.append(counters)
+    return ac_counters
+
+
+def legacy_count_worlds_fix_ri(B, BR, n_beta, ri):
+    if n_beta < 0:
+        return 0
+    if ri == len(B) - 2:
+        # the bottom row, only use BR
+        n_world = BR[ri, n_beta]
+    elif ri == 0:
+        # the top row, only use B
+        n_world = B[1, n_beta]
+    else:
+        n_world = B[ri + 1, : n_beta + 1].dot(BR[ri, : n_beta + 1][::-1])
+    return n_world
+
+
+def legacy_count_worlds_after_clean(B_c, BR_c, cases, classes, y, new_rid, dirty_rows):
+    count_worlds = []
+
+    for ri, yi in enumerate(y):
+        if ri not in dirty_rows:
+            # omit clean rows
+            count_worlds.append([None, None])
+            continue
+
+        # initialize counter
+        l_count = {c: 0 for c in classes}
+        s_count = {c: 0 for c in classes}
+
+        new_ri = new_rid[ri]
+        other_c = [c for c in classes if c != yi][
+            0
+        ]  # classes other than the current one
+
+        for case in cases:
+            # worlds for other classes
+            world_other = B_c[other_c][0, case[other_c]]
+
+            # world for the current class
+            n_beta_yi = case[yi]
+            world_yi_s = legacy_count_worlds_fix_ri(
+                B_c[yi], BR_c[yi], n_beta_yi, new_ri
+            )
+            world_yi_l = legacy_count_worlds_fix_ri(
+                B_c[yi], BR_c[yi], n_beta_yi - 1, new_ri
+            )
+
+            pred = case["knn_pred"]
+            s_count[pred] += world_yi_s * world_other
+            l_count[pred] += world_yi_l * world_other
+
+        count_worlds.append([s_count, l_count])
+    return count_worlds
+
+
+def legacy_update_ac_counters(ac_counters, sl_counts, ri, rj, S, y, dirty_rows):
+    # update current element using large counts
+    if ri in dirty_rows:
+        l_count = sl_counts[ri][1]
+        for c, value in l_count.items():
+            ac_counters[ri][rj][c] += value
+
+    # update others
+    for i, Si in enumerate(S):
+        if i == ri:
+            continue
+
+        if i not in dirty_rows:
+            continue
+
+        s_count, l_count = sl_counts[i]
+        for j, sij in enumerate(Si):
+            if sij < S[ri][rj] or (sij == S[ri][rj] and i > ri):
+                for c, value in s_count.items():
+                    ac_counters[i][j][c] += value
+            else:
+                for c, value in l_count.items():
+                    ac_counters[i][j][c] += value
+    return ac_counters
+
+
+def legacy_compute_after_entropy(valid_indices, y_full, ac_counters, dirty_rows):
+    after_entropies = []
+    indices_map = {idx: i for i, idx in enumerate(valid_indices)}
+
+    for i in range(len(y_full)):
+        if i not in indices_map:
+            after_entropies.append(None)
+        elif indices_map[i] not in dirty_rows:
+            after_entropies.append(None)
+        else:
+            entropies = [
+                compute_entropy_by_counts(counts)
+                for counts in ac_counters[indices_map[i]]
+            ]
+            after_entropies.append(entropies)
+    return after_entropies
+
+
+def legacy_sort_count_after_clean(S_full, y_full, K, mm=None):
+    """Implementation of :func:`sort_count_after_clean` that rebuilds the dp tables
+    at every step of the scan."""
+    S, y, valid_indices = prune(S_full, y_full, K, mm)
+
+    # omit clean rows in later computation
+    dirty_rows = set([i for i, x in enumerate(S) if len(x) > 1])
+
+    # initialize
+    (
+        alpha_beta_c,
+        new_rid,
+        classes,
+        N_c,
+        row_count,
+        n_must_alpha_c,
+        n_must_beta_c,
+    ) = group_by_classes(S, y, get_classes(y))
+    ac_counters = legacy_init_ac_counters(S, classes)
+
+    # sort
+    sorted_A = sort(S, y).tolist()
+
+    # dp tables
+    B_c = {}
+    BR_c = {}
+    # scan
+    for sij, ri, rj, yi in sorted_A:
+        new_ri = new_rid[ri]
+
+        # temporarily change alpha beta to [0, 1] for current row
+        temp_ab = alpha_beta_c[yi][new_ri]
+        change_alpha_beta(
+            alpha_beta_c,
+            n_must_alpha_c,
+            n_must_beta_c,
+            new_ri,
+            yi,
+            [0, 1 / row_count[yi][new_ri]],
+        )
+
+        # get possible cases
+        cases, max_n_beta = get_cases(n_must_alpha_c, n_must_beta_c, N_c, classes, K)
+
+        # skip if no possible cases
+        if len(cases) > 0:
+            # compute dp tables B_c, BR_c only for the class of the current element
+            for c in classes:
+                B_c[c], status = compute_B(alpha_beta_c[c], max_n_beta[c])
+                if status == "small":
+                    break
+                BR_c[c], status = compute_BR(alpha_beta_c[c], max_n_beta[c])
+                if status == "small":
+                    break
+
+            if status == "big":
+                # count worlds for each cell
+                sl_counts = legacy_count_worlds_after_clean(
+                    B_c, BR_c, cases, classes, y, new_rid, dirty_rows
+                )
+
+                # update counts
+                ac_counters = legacy_update_ac_counters(
+                    ac_counters, sl_counts, ri, rj, S, y, dirty_rows
+                )
+
+        # restore and update alpha beta
+        new_ab = [
+            temp_ab[0] + 1 / row_count[yi][new_ri],
+            temp_ab[1] - 1 / row_count[yi][new_ri],
+        ]
+        new_ab = stablelize(new_ab)
+        change_alpha_beta(
+            alpha_beta_c, n_must_alpha_c, n_must_beta_c, new_ri, yi, new_ab
+        )
+
+    after_entropies = legacy_compute_after_entropy(
+        valid_indices, y_full, ac_counters, dirty_rows
+    )
+    return after_entropies
+
+
+def legacy_compute_similarity(X_train, X_val):
+    """Loop-based implementation of :func:`compute_similarities` that it replaced."""
+    return np.array(
+        [1 / (1 + np.sqrt(np.sum((X_train - x_val) ** 2, axis=1))) for x_val in X_val]
+    )
+
+
+def legacy_make_space(X_train_repairs, X_val, gt=None):
+    """Implementation of :meth:`CPClean.make_space` that computes the similarities
+    of every repair of every row."""
+    sim = np.array(
+        [legacy_compute_similarity(X_train, X_val) for X_train in X_train_repairs]
+    )  # shape (#repair, #val, #train)
+    space_sim = np.transpose(sim, (2, 0, 1))  # shape (#train, #repair, #val)
+    space_X = np.transpose(X_train_repairs, (1, 0, 2))  # shape (#row, #repair, #column)
+    MM = np.array([sim.min(axis=0), sim.max(axis=0)]).transpose(1, 2, 0)
+
+    space_X = np.around(space_X, decimals=12)
+    gt = np.around(gt, decimals=12)
+
+    space = []
+    gt_indices = []
+    S_val_t = []
+    for X, X_gt, S in zip(space_X, gt, space_sim):
+        X_unique, X_indices = np.unique(X, axis=0, return_index=True)
+        S_unique = S[X_indices]
+        gt_id = np.argwhere((X_unique == X_gt).all(axis=1))[0, 0]
+        space.append(X_unique)
+        S_val_t.append(S_unique)
+        gt_indices.append(gt_id)
+
+    S_val = []
+    for i in range(len(X_val)):
+        s_val = [S[:, i] for S in S_val_t]
+        S_val.append(s_val)
+
+    return space, S_val, gt_indices, MM
+
+
+def random_repairs(
+    n_rows, n_val, n_repairs=5, n_features=10, p_dirty=0.2, random_state=0
+):
+    """Generate random repairs of a training set in which a fraction ``p_dirty`` of
+    rows differ across repairs.
+
+    Return:
+        X_train_repairs (np.array): #repair x #train x #column
+        X_val (np.array), gt (np.array)
+    """
+    rng = np.random.RandomState(random_state)
+    X = rng.randn(n_rows, n_features)
+    is_dirty = rng.rand(n_rows, 1) < p_dirty
+    X_train_repairs = np.stack(
+        [X + is_dirty * rng.randn(n_rows, n_features) for _ in range(n_repairs)]
+    )
+    gt = X_train_repairs[rng.randint(0, n_repairs, n_rows), np.arange(n_rows)]
+    return X_train_repairs, rng.randn(n_val, n_features), gt
+
+
+def random_space(n_rows, n_candidates, p_dirty=0.2, n_classes=2, random_state=0):
+    """Generate the similarities of a single validation point to a random training
+    set in which a fraction ``p_dirty`` of rows have ``n_candidates`` candidates.
+
+    Return:
+        S (list of np.array), y (np.array)
+    """
+    rng = np.random.RandomState(random_state)
+    y = rng.randint(0, n_classes, n_rows)
+    S = [rng.rand(n_candidates if rng.rand() < p_dirty else 1) for _ in range(n_rows)]
+    return S, y
+
+
+def brute_force_counts(S, y, K):
+    """Enumerate every possible world and count the KNN predictions, ties go to
+    the largest label."""
+    y = np.asarray(y)
+    counts = {c: 0.0 for c in get_classes(y)}
+    prob = np.prod([1 / len(Si) for Si in S])
+    for world in itertools.product(*[range(len(Si)) for Si in S]):
+        sims = np.array([Si[j] for Si, j in zip(S, world)])
+        # break tie: small index has larger similarity
+        top_k = np.argsort(-sims, kind="stable")[:K]
+        votes = np.bincount(y[top_k], minlength=len(counts))
+        counts[len(votes) - 1 - int(np.argmax(votes[::-1]))] += prob
+    return counts
+
+
+def assert_close(a, b):
+    """Assert that nested counts or entropies are equal up to float rounding."""
+    if isinstance(a, dict):
+        assert a.keys() == b.keys()
+        a, b = list(a.values()), [b[k] for k in a]
+    if isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_close(x, y)
+    elif a is None or b is None:
+        assert a is None and b is None
+    else:
+        assert np.isclose(a, b, rtol=1e-9, atol=1e-12), (a, b)
@@ -0,0 +1,639 @@
+import logging
+import warnings
+from functools import partial
+
+import numpy as np
+import pytest
+from scipy.stats import binom, entropy
+
+from dcbench.tasks.budgetclean.cpclean.algorithm.distance import compute_distances
+from dcbench.tasks.budgetclean.cpclean.algorithm.min_max import (
+    IncrementalMinMax,
+    min_max_batch,
+    min_max_val,
+)
+from dcbench.tasks.budgetclean.cpclean.algorithm.monte_carlo import MonteCarloCounter
+from dcbench.tasks.budgetclean.cpclean.algorithm.poly_tree import PolyTree
+from dcbench.tasks.budgetclean.cpclean.algorithm.select import (
+    LazyGreedy,
+    avg_entropy_matrix,
+    entropy_expected,
+    min_entropy_expected,
+    select_batch,
+)
+from dcbench.tasks.budgetclean.cpclean.algorithm.sort_count import (
+    compute_status,
+    sort,
+    sort_count_after_clean,
+    sort_count_dp,
+    sort_valid,
+)
+from dcbench.tasks.budgetclean.cpclean.algorithm.utils import (
+    compute_entropy_by_counts,
+    entropy_by_count_dicts,
+    entropy_by_counts,
+)
+from dcbench.tasks.budgetclean.cpclean.clean import CPClean
+from dcbench.tasks.budgetclean.cpclean.events import EventLog, IterationEvent
+from dcbench.tasks.budgetclean.cpclean.knn_evaluator import KNNEvaluator
+from dcbench.tasks.budgetclean.cpclean.query import Querier
+from dcbench.tasks.budgetclean.cpclean.utils import SimilaritySpace, WorkerPool
+
+from .cpclean_reference import (
+    assert_close,
+    brute_force_counts,
+    legacy_make_space,
+    legacy_sort,
+    legacy_sort_count_after_clean,
+    legacy_sort_count_dp,
+    random_repairs,
+    random_space,
+)
+
+
+def random_small_space(rng, n_rows=6, max_candidates=3, n_classes=2):
+    y = rng.randint(0, n_classes, n_rows)
+    # rounding produces ties between candidates
+    S = [np.round(rng.rand(rng.randint(1, max_candidates + 1)), 1) for _ in y]
+    return S, y
+
+
+def test_sort():
+    S, y = random_space(1000, 5)
+    S = [np.round(Si, 2) for Si in S]
+    assert [tuple(a) for a in sort(S, y).tolist()] == legacy_sort(S, y)
+
+
+@pytest.mark.parametrize("K", [1, 3])
+def test_sort_count_dp(K):
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        S, y = random_small_space(rng)
+        counts = sort_count_dp(S, y, K)
+        expected = brute_force_counts(S, y, K)
+        assert np.allclose([counts[0], counts[1]], [expected[0], expected[1]])
+
+
+@pytest.mark.parametrize("K", [1, 3, 5])
+def test_sort_count_matches_legacy(K):
+    rng = np.random.RandomState(K)
+    for _ in range(5):
+        S, y = random_small_space(rng, n_rows=40, max_candidates=5)
+        assert_close(sort_count_dp(S, y, K), legacy_sort_count_dp(S, y, K))
+        assert_close(
+            sort_count_after_clean(S, y, K), legacy_sort_count_after_clean(S, y, K)
+        )
+
+
+@pytest.mark.parametrize("K", [1, 2, 3])
+def test_sort_count_multi_class(K):
+    rng = np.random.RandomState(K)
+    for _ in range(10):
+        S, y = random_small_space(rng, n_classes=3)
+        assert_close(sort_count_dp(S, y, K), brute_force_counts(S, y, K))
+
+        counts, after_entropies = sort_count_after_clean(S, y, K, return_counts=True)
+        assert_close(counts, sort_count_dp(S, y, K))
+        for ri, entropies in enumerate(after_entropies):
+            if entropies is None:
+                continue
+            expected = [
+                compute_entropy_by_counts(
+                    brute_force_counts(S[:ri] + [S[ri][[rj]]] + S[ri + 1 :], y, K)
+                )
+                for rj in range(len(S[ri]))
+            ]
+            assert_close(entropies, expected)
+
+
+def test_sort_count_after_clean_rows():
+    rng = np.random.RandomState(0)
+    S, y = random_small_space(rng, n_rows=40, max_candidates=5)
+    rows = [ri for ri, Si in enumerate(S) if len(Si) > 1][::3]
+    expected = sort_count_after_clean(S, y, 3)
+    after_entropies = sort_count_after_clean(S, y, 3, rows=rows)
+    assert_close(
+        after_entropies, [e if ri in rows else None for ri, e in enumerate(expected)]
+    )
+
+
+@pytest.mark.parametrize("K", [1, 3])
+def test_sort_count_fused(K):
+    rng = np.random.RandomState(K)
+    for _ in range(5):
+        S, y = random_small_space(rng, n_rows=40, max_candidates=5)
+        counts, after_entropies = sort_count_after_clean(S, y, K, return_counts=True)
+        assert counts == sort_count_dp(S, y, K)
+        assert after_entropies == sort_count_after_clean(S, y, K)
+
+
+@pytest.mark.parametrize("p", [1e-4, 5e-4, 2e-3])
+def test_compute_status_large(p):
+    # the worlds with at most 3 betas out of 300000 weigh about 5e-10, 4e-60 and
+    # 5e-254, the second one below the rounding error of compute_B
+    n = 300000
+    tree = PolyTree([[1 - p, p]] * n, 3)
+    expected = binom.pmf(np.arange(4), n, p)
+    np.testing.assert_allclose(tree.root, expected, rtol=1e-9)
+    status = compute_status(tree, None, 1, 3)
+    assert status == ("big" if expected.sum() >= 1e-100 / n else "small")
+
+
+def test_sort_count_large():
+    rng = np.random.RandomState(0)
+    n_rows = 100000
+    y = rng.randint(0, 2, n_rows)
+    # clean rows far from the validation point and dirty rows that span it
+    S = list(rng.rand(n_rows, 1) * 0.5)
+    for ri in rng.choice(n_rows, 2000, replace=False):
+        S[ri] = rng.rand(3)
+    counts = sort_count_dp(S, y, 3)
+    assert sum(counts.values()) == pytest.approx(1, rel=1e-9)
+    assert min(counts.values()) > 0
+    assert sort_count_after_clean(S, y, 3, return_counts=True)[0] == counts
+
+
+@pytest.mark.parametrize("K", [1, 3, 4])
+def test_monte_carlo_counter(K):
+    rng = np.random.RandomState(K)
+    counter = MonteCarloCounter(tol=0.02)
+    for _ in range(5):
+        S, y = random_small_space(rng, n_rows=30, max_candidates=4)
+        counts = counter.sort_count(S, y, K)
+        assert counts[1] == pytest.approx(sort_count_dp(S, y, K)[1], abs=0.02)
+
+        # entropies of estimates within 0.02 of p differ by at most about 0.1
+        expected = sort_count_after_clean(S, y, K)
+        for a, b in zip(counter.sort_count_after_clean(S, y, K), expected):
+            assert (a is None) == (b is None)
+            assert b is None or np.allclose(a, b, atol=0.1)
+
+
+def test_monte_carlo_counter_multi_class():
+    rng = np.random.RandomState(0)
+    S, y = random_small_space(rng, n_rows=30, n_classes=3)
+    counter = MonteCarloCounter()
+    with pytest.raises(ValueError):
+        counter.sort_count(S, y, 3)
+    with pytest.raises(ValueError):
+        counter.sort_count_after_clean(S, y, 3)
+    with pytest.raises(ValueError):
+        Querier(3, [S], y, counter=counter)
+
+
+def test_poly_tree():
+    rng = np.random.RandomState(0)
+    alpha = rng.rand(11)
+    alpha_beta = np.stack([alpha, 1 - alpha], axis=1)
+    tree = PolyTree(alpha_beta, K=3)
+    tree.update(4, [0, 0.5])
+    alpha_beta[4] = [0, 0.5]
+
+    def product(rows):
+        result = np.ones(1)
+        for a, b in alpha_beta[rows]:
+            result = np.convolve(result, [a, b])
+        return np.pad(result, (0, 4))[:4]
+
+    assert np.allclose(tree.root, product(np.arange(11)))
+    assert np.allclose(tree.product(2, 7), product(np.arange(2, 7)))
+    for i, worlds in enumerate(tree.leave_one_out()):
+        assert np.allclose(worlds, product(np.arange(11) != i))
+    assert np.allclose(tree.leave_out([4, 0]), tree.leave_one_out()[[4, 0]])
+
+
+def test_select_batch():
+    before = np.array([1.0, 1.0, 0.5])
+    # after entropies of rows 0..3 for each validation point (2 candidates each)
+    after_entropy_val = [
+        [[0, 0], [0, 0.4], [1, 1], None],
+        [[1, 1], [1, 1], [0.2, 0.4], None],
+        [[0.5, 0.5], [0.4, 0.4], [0.5, 0.5], None],
+    ]
+    dirty_rows = [0, 1, 2, 3]
+    assert select_batch(after_entropy_val, dirty_rows, before, 1) == [
+        min_entropy_expected(after_entropy_val, dirty_rows, before)
+    ]
+    # row 1 mostly resolves the validation point that row 0 already resolves
+    assert select_batch(after_entropy_val, dirty_rows, before, 3) == [0, 2, 1]
+    assert select_batch(after_entropy_val, dirty_rows, before, 3, gain_ratio=0.5) == [
+        0,
+        2,
+    ]
+
+    # the average entropies can be passed as a dense matrix
+    avg_entropies_val = avg_entropy_matrix(after_entropy_val, dirty_rows, before)
+    assert np.allclose(avg_entropies_val[:, 3], before)
+    assert np.array_equal(
+        entropy_expected(avg_entropies_val, dirty_rows, before),
+        entropy_expected(after_entropy_val, dirty_rows, before),
+    )
+    assert select_batch(avg_entropies_val, dirty_rows, before, 3) == [0, 2, 1]
+
+
+def test_entropy_by_counts():
+    rng = np.random.RandomState(0)
+    counts = rng.rand(20, 5, 3)
+    counts[::3, :, 1] = 0
+    counts[::4, ::2] = 0
+    entropies = entropy_by_counts(counts)
+    for c, e in zip(counts.reshape(-1, 3), entropies.ravel()):
+        assert e == np.inf if c.sum() == 0 else np.isclose(e, entropy(c))
+    assert np.allclose(
+        entropy_by_count_dicts([{0: 1, 1: 3}, {1: 2, 2: 2}, {0: 1}]),
+        [entropy([1, 3]), np.log(2), 0],
+    )
+
+
+@pytest.mark.parametrize("before", [[np.inf, 0.5], [1.0, 0.5]])
+def test_select_batch_no_gain(before):
+    # no row is known to reduce the entropy of either validation point
+    before = np.array(before)
+    after_entropy_val = [[[1.0, 1.0], [1.0, 1.0]], [[0.5, 0.5], [0.5, 0.5]]]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert select_batch(after_entropy_val, [0, 1], before, 2) == [0]
+
+
+def test_avg_entropy_matrix_no_worlds():
+    # the worlds after cleaning row 1 to its first candidate were all skipped
+    counts = np.array([[[1, 4], [2, 2]], [[0, 0], [2, 2]]])
+    after_entropy_val = [entropy_by_counts(counts).tolist()]
+    before = np.array([np.log(2)])
+    assert np.isinf(after_entropy_val[0][1][0])
+
+    avg_entropies_val = avg_entropy_matrix(after_entropy_val, [0, 1], before)
+    assert avg_entropies_val[0, 1] == before[0]
+    gains = before - avg_entropies_val[0]
+    assert gains[0] > 0 and gains[1] == 0
+    assert select_batch(after_entropy_val, [0, 1], before, 2) == [0]
+
+
+def test_lazy_greedy():
+    # the gain of every row decreases by a row-dependent factor at each step
+    rng = np.random.RandomState(0)
+    gains, decay = rng.rand(30), rng.rand(30)
+    dirty_rows = list(range(30))
+    selector = LazyGreedy(batch_size=2)
+
+    for _ in range(10):
+        expected = dirty_rows[np.argmax(gains[dirty_rows])]
+        sel = selector.select(lambda rows: gains[rows], dirty_rows)
+        assert sel == expected
+        dirty_rows.remove(sel)
+        gains *= decay
+    assert selector.n_evaluated < selector.n_exact
+
+
+def random_similarity_space(rng, n_val=5, n_rows=20, max_candidates=3):
+    lengths = rng.randint(1, max_candidates + 1, n_rows)
+    return SimilaritySpace(np.round(rng.rand(n_val, lengths.sum()), 1), lengths)
+
+
+def test_similarity_space():
+    rng = np.random.RandomState(0)
+    space = random_similarity_space(rng)
+    S_val = space.to_lists()
+    assert np.array_equal(space.MM[2, :, 0], [min(s) for s in S_val[2]])
+    assert np.array_equal(space.MM[2, :, 1], [max(s) for s in S_val[2]])
+
+    row = space.dirty_rows[0]
+    cleaned = space.copy()
+    cleaned.collapse(row, 1)
+    assert cleaned.lengths[row] == 1 and space.lengths[row] > 1
+    assert row not in cleaned.dirty_rows
+    assert np.array_equal(
+        cleaned.MM[:, row],
+        np.stack([space.values[:, space.starts[row] + 1]] * 2, axis=1),
+    )
+    with pytest.raises(IndexError):
+        cleaned.collapse(row, 1)
+
+    taken = cleaned.take([3, 0, 4]).take([0, 1])
+    assert len(taken) == 2
+    assert_close([list(s) for s in taken[0]], [list(s) for s in cleaned[3]])
+    assert np.array_equal(taken.MM, cleaned.MM[[3, 0]])
+    assert np.array_equal(taken.mm(1), cleaned.mm(0))
+
+    packed = SimilaritySpace.from_lists(cleaned.to_lists())
+    assert np.array_equal(packed.MM, cleaned.MM)
+    with pytest.raises(ValueError):
+        SimilaritySpace.from_lists([S_val[0], S_val[1][:-1]])
+
+    # the similarities are shared, and collapsing only writes to the taken points
+    assert taken.values is space.values
+    other = taken.dirty_rows[0]
+    taken.collapse(other, 0)
+    assert np.array_equal(taken.MM[:, other, 0], taken.similarities(other, 0))
+    assert np.array_equal(cleaned.MM[[3, 0], other], taken.MM[:, other])
+    assert np.array_equal(cleaned.MM[[1, 2, 4], other], space.MM[[1, 2, 4], other])
+    assert np.array_equal(taken.copy().MM, taken.MM)
+
+
+def test_sorted_candidates():
+    rng = np.random.RandomState(0)
+    space = random_similarity_space(rng, n_rows=40)
+    y = rng.randint(0, 2, space.n_rows)
+    rows = np.arange(space.n_rows)
+
+    for row in space.dirty_rows[:5]:
+        S_full = space[2]
+        S = [S_full[r] for r in rows]
+        order = partial(space.sorted_candidates, 2)
+        assert np.array_equal(sort_valid(S, y[rows], rows, order), sort(S, y[rows]))
+
+        # the cached order is reused for any subset of the rows
+        space.collapse(row, rng.randint(space.lengths[row]))
+        rows = np.sort(rng.choice(rows, len(rows) - 5, replace=False))
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_worker_pool(n_jobs):
+    rng = np.random.RandomState(0)
+    space = random_similarity_space(rng)
+    y = rng.randint(0, 2, space.n_rows)
+    row = space.dirty_rows[0]
+
+    with WorkerPool(space, y, n_jobs=n_jobs) as pool:
+        assert pool.map(sort_count_dp, 3) == [sort_count_dp(S, y, 3) for S in space]
+
+        # only the cleaned row is sent to the workers
+        pool.clean(row, 0)
+        space.collapse(row, 0)
+        assert pool.map(sort_count_dp, 3, indices=[4, 1]) == [
+            sort_count_dp(space[i], y, 3) for i in [4, 1]
+        ]
+
+
+def test_map_after_clean():
+    rng = np.random.RandomState(0)
+    space = random_similarity_space(rng, n_val=4, n_rows=30)
+    y = rng.randint(0, 2, space.n_rows)
+    rows = space.dirty_rows[::2]
+
+    with WorkerPool(space, y, n_jobs=4) as pool:
+        for kwargs in [{}, {"rows": rows}, {"rows": rows}]:
+            # fewer validation points than workers, their dirty rows are split
+            querier = Querier(3, space.take([2, 0]), y, pool=pool, val_indices=[2, 0])
+            assert_close(
+                querier.map_after_clean(sort_count_after_clean, **kwargs),
+                [
+                    sort_count_after_clean(space[i], y, 3, mm=space.mm(i), **kwargs)
+                    for i in [2, 0]
+                ],
+            )
+            # the workers collapse the points they were given parts of as well
+            pool.clean(rows[-1], 0)
+            space.collapse(rows[-1], 0)
+            rows = rows[:-1]
+        assert 0 < pool.utilization() <= 1
+
+
+def possible_predictions(space, y, K):
+    """Labels predicted by a world of each validation point, by enumeration."""
+    return [
+        [c for c, count in brute_force_counts(S, y, K).items() if count > 0]
+        for S in space.to_lists()
+    ]
+
+
+@pytest.mark.parametrize("n_classes", [2, 3, 4])
+@pytest.mark.parametrize("K", [1, 3, 4, 5])
+def test_min_max_batch(K, n_classes):
+    rng = np.random.RandomState(K)
+    space = random_similarity_space(rng, n_val=30, n_rows=7)
+    y = rng.randint(0, n_classes, space.n_rows)
+
+    q1_results, pred_sets = min_max_batch(space, y, K)
+    expected_q1_results, _, expected_pred_sets = min_max_val(space, y, K)
+    assert np.array_equal(q1_results, expected_q1_results)
+    for cp, possible, expected, predictions in zip(
+        q1_results, pred_sets, expected_pred_sets, possible_predictions(space, y, K)
+    ):
+        assert np.flatnonzero(possible).tolist() == expected
+        # every label a world predicts is possible, and exactly those for two
+        assert set(predictions) <= set(expected)
+        if n_classes == 2:
+            assert predictions == expected
+        if cp:
+            assert len(predictions) == 1
+
+
+@pytest.mark.parametrize("n_classes", [2, 3])
+def test_incremental_min_max(n_classes):
+    rng = np.random.RandomState(0)
+    space = random_similarity_space(rng, n_val=100, n_rows=50)
+    y = rng.randint(0, n_classes, space.n_rows)
+
+    dirty_rows = space.dirty_rows
+    q1 = IncrementalMinMax(space.MM, y, 3)
+    for row in dirty_rows:
+        index = rng.randint(space.lengths[row])
+        q1_results = q1.collapse(row, space.similarities(row, index))
+        space.collapse(row, index)
+        expected_q1_results, expected_pred_sets = min_max_batch(space, y, 3)
+        assert np.array_equal(q1_results, expected_q1_results)
+        assert np.array_equal(q1.pred_sets, expected_pred_sets)
+        q1 = q1.take(np.flatnonzero(~q1_results))
+        space = space.take(np.flatnonzero(~q1_results))
+    assert q1.n_evaluated < 100 * len(dirty_rows)
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{}, {"lazy": True}, {"batch_size": 3}, {"n_jobs": 2}]
+)
+def test_clean_multi_class(kwargs):
+    X_train_repairs, X_val, gt = random_repairs(
+        30, 10, n_repairs=2, n_features=2, p_dirty=0.3
+    )
+    y_train = np.random.RandomState(0).randint(0, 3, 30)
+    cleaner = CPClean(n_jobs=kwargs.pop("n_jobs", 1))
+    _, S_val, gt_indices, _ = cleaner.make_space(X_train_repairs, X_val, gt)
+
+    selection = cleaner.clean(S_val, y_train, gt_indices, **kwargs)
+    assert len(selection) > 0
+
+    # cleaning the selected rows CP's every validation point
+    space = S_val.copy()
+    for row in set(selection):
+        space.collapse(row, gt_indices[row])
+    assert all(len(p) == 1 for p in possible_predictions(space, y_train, 3))
+
+
+def test_knn_evaluator_update():
+    rng = np.random.RandomState(0)
+    X_train, y_train = rng.rand(60, 3), rng.randint(0, 3, 60)
+    X_val, y_val = rng.rand(20, 3), rng.randint(0, 3, 20)
+    X_test, y_test = rng.rand(30, 3), rng.randint(0, 3, 30)
+
+    evaluator = KNNEvaluator(X_train, y_train, X_val, y_val, X_test, y_test, K=5)
+    for row in rng.randint(0, len(X_train), 30):
+        # moving a row next to a validation point brings it into its top K
+        X_train[row] = X_val[rng.randint(len(X_val))] + rng.rand(3) * 0.01
+        evaluator.update(row, X_train[row])
+
+        expected = KNNEvaluator(X_train, y_train, X_val, y_val, X_test, y_test, K=5)
+        assert np.array_equal(evaluator.top_val, expected.top_val)
+        assert np.array_equal(evaluator.top_test, expected.top_test)
+        assert evaluator.score() == expected.score()
+
+
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_compute_distances(chunk_size):
+    rng = np.random.RandomState(0)
+    X_train, X_test = rng.randn(50, 4), rng.randn(20, 4)
+    X_test[3] = X_train[5]
+    expected = np.sqrt(((X_test[:, None] - X_train[None]) ** 2).sum(axis=-1))
+
+    dists = compute_distances(X_train, X_test, chunk_size=chunk_size)
+    assert dists.shape == (20, 50)
+    assert np.allclose(dists, expected)
+    assert dists[3, 5] == pytest.approx(0, abs=1e-6)
+
+    dists = compute_distances(X_train, X_test, chunk_size=chunk_size, dtype=np.float32)
+    assert dists.dtype == np.float32
+    assert np.allclose(dists, expected, atol=1e-3)
+
+
+def test_make_space():
+    X_train_repairs, X_val, _ = random_repairs(100, 10, n_repairs=4, n_features=3)
+    # duplicated repairs are a single candidate
+    X_train_repairs[3] = X_train_repairs[1]
+    gt = X_train_repairs[3]
+
+    space, S_val, gt_indices, MM = CPClean().make_space(X_train_repairs, X_val, gt)
+    legacy_space, legacy_S_val, legacy_gt_indices, legacy_MM = legacy_make_space(
+        X_train_repairs, X_val, gt
+    )
+    assert all(np.array_equal(a, b) for a, b in zip(space, legacy_space))
+    assert gt_indices == legacy_gt_indices
+    assert np.allclose(MM, legacy_MM)
+    assert_close([[list(Si) for Si in S] for S in S_val], legacy_S_val)
+
+
+def test_make_space_chunked(tmpdir):
+    X_train_repairs, X_val, gt = random_repairs(100, 10, n_repairs=4, n_features=3)
+    _, S_val, gt_indices, MM = CPClean().make_space(X_train_repairs, X_val, gt)
+
+    # one validation point at a time, into memory-mapped files
+    cleaner = CPClean(max_memory=1, mmap_dir=str(tmpdir))
+    _, chunked_S_val, chunked_gt_indices, chunked_MM = cleaner.make_space(
+        X_train_repairs, X_val, gt
+    )
+    assert isinstance(chunked_S_val.values, np.memmap)
+    assert chunked_gt_indices == gt_indices
+    assert np.allclose(chunked_S_val.values, S_val.values)
+    assert np.array_equal(chunked_S_val.lengths, S_val.lengths)
+    assert np.allclose(chunked_MM, MM)
+
+
+def test_event_log(tmpdir):
+    X_train_repairs, X_val, gt = random_repairs(60, 10, n_repairs=3, n_features=2)
+    y_train = np.random.RandomState(0).randint(0, 2, 60)
+    cleaner = CPClean(n_jobs=1)
+    _, S_val, gt_indices, MM = cleaner.make_space(X_train_repairs, X_val, gt)
+
+    def selected(path):
+        events = [IterationEvent.from_record(r) for r in EventLog.read(path)]
+        assert [e.n_iter for e in events] == list(range(len(events)))
+        assert events[0].selection is None
+        return [e.selection for e in events[1:]]
+
+    path = str(tmpdir.join("events.jsonl"))
+    selection = cleaner.clean(S_val, y_train, gt_indices, budget=4, event_log=path)
+    assert selected(path) == list(dict.fromkeys(selection))
+
+    # an interrupted run continues from its log
+    interrupted = str(tmpdir.join("interrupted.csv"))
+    with EventLog(interrupted) as log:
+        for record in list(EventLog.read(path))[:3]:
+            log.write(record)
+    cleaner.clean(
+        S_val, y_train, gt_indices, budget=4, restore=True, event_log=interrupted
+    )
+    assert selected(interrupted) == selected(path)
+
+
+def test_event_log_lazy(tmpdir, capsys):
+    X_train_repairs, X_val, gt = random_repairs(60, 10, n_repairs=3, n_features=2)
+    y_train = np.random.RandomState(0).randint(0, 2, 60)
+    cleaner = CPClean(n_jobs=1)
+    _, S_val, gt_indices, _ = cleaner.make_space(X_train_repairs, X_val, gt)
+
+    path = str(tmpdir.join("events.jsonl"))
+    cleaner.clean(S_val, y_train, gt_indices, lazy=True, event_log=path)
+    # progress goes to the log only
+    assert capsys.readouterr().out == ""
+    last = IterationEvent.from_record(list(EventLog.read(path))[-1])
+    assert 0 < last.n_evaluated <= last.n_exact
+
+
+@pytest.mark.parametrize("method", ["sgd_cpclean", "random_clean"])
+def test_event_log_baselines(tmpdir, capsys, caplog, monkeypatch, method):
+    X_train_repairs, X_val, gt = random_repairs(60, 10, n_repairs=3, n_features=2)
+    y_train = np.random.RandomState(0).randint(0, 2, 60)
+    cleaner = CPClean(n_jobs=1)
+    _, S_val, gt_indices, _ = cleaner.make_space(X_train_repairs, X_val, gt)
+    clean = getattr(cleaner, method)
+
+    path = str(tmpdir.join("events.jsonl"))
+    selection = clean(S_val, y_train, gt_indices, event_log=path)
+    records = list(EventLog.read(path))
+    assert [r["selection"] for r in records[1:]] == list(dict.fromkeys(selection))
+
+    # without a log, the iterations are logged instead of printed
+    with caplog.at_level(logging.INFO):
+        assert clean(S_val, y_train, gt_indices) == selection
+    assert capsys.readouterr().out == ""
+    assert sum(r.message.startswith("Iteration") for r in caplog.records) == len(
+        records[1:]
+    )
+
+    # the workers are closed even if an iteration raises
+    closed = []
+    monkeypatch.setattr(WorkerPool, "close", lambda self: closed.append(self))
+    monkeypatch.setattr(
+        SimilaritySpace, "collapse", partial(_raise, RuntimeError("interrupted"))
+    )
+    with pytest.raises(RuntimeError):
+        clean(S_val, y_train, gt_indices)
+    assert len(closed) == (method == "sgd_cpclean")
+
+
+def _raise(error, *args, **kwargs):
+    raise error
+
+
+def test_event_log_on_error(tmpdir, monkeypatch):
+    X_train_repairs, X_val, gt = random_repairs(60, 10, n_repairs=3, n_features=2)
+    y_train = np.random.RandomState(0).randint(0, 2, 60)
+    cleaner = CPClean(n_jobs=1)
+    _, S_val, gt_indices, _ = cleaner.make_space(X_train_repairs, X_val, gt)
+    path = str(tmpdir.join("events.jsonl"))
+    selection = list(
+        dict.fromkeys(cleaner.clean(S_val, y_train, gt_indices, event_log=path))
+    )
+    assert len(selection) > 3
+
+    # the third selection fails, the log still holds the first two
+    run_q3_select = Querier.run_q3_select
+    calls = []
+
+    def failing_run_q3_select(self, *args, **kwargs):
+        calls.append(None)
+        if len(calls) == 3:
+            raise RuntimeError("interrupted")
+        return run_q3_select(self, *args, **kwargs)
+
+    interrupted = str(tmpdir.join("interrupted.jsonl"))
+    monkeypatch.setattr(Querier, "run_q3_select", failing_run_q3_select)
+    with pytest.raises(RuntimeError):
+        cleaner.clean(S_val, y_train, gt_indices, event_log=interrupted)
+    records = list(EventLog.read(interrupted))
+    assert [r["selection"] for r in records[1:]] == selection[:2]
+
+    monkeypatch.setattr(Querier, "run_q3_select", run_q3_select)
+    restored = cleaner.clean(
+        S_val, y_train, gt_indices, restore=True, event_log=interrupted
+    )
+    assert list(dict.fromkeys(restored)) == selection